@@ -0,0 +1,91 @@
+import argparse
+import sys
+
+from .file import FileAnnex
+
+# -----------------------------------------------------------------------------
+
+
+def migrate(args):
+    annex = FileAnnex(args.root_path, shard_width=args.shard_width)
+    num_keys = annex.migrate(from_shard_width=args.from_shard_width)
+    print(f"migrated {num_keys} keys")
+
+
+def rebuild_index(args):
+    annex = FileAnnex(args.root_path, shard_width=args.shard_width, index=True)
+    num_keys = annex.rebuild_index()
+    print(f"indexed {num_keys} keys")
+
+
+def verify_index(args):
+    annex = FileAnnex(args.root_path, shard_width=args.shard_width, index=True)
+    out_of_sync_keys = annex.verify_index()
+
+    for key in out_of_sync_keys:
+        print(key)
+
+    # Exit with an error if the index needs a rebuild, for use in scripts.
+    return 1 if out_of_sync_keys else 0
+
+
+# -----------------------------------------------------------------------------
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(prog="python -m flask_annex")
+    subparsers = parser.add_subparsers(required=True)
+
+    migrate_parser = subparsers.add_parser(
+        "migrate",
+        help="move a file annex root to another shard width",
+    )
+    migrate_parser.add_argument("root_path")
+    migrate_parser.add_argument(
+        "--shard-width",
+        type=int,
+        default=0,
+        help="shard width to migrate to (default: unsharded)",
+    )
+    migrate_parser.add_argument(
+        "--from-shard-width",
+        type=int,
+        default=0,
+        help="shard width the files are stored with now (default: unsharded)",
+    )
+    migrate_parser.set_defaults(func=migrate)
+
+    rebuild_index_parser = subparsers.add_parser(
+        "rebuild-index",
+        help="rebuild the key index of a file annex root from its files",
+    )
+    add_index_arguments(rebuild_index_parser)
+    rebuild_index_parser.set_defaults(func=rebuild_index)
+
+    verify_index_parser = subparsers.add_parser(
+        "verify-index",
+        help="list keys for which the key index doesn't match the files",
+    )
+    add_index_arguments(verify_index_parser)
+    verify_index_parser.set_defaults(func=verify_index)
+
+    return parser
+
+
+def add_index_arguments(parser):
+    parser.add_argument("root_path")
+    parser.add_argument(
+        "--shard-width",
+        type=int,
+        default=0,
+        help="shard width the files are stored with (default: unsharded)",
+    )
+
+
+def main(argv=None):
+    args = get_parser().parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,127 @@
+import contextvars
+
+import asyncio
+import functools
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+
+from . import Annex, utils
+
+# -----------------------------------------------------------------------------
+
+# Keys are pulled from the wrapped annex in batches of this size, so iterating
+# over a listing doesn't cost an executor round trip per key.
+LIST_KEYS_BATCH_SIZE = 1000
+
+# -----------------------------------------------------------------------------
+
+
+class AsyncAnnexBase:
+    def __init__(self, annex, *, max_workers=utils.DEFAULT_MAX_CONCURRENCY):
+        self._annex = annex
+
+        # Transfers block on I/O, so run them on a dedicated, bounded pool
+        # rather than the loop's default executor, where they would compete
+        # with other blocking work.
+        self._executor = ThreadPoolExecutor(
+            max_workers,
+            thread_name_prefix="flask-annex",
+        )
+
+    @property
+    def annex(self):
+        return self._annex
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        # Shutting down waits for in-flight transfers, so don't block the loop
+        # on it.
+        await asyncio.get_running_loop().run_in_executor(
+            None, self._executor.shutdown
+        )
+
+    def close(self):
+        self._executor.shutdown()
+
+    async def _run(self, func, *args, **kwargs):
+        # Copy the context so the Flask app and request contexts are visible
+        # to the wrapped annex, e.g. for send_file and get_upload_info.
+        context = contextvars.copy_context()
+        return await asyncio.get_running_loop().run_in_executor(
+            self._executor,
+            functools.partial(context.run, func, *args, **kwargs),
+        )
+
+    async def delete(self, key):
+        return await self._run(self._annex.delete, key)
+
+    async def delete_many(self, keys):
+        return await self._run(self._annex.delete_many, keys)
+
+    async def delete_prefix(self, prefix):
+        return await self._run(self._annex.delete_prefix, prefix)
+
+    async def exists(self, key):
+        return await self._run(self._annex.exists, key)
+
+    async def get_file(self, key, out_file):
+        return await self._run(self._annex.get_file, key, out_file)
+
+    async def list_entries(self, prefix, **kwargs):
+        entries = await self._run(self._annex.list_entries, prefix, **kwargs)
+        async for entry in self._iter_batched(entries):
+            yield entry
+
+    async def list_keys(self, prefix, **kwargs):
+        keys = await self._run(self._annex.list_keys, prefix, **kwargs)
+        async for key in self._iter_batched(keys):
+            yield key
+
+    async def _iter_batched(self, iterable):
+        iterator = iter(iterable)
+
+        while batch := await self._run(
+            tuple, itertools.islice(iterator, LIST_KEYS_BATCH_SIZE)
+        ):
+            for item in batch:
+                yield item
+
+    async def save_file(self, key, in_file, **kwargs):
+        return await self._run(self._annex.save_file, key, in_file, **kwargs)
+
+    async def stat(self, key):
+        return await self._run(self._annex.stat, key)
+
+    async def stat_many(self, keys):
+        return await self._run(self._annex.stat_many, keys)
+
+    async def send_file(self, key, **kwargs):
+        return await self._run(self._annex.send_file, key, **kwargs)
+
+    async def get_upload_info(self, key, **kwargs):
+        return await self._run(self._annex.get_upload_info, key, **kwargs)
+
+
+# -----------------------------------------------------------------------------
+
+
+class AsyncAnnex:
+    def __new__(
+        cls,
+        storage,
+        *args,
+        max_workers=utils.DEFAULT_MAX_CONCURRENCY,
+        **kwargs,
+    ):
+        annex = Annex(storage, *args, **kwargs)
+        return AsyncAnnexBase(annex, max_workers=max_workers)
+
+    @staticmethod
+    def from_env(namespace):
+        config = utils.get_config_from_env(namespace, {"max_workers": int})
+        max_workers = config.get("max_workers", utils.DEFAULT_MAX_CONCURRENCY)
+
+        annex = Annex.from_env(namespace)
+        return AsyncAnnexBase(annex, max_workers=max_workers)
@@ -1,12 +1,110 @@
-from . import utils
+import io
+import itertools
+import operator
+import tempfile
+from collections import namedtuple
+
+from . import signals, utils
+
+# -----------------------------------------------------------------------------
+
+KeyInfo = namedtuple(
+    "KeyInfo", ("key", "size", "last_modified", "etag", "content_type")
+)
+
+# Listings of KeyInfo merge on this, as the other fields can be None.
+get_entry_key = operator.attrgetter("key")
+
+# Buffered files spill from memory to disk past this size.
+SPOOL_MAX_SIZE = 1024**2
+
+# -----------------------------------------------------------------------------
+
+
+class AnnexWriter(io.RawIOBase):
+    # Subclasses implement write, _commit, and _abort. Closing the writer, or
+    # leaving its context normally, commits the file. Leaving its context on
+    # an exception, calling abort, or dropping it unclosed, discards it.
+
+    def writable(self):
+        return True
+
+    def close(self):
+        if self.closed:
+            return
+
+        try:
+            self._commit()
+        except BaseException:
+            self._abort()
+            raise
+        finally:
+            super().close()
+
+    def abort(self):
+        if self.closed:
+            return
+
+        try:
+            self._abort()
+        finally:
+            super().close()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def __del__(self):
+        self.abort()
+
+    def _commit(self):
+        raise NotImplementedError()
+
+    def _abort(self):
+        raise NotImplementedError()
+
+
+class SpooledWriter(AnnexWriter):
+    def __init__(self, annex, key, content_encoding=None):
+        self._annex = annex
+        self._key = key
+        self._content_encoding = content_encoding
+        self._spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+
+    def write(self, data):
+        return self._spool.write(data)
+
+    def _commit(self):
+        self._spool.seek(0)
+        self._annex.save_file(
+            self._key, self._spool, content_encoding=self._content_encoding
+        )
+        self._spool.close()
+
+    def _abort(self):
+        self._spool.close()
+
 
 # -----------------------------------------------------------------------------
 
 
 class AnnexBase:
+    # Parsers for constructor arguments that aren't strings, for from_env.
+    _config_types = {}
+
+    _max_concurrency = utils.DEFAULT_MAX_CONCURRENCY
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+
+        # Report every operation through the signals in signals.py.
+        signals.instrument_operations(cls)
+
     @classmethod
     def from_env(cls, namespace):
-        return cls(**utils.get_config_from_env(namespace))
+        return cls(**utils.get_config_from_env(namespace, cls._config_types))
 
     def delete(self, key):
         raise NotImplementedError()
@@ -14,17 +112,136 @@ class AnnexBase:
     def delete_many(self, keys):
         raise NotImplementedError()
 
+    def delete_prefix(self, prefix):
+        # Delete every key that list_keys lists for prefix. This fallback
+        # passes the listing to delete_many as is, so it holds no more keys
+        # in memory than delete_many does.
+        return self.delete_many(self.list_keys(prefix))
+
+    def exists(self, key):
+        try:
+            self.stat(key)
+        except FileNotFoundError:
+            return False
+
+        return True
+
     def get_file(self, key, out_file):
         raise NotImplementedError()
 
-    def list_keys(self, prefix):
+    def get_many(self, pairs):
+        return self._map_items(self.get_file, pairs)
+
+    def list_entries(
+        self, prefix, *, recursive=True, start_after=None, limit=None
+    ):
+        # Yield a KeyInfo for each key under prefix, in key order. Unless
+        # recursive, keys below the next "/" after prefix are instead listed
+        # once per directory, as a key ending in "/" with no other fields, like
+        # S3 common prefixes. This fallback stats each key, so backends whose
+        # listings already carry the metadata should override it.
+        return itertools.islice(
+            self._iter_entries(prefix, recursive, start_after), limit
+        )
+
+    def _iter_entries(self, prefix, recursive, start_after):
+        dir_key = None
+        for key in self.list_keys(prefix, start_after=start_after):
+            if not recursive:
+                separator_index = key.find("/", len(prefix))
+                if separator_index != -1:
+                    # Keys come in order, so each directory's keys are
+                    # consecutive.
+                    if key[: separator_index + 1] == dir_key:
+                        continue
+
+                    dir_key = key[: separator_index + 1]
+                    if start_after is None or dir_key > start_after:
+                        yield KeyInfo(dir_key, None, None, None, None)
+                    continue
+
+            try:
+                yield self.stat(key)
+            except FileNotFoundError:
+                # The key was deleted since it was listed.
+                continue
+
+    def list_keys(self, prefix, *, start_after=None, limit=None):
         raise NotImplementedError()
 
-    def save_file(self, key, in_file):
+    def open_mapped(self, key):
+        # Backends without local files have nothing to map, so this fallback
+        # reads the whole file into memory. It still returns a read-only
+        # buffer that works as a context manager, like a mapped file.
+        buffer = io.BytesIO()
+        self.get_file(key, buffer)
+        return buffer.getbuffer().toreadonly()
+
+    def open_read(self, key):
+        # This fallback downloads the whole file before returning it. Backends
+        # that can read ranges on demand should override this.
+        spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+        try:
+            self.get_file(key, spool)
+        except BaseException:
+            spool.close()
+            raise
+
+        spool.seek(0)
+        return spool
+
+    def open_write(self, key, *, content_encoding=None):
+        # This fallback buffers the whole file, then saves it on close.
+        # Backends that can upload incrementally should override this.
+        # content_encoding names an encoding, such as gzip, that the content
+        # is already in, for backends that can serve it back to clients.
+        return SpooledWriter(self, key, content_encoding)
+
+    def save_file(self, key, in_file, *, content_encoding=None):
         raise NotImplementedError()
 
+    def save_many(self, items):
+        return self._map_items(self.save_file, items)
+
+    def stat(self, key):
+        raise NotImplementedError()
+
+    def stat_many(self, keys):
+        def stat(key):
+            try:
+                return key, self.stat(key)
+            except FileNotFoundError:
+                return key, None
+
+        keys = tuple(keys)
+        key_infos = dict(
+            utils.map_concurrent(stat, keys, self._max_concurrency)
+        )
+
+        # Return the results in the order of the requested keys.
+        return {key: key_infos[key] for key in keys}
+
+    def _map_items(self, func, items):
+        # Run func over (key, file) pairs on a bounded pool, yielding
+        # (key, error) as each finishes. Like delete_many, this starts the
+        # work right away, so it all runs even if the caller never iterates
+        # the results.
+        def call(item):
+            key, file = item
+            try:
+                func(key, file)
+            except Exception as e:
+                return key, e
+
+            return key, None
+
+        return utils.start_concurrent(call, items, self._max_concurrency)
+
     def send_file(self, key):
         raise NotImplementedError()
 
     def get_upload_info(self, key):
         raise NotImplementedError()
+
+
+signals.instrument_operations(AnnexBase)
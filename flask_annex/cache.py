@@ -0,0 +1,265 @@
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from concurrent.futures import Future
+
+from .base import AnnexBase, SpooledWriter
+from .file import TEMP_PREFIX, FileAnnex
+
+# -----------------------------------------------------------------------------
+
+DEFAULT_REVALIDATE_AFTER = 60
+
+CacheInfo = namedtuple("CacheInfo", ("hits", "misses", "size", "max_size"))
+
+# -----------------------------------------------------------------------------
+
+
+class CacheEntry:
+    def __init__(self, size, etag):
+        self.size = size
+        self.etag = etag
+        self.validated_at = time.monotonic()
+
+
+# -----------------------------------------------------------------------------
+
+
+class CachedAnnex(AnnexBase):
+    # Processes can share cache_path, but each keeps its own accounting, and
+    # only counts files that other processes fetch after it starts once it
+    # fetches them itself. So disk use can reach max_size for each process.
+    # Give each process its own cache_path to keep it within max_size.
+
+    def __init__(
+        self,
+        annex,
+        cache_path,
+        *,
+        max_size,
+        revalidate_after=DEFAULT_REVALIDATE_AFTER,
+    ):
+        self._annex = annex
+        self._cache_path = cache_path
+        self._cache = FileAnnex(cache_path)
+        self._max_size = max_size
+        self._revalidate_after = revalidate_after
+
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._size = 0
+        self._fetches = {}
+        self._hits = 0
+        self._misses = 0
+
+        # Account for files already in the cache directory, from earlier runs
+        # or other processes, evicting the least recently written first. The
+        # index of cached files only lives in memory, so their ETags are
+        # unknown, and they are fetched again on their first read.
+        for key_info in sorted(
+            self._cache.list_entries(""),
+            key=lambda key_info: key_info.last_modified,
+        ):
+            self._entries[key_info.key] = CacheEntry(key_info.size, None)
+            self._size += key_info.size
+
+        self._delete_cached(self._evict())
+
+    def cache_info(self):
+        with self._lock:
+            return CacheInfo(
+                self._hits, self._misses, self._size, self._max_size
+            )
+
+    def delete(self, key):
+        self._annex.delete(key)
+        self._invalidate(key)
+
+    def delete_many(self, keys):
+        keys = tuple(keys)
+        errors = self._annex.delete_many(keys)
+
+        for key in keys:
+            self._invalidate(key)
+
+        return errors
+
+    def get_file(self, key, out_file):
+        return self._read_cached(key, self._cache.get_file, out_file)
+
+    def open_read(self, key):
+        # The open file and the mapping below stay valid even if the entry is
+        # evicted later.
+        return self._read_cached(key, self._cache.open_read)
+
+    def open_mapped(self, key):
+        return self._read_cached(key, self._cache.open_mapped)
+
+    def _read_cached(self, key, read, *args):
+        while True:
+            self._ensure_cached(key)
+            with self._lock:
+                entry = self._entries.get(key)
+
+            try:
+                return read(key, *args)
+            except FileNotFoundError:
+                # If the cached file is there, the error is about something
+                # else, like get_file's output path, so fetching again can't
+                # help.
+                if self._cache.exists(key):
+                    raise
+
+                # The entry was evicted or invalidated before we could read
+                # it, or another process sharing the cache removed its file,
+                # so fetch it again.
+                with self._lock:
+                    if entry is not None and self._entries.get(key) is entry:
+                        self._remove_entry(key)
+
+    def _ensure_cached(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                if not self._needs_revalidation(entry):
+                    self._hits += 1
+                    return
+
+        if entry is not None and self._annex.stat(key).etag == entry.etag:
+            with self._lock:
+                entry.validated_at = time.monotonic()
+                self._hits += 1
+            return
+
+        self._fetch(key)
+
+    def _needs_revalidation(self, entry):
+        if entry.etag is None:
+            return True
+
+        if self._revalidate_after is None:
+            return False
+
+        return time.monotonic() - entry.validated_at >= self._revalidate_after
+
+    def _fetch(self, key):
+        # Only one thread downloads a given key at a time. Other threads that
+        # miss on the same key wait for that download instead.
+        with self._lock:
+            self._misses += 1
+
+            future = self._fetches.get(key)
+            if future is not None:
+                owner = False
+            else:
+                owner = True
+                future = self._fetches[key] = Future()
+
+        if not owner:
+            return future.result()
+
+        try:
+            self._download(key, future)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(None)
+        finally:
+            with self._lock:
+                if self._fetches.get(key) is future:
+                    del self._fetches[key]
+
+    def _download(self, key, future):
+        # Get the ETag first, so if the file changes during the download, we
+        # at worst store a newer file than the ETag, which revalidation then
+        # replaces.
+        etag = self._annex.stat(key).etag
+
+        # Use the reserved prefix, so listings of the cache skip the file.
+        fd, temp_filename = tempfile.mkstemp(
+            dir=self._cache_path, prefix=TEMP_PREFIX
+        )
+        os.close(fd)
+
+        try:
+            self._annex.get_file(key, temp_filename)
+            size = os.path.getsize(temp_filename)
+
+            with self._lock:
+                # Don't store the file if the key was invalidated meanwhile.
+                if self._fetches.get(key) is not future:
+                    return
+
+                self._cache._ensure_key_dir(key)
+                os.replace(temp_filename, self._cache._get_filename(key))
+
+                self._remove_entry(key)
+                self._entries[key] = CacheEntry(size, etag)
+                self._size += size
+
+                evicted = self._evict()
+
+            self._delete_cached(evicted)
+        finally:
+            try:
+                os.unlink(temp_filename)
+            except FileNotFoundError:
+                pass
+
+    def _evict(self):
+        # Always keep the newest entry, even if it alone is over budget, so
+        # the caller that just fetched it can read it. This returns the
+        # evicted keys, for the caller to delete once it releases the lock.
+        evicted = []
+        while self._size > self._max_size and len(self._entries) > 1:
+            key, entry = self._entries.popitem(last=False)
+            self._size -= entry.size
+            evicted.append(key)
+
+        return evicted
+
+    def _delete_cached(self, keys):
+        # A fetch can store a key again before this deletes it. Reads then
+        # miss on its entry and fetch it again.
+        for key in keys:
+            self._cache.delete(key)
+
+    def _remove_entry(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._size -= entry.size
+
+    def _invalidate(self, key):
+        with self._lock:
+            self._fetches.pop(key, None)
+            self._remove_entry(key)
+
+        self._delete_cached((key,))
+
+    def list_entries(self, prefix, **kwargs):
+        return self._annex.list_entries(prefix, **kwargs)
+
+    def list_keys(self, prefix, **kwargs):
+        return self._annex.list_keys(prefix, **kwargs)
+
+    def save_file(self, key, in_file, *, content_encoding=None):
+        self._annex.save_file(key, in_file, content_encoding=content_encoding)
+        self._invalidate(key)
+
+    def open_write(self, key, *, content_encoding=None):
+        # Save through this annex when the file is committed, so the cached
+        # copy is invalidated.
+        return SpooledWriter(self, key, content_encoding)
+
+    def stat(self, key):
+        return self._annex.stat(key)
+
+    def send_file(self, key, **kwargs):
+        return self._annex.send_file(key, **kwargs)
+
+    def get_upload_info(self, key, **kwargs):
+        return self._annex.get_upload_info(key, **kwargs)
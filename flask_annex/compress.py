@@ -0,0 +1,234 @@
+import flask
+import gzip
+import mimetypes
+import os
+import tempfile
+
+from . import utils
+from .base import SPOOL_MAX_SIZE, AnnexBase
+
+# -----------------------------------------------------------------------------
+
+# Text formats that compress well. Formats that are already compressed, like
+# images and archives, gain nothing from another pass.
+DEFAULT_CONTENT_TYPES = frozenset(("application/json", "text/csv"))
+
+# This is the level most web servers use, which is much faster than the
+# maximum for little less compression.
+DEFAULT_COMPRESS_LEVEL = 6
+
+# Whether keys are stored compressed is remembered for this many keys, so
+# sending them doesn't need to read their content.
+DEFAULT_ENCODING_CACHE_SIZE = 1024
+
+CONTENT_ENCODING = "gzip"
+GZIP_MAGIC = b"\x1f\x8b"
+
+# -----------------------------------------------------------------------------
+
+
+class GzipReader(gzip.GzipFile):
+    # Unlike GzipFile, this owns the compressed file and closes it too.
+
+    def __init__(self, in_file):
+        super().__init__(fileobj=in_file, mode="rb")
+        self._in_file = in_file
+
+    def close(self):
+        try:
+            super().close()
+        finally:
+            self._in_file.close()
+
+
+# -----------------------------------------------------------------------------
+
+
+class CompressedAnnex(AnnexBase):
+    def __init__(
+        self,
+        annex,
+        *,
+        content_types=DEFAULT_CONTENT_TYPES,
+        compress_level=DEFAULT_COMPRESS_LEVEL,
+        encoding_cache_size=DEFAULT_ENCODING_CACHE_SIZE,
+    ):
+        self._annex = annex
+        self._content_types = frozenset(content_types)
+        self._compress_level = compress_level
+
+        # Map keys to their ETag and whether they're stored compressed. The
+        # ETag changes when the file does, including through direct uploads
+        # or other processes, so a stale entry is never used.
+        self._encodings = utils.LruCache(encoding_cache_size)
+
+    def _should_compress(self, key):
+        # Keys like foo.csv.gz already have an encoding, so don't compress
+        # them again.
+        content_type, encoding = mimetypes.guess_type(key)
+        return content_type in self._content_types and encoding is None
+
+    def delete(self, key):
+        self._annex.delete(key)
+        self._encodings.pop(key)
+
+    def delete_many(self, keys):
+        keys = tuple(keys)
+        errors = self._annex.delete_many(keys)
+        for key in keys:
+            self._encodings.pop(key)
+
+        return errors
+
+    def get_file(self, key, out_file):
+        if not self._should_compress(key):
+            self._annex.get_file(key, out_file)
+            return
+
+        # Download through the wrapped annex, which can transfer large files
+        # in parallel, rather than reading them a block at a time. This also
+        # leaves the output file alone for a missing key.
+        with tempfile.SpooledTemporaryFile(SPOOL_MAX_SIZE) as spool:
+            self._annex.get_file(key, spool)
+            spool.seek(0)
+
+            if self._is_compressed(spool):
+                in_file = gzip.GzipFile(fileobj=spool, mode="rb")
+            else:
+                in_file = spool
+
+            if isinstance(out_file, str):
+                with open(out_file, "wb") as out_fp:
+                    utils.copy_fileobj(in_file, out_fp)
+            else:
+                utils.copy_fileobj(in_file, out_file)
+
+    def list_entries(self, prefix, **kwargs):
+        return self._annex.list_entries(prefix, **kwargs)
+
+    def list_keys(self, prefix, **kwargs):
+        return self._annex.list_keys(prefix, **kwargs)
+
+    def open_read(self, key):
+        in_file = self._annex.open_read(key)
+        if not self._should_compress(key):
+            return in_file
+
+        try:
+            compressed = self._is_compressed(in_file)
+        except BaseException:
+            in_file.close()
+            raise
+
+        if not compressed:
+            return in_file
+
+        return GzipReader(in_file)
+
+    def _is_compressed(self, in_file):
+        # Check the content rather than trusting the key, as files saved
+        # before compression was enabled, or uploaded directly, are stored as
+        # is.
+        compressed = in_file.read(len(GZIP_MAGIC)) == GZIP_MAGIC
+        in_file.seek(0)
+        return compressed
+
+    def save_file(self, key, in_file, *, content_encoding=None):
+        # Content that's already encoded is stored as is.
+        if content_encoding or not self._should_compress(key):
+            self._annex.save_file(
+                key, in_file, content_encoding=content_encoding
+            )
+            self._record_encoding(key, content_encoding == CONTENT_ENCODING)
+            return
+
+        if isinstance(in_file, str):
+            with open(in_file, "rb") as in_fp:
+                self.save_file(key, in_fp)
+            return
+
+        # Compress into the wrapped annex's writer as the file is read, so
+        # neither the original nor the compressed file is held in full. A zero
+        # mtime keeps the output the same for the same content.
+        with self._annex.open_write(
+            key, content_encoding=CONTENT_ENCODING
+        ) as out_file:
+            with gzip.GzipFile(
+                fileobj=out_file,
+                mode="wb",
+                compresslevel=self._compress_level,
+                mtime=0,
+            ) as gzip_file:
+                utils.copy_fileobj(in_file, gzip_file)
+
+        self._record_encoding(key, True)
+
+    def _record_encoding(self, key, compressed):
+        if not self._should_compress(key):
+            return
+
+        etag = self._annex.stat(key).etag
+        if etag is None:
+            self._encodings.pop(key)
+            return
+
+        self._encodings.set(key, (etag, compressed))
+
+    def _is_stored_compressed(self, key):
+        etag = self._annex.stat(key).etag
+        cached = self._encodings.get(key)
+        if etag is not None and cached is not None and cached[0] == etag:
+            return cached[1]
+
+        # The key was written elsewhere, or has been evicted, so check the
+        # content once.
+        with self._annex.open_read(key) as in_file:
+            compressed = self._is_compressed(in_file)
+
+        if etag is not None:
+            self._encodings.set(key, (etag, compressed))
+
+        return compressed
+
+    def stat(self, key):
+        # This is the stored size, which is the compressed size for
+        # compressed files.
+        return self._annex.stat(key)
+
+    def send_file(self, key, **kwargs):
+        response = self._annex.send_file(key, **kwargs)
+
+        # Redirects go to a backend that serves the content encoding stored
+        # with the file.
+        if "Location" in response.headers or not self._should_compress(key):
+            return response
+
+        if not self._is_stored_compressed(key):
+            return response
+
+        # Otherwise the response has the compressed file as is, so declare the
+        # encoding for clients that accept it, and decompress it for the rest.
+        # No Accept-Encoding header means any encoding is fine.
+        response.vary.add("Accept-Encoding")
+        request = flask.request
+        if (
+            "Accept-Encoding" not in request.headers
+            or request.accept_encodings[CONTENT_ENCODING]
+        ):
+            response.headers["Content-Encoding"] = CONTENT_ENCODING
+            return response
+
+        response.close()
+        download_name = kwargs.get("download_name") or os.path.basename(key)
+        response = flask.send_file(
+            GzipReader(self._annex.open_read(key)),
+            mimetype=response.mimetype,
+            as_attachment=True,
+            **{utils.get_download_name_arg(): download_name},
+        )
+        response.vary.add("Accept-Encoding")
+        return response
+
+    def get_upload_info(self, key, **kwargs):
+        # Direct uploads are stored uncompressed, which reads still handle.
+        return self._annex.get_upload_info(key, **kwargs)
@@ -0,0 +1,223 @@
+import hashlib
+import io
+import mimetypes
+import os
+import tempfile
+
+from . import utils
+from .base import SPOOL_MAX_SIZE, AnnexBase
+
+# -----------------------------------------------------------------------------
+
+HASH_CHUNK_SIZE = 1024**2
+
+# Keys in the wrapped annex for each kind of record. Pointers map keys to
+# blobs, and each reference to a blob has an empty marker under its refs
+# prefix, so a blob is unused when it has no markers left.
+POINTERS_PREFIX = "keys/"
+BLOBS_PREFIX = "blobs/"
+REFS_PREFIX = "refs/"
+
+# -----------------------------------------------------------------------------
+
+
+def hash_file(in_file, out_file=None):
+    digest = hashlib.sha256()
+
+    while chunk := in_file.read(HASH_CHUNK_SIZE):
+        digest.update(chunk)
+        if out_file is not None:
+            out_file.write(chunk)
+
+    return digest.hexdigest()
+
+
+# -----------------------------------------------------------------------------
+
+
+class DedupAnnex(AnnexBase):
+    def __init__(self, annex):
+        self._annex = annex
+
+    def _get_blob_name(self, digest, content_encoding):
+        # Name blobs by their content, so keys with the same content share a
+        # blob whatever their extensions. Content types come from the keys
+        # instead. The content encoding is stored with the blob, so the same
+        # bytes with a different encoding need their own blob.
+        if not content_encoding:
+            return digest
+
+        return f"{digest}.{content_encoding}"
+
+    def _get_pointer_key(self, key):
+        return f"{POINTERS_PREFIX}{key}"
+
+    def _get_blob_key(self, blob_name):
+        # Fan out blobs so no single directory holds all of them.
+        return f"{BLOBS_PREFIX}{blob_name[:2]}/{blob_name}"
+
+    def _get_refs_prefix(self, blob_name):
+        return f"{REFS_PREFIX}{blob_name}/"
+
+    def _read_blob_name(self, key):
+        pointer = io.BytesIO()
+        try:
+            self._annex.get_file(self._get_pointer_key(key), pointer)
+        except FileNotFoundError as e:
+            raise FileNotFoundError(f"key {key} does not exist") from e
+
+        return pointer.getvalue().decode()
+
+    def _get_blob_key_for(self, key):
+        return self._get_blob_key(self._read_blob_name(key))
+
+    def delete(self, key):
+        try:
+            blob_name = self._read_blob_name(key)
+        except FileNotFoundError:
+            return
+
+        self._annex.delete(self._get_pointer_key(key))
+        self._release_blob(blob_name, key)
+
+    def _release_blob(self, blob_name, key):
+        refs_prefix = self._get_refs_prefix(blob_name)
+        self._annex.delete(f"{refs_prefix}{key}")
+
+        # This is best effort. A concurrent save of the same content between
+        # the check and the delete can still lose the blob.
+        if not any(self._annex.list_keys(refs_prefix, limit=1)):
+            self._annex.delete(self._get_blob_key(blob_name))
+
+    def delete_many(self, keys):
+        # Delete the pointers and references for all keys in one call to the
+        # wrapped annex, then the blobs left unused in another.
+        blob_names = self._read_blob_names(keys)
+
+        record_keys = []
+        for key, blob_name in blob_names.items():
+            record_keys.append(self._get_pointer_key(key))
+            record_keys.append(f"{self._get_refs_prefix(blob_name)}{key}")
+
+        if not record_keys:
+            return []
+
+        errors = list(self._annex.delete_many(record_keys) or ())
+
+        # As in _release_blob, this is best effort, and references that
+        # failed to delete keep their blobs.
+        def is_unused(blob_name):
+            refs_prefix = self._get_refs_prefix(blob_name)
+            return blob_name, not any(
+                self._annex.list_keys(refs_prefix, limit=1)
+            )
+
+        unused_blob_keys = [
+            self._get_blob_key(blob_name)
+            for blob_name, unused in utils.map_concurrent(
+                is_unused, set(blob_names.values()), self._max_concurrency
+            )
+            if unused
+        ]
+        if unused_blob_keys:
+            errors.extend(self._annex.delete_many(unused_blob_keys) or ())
+
+        return errors
+
+    def _read_blob_names(self, keys):
+        # Read the pointers concurrently, skipping keys that don't exist.
+        pointers = {key: io.BytesIO() for key in keys}
+        results = self._annex.get_many(
+            (self._get_pointer_key(key), pointer)
+            for key, pointer in pointers.items()
+        )
+
+        blob_names = {}
+        for pointer_key, error in results:
+            if isinstance(error, FileNotFoundError):
+                continue
+            if error is not None:
+                raise error
+
+            key = pointer_key[len(POINTERS_PREFIX) :]
+            blob_names[key] = pointers[key].getvalue().decode()
+
+        return blob_names
+
+    def get_file(self, key, out_file):
+        self._annex.get_file(self._get_blob_key_for(key), out_file)
+
+    def list_keys(self, prefix, *, start_after=None, limit=None):
+        if start_after is not None:
+            start_after = self._get_pointer_key(start_after)
+
+        pointer_keys = self._annex.list_keys(
+            self._get_pointer_key(prefix), start_after=start_after, limit=limit
+        )
+        return (
+            pointer_key[len(POINTERS_PREFIX) :] for pointer_key in pointer_keys
+        )
+
+    def open_mapped(self, key):
+        return self._annex.open_mapped(self._get_blob_key_for(key))
+
+    def open_read(self, key):
+        return self._annex.open_read(self._get_blob_key_for(key))
+
+    def save_file(self, key, in_file, *, content_encoding=None):
+        # Hash the content first, to know whether we need to upload it at all.
+        # File objects can only be read once, so spool them while hashing.
+        if isinstance(in_file, str):
+            with open(in_file, "rb") as in_fp:
+                digest = hash_file(in_fp)
+            self._save_blob(key, digest, in_file, content_encoding)
+        else:
+            with tempfile.SpooledTemporaryFile(SPOOL_MAX_SIZE) as spool:
+                digest = hash_file(in_file, spool)
+                spool.seek(0)
+                self._save_blob(key, digest, spool, content_encoding)
+
+    def _save_blob(self, key, digest, in_file, content_encoding):
+        blob_name = self._get_blob_name(digest, content_encoding)
+
+        try:
+            old_blob_name = self._read_blob_name(key)
+        except FileNotFoundError:
+            old_blob_name = None
+
+        if old_blob_name == blob_name:
+            return
+
+        # Write the blob, then the reference, then the pointer, so a failure
+        # part way through never leaves a pointer to a missing blob.
+        blob_key = self._get_blob_key(blob_name)
+        if not self._annex.exists(blob_key):
+            self._annex.save_file(
+                blob_key, in_file, content_encoding=content_encoding
+            )
+
+        self._annex.save_file(
+            f"{self._get_refs_prefix(blob_name)}{key}", io.BytesIO()
+        )
+        self._annex.save_file(
+            self._get_pointer_key(key), io.BytesIO(blob_name.encode())
+        )
+
+        if old_blob_name is not None:
+            self._release_blob(old_blob_name, key)
+
+    def stat(self, key):
+        key_info = self._annex.stat(self._get_blob_key_for(key))
+        return key_info._replace(
+            key=key, content_type=mimetypes.guess_type(key)[0]
+        )
+
+    def send_file(self, key, **kwargs):
+        kwargs.setdefault("download_name", os.path.basename(key))
+        return self._annex.send_file(self._get_blob_key_for(key), **kwargs)
+
+    def get_upload_info(self, key):
+        raise NotImplementedError(
+            "dedup annex does not support upload info, as direct uploads "
+            "would bypass deduplication"
+        )
@@ -1,23 +1,179 @@
+import contextlib
 import errno
 import flask
+import hashlib
+import heapq
+import itertools
+import mimetypes
+import mmap
 import os
 import shutil
+import stat
+import threading
+import uuid
 import werkzeug
-from packaging.version import Version
+from datetime import datetime, timezone
+from urllib.parse import quote as url_quote
+
+from . import utils
+from .base import AnnexBase, AnnexWriter, KeyInfo, get_entry_key
+
+# -----------------------------------------------------------------------------
+
+# Local file copies are mostly bound by the disk and release the GIL, so size
+# the pool like ThreadPoolExecutor does by default.
+DEFAULT_MAX_CONCURRENCY = min(32, (os.cpu_count() or 1) + 4)
+
+# Files with this prefix are the annex's own, like partially written files, and
+# don't correspond to keys.
+RESERVED_PREFIX = ".annex-"
+TEMP_PREFIX = f"{RESERVED_PREFIX}tmp-"
+MIGRATE_DIR_NAME = f"{RESERVED_PREFIX}migrate"
+MIGRATE_STAGED_FILENAME = f"{RESERVED_PREFIX}staged"
+INDEX_FILENAME = f"{RESERVED_PREFIX}index.sqlite3"
+
+OFFLOAD_X_SENDFILE = "x-sendfile"
+OFFLOAD_X_ACCEL_REDIRECT = "x-accel-redirect"
+
+# -----------------------------------------------------------------------------
+
+
+@contextlib.contextmanager
+def _raise_not_found(key):
+    # Directories and paths through files aren't keys either, so raise what
+    # any other missing key raises.
+    try:
+        yield
+    except (IsADirectoryError, NotADirectoryError) as e:
+        raise FileNotFoundError(f"key {key} does not exist") from e
+
+
+def _unlink_missing_ok(filename):
+    try:
+        os.unlink(filename)
+    except FileNotFoundError:
+        pass
+
+
+# -----------------------------------------------------------------------------
+
+
+class AtomicFileWriter(AnnexWriter):
+    def __init__(self, temp_file, filename, on_commit=None):
+        self._file = temp_file
+        self._temp_filename = temp_file.name
+        self._filename = filename
+        self._on_commit = on_commit
+
+    def write(self, data):
+        return self._file.write(data)
+
+    def _commit(self):
+        self._file.close()
+        os.replace(self._temp_filename, self._filename)
+
+        if self._on_commit is not None:
+            self._on_commit()
+
+    def _abort(self):
+        self._file.close()
+        _unlink_missing_ok(self._temp_filename)
 
-from .base import AnnexBase
 
 # -----------------------------------------------------------------------------
 
 
 class FileAnnex(AnnexBase):
-    def __init__(self, root_path):
+    _config_types = {
+        "max_concurrency": int,
+        "shard_width": int,
+        "index": utils.parse_bool,
+    }
+
+    def __init__(
+        self,
+        root_path,
+        *,
+        max_concurrency=DEFAULT_MAX_CONCURRENCY,
+        offload=None,
+        offload_prefix="/",
+        shard_width=0,
+        index=False,
+    ):
+        if offload not in (None, OFFLOAD_X_SENDFILE, OFFLOAD_X_ACCEL_REDIRECT):
+            raise ValueError(f"unsupported offload {offload}")
+
         self._root_path = root_path
+        self._max_concurrency = max_concurrency
+        self._offload = offload
+        self._offload_prefix = offload_prefix
+        self._shard_width = shard_width
+
+        self._index_filename = os.path.join(root_path, INDEX_FILENAME)
+        if index:
+            # Only load SQLite for annexes that use the index.
+            from .index import KeyIndex
+
+            self._index = KeyIndex(self._index_filename)
+        else:
+            self._index = None
+        self._index_ready = False
+        self._index_lock = threading.Lock()
+
+    def _get_shard(self, key):
+        # With sharding, each key is stored under a directory named for the
+        # leading hex digits of its hash, so keys under the same prefix spread
+        # across many smaller directories.
+        digest = hashlib.md5(key.encode(), usedforsecurity=False).hexdigest()
+        return digest[: self._shard_width]
+
+    def _get_key_root(self, key):
+        if not self._shard_width:
+            return self._root_path
+
+        return os.path.join(self._root_path, self._get_shard(key))
+
+    def _get_relative_filename(self, key):
+        if not self._shard_width:
+            return key
+
+        return f"{self._get_shard(key)}/{key}"
 
     def _get_filename(self, key):
-        return werkzeug.utils.safe_join(self._root_path, key)
+        return werkzeug.utils.safe_join(
+            self._root_path, self._get_relative_filename(key)
+        )
+
+    def _get_index(self):
+        if self._index is None or self._index_ready:
+            return self._index
+
+        with self._index_lock:
+            if not self._index_ready:
+                # A new index starts out empty, so fill it from the files.
+                if not os.path.exists(self._index_filename):
+                    self.rebuild_index()
+
+                self._index_ready = True
+
+        return self._index
+
+    def _update_index(self, key):
+        index = self._get_index()
+        if index is None:
+            return
+
+        stat_result = os.stat(self._get_filename(key))
+        index.put(key, stat_result.st_size, stat_result.st_mtime_ns)
 
     def delete(self, key):
+        self._delete_file(key)
+
+        index = self._get_index()
+        if index is not None:
+            index.delete_many((key,))
+
+    def _delete_file(self, key):
         try:
             os.unlink(self._get_filename(key))
         except FileNotFoundError:
@@ -26,10 +182,11 @@ class FileAnnex(AnnexBase):
         self._clean_empty_dirs(key)
 
     def _clean_empty_dirs(self, key):
-        key_dir_name = os.path.dirname(key)
+        self._remove_empty_dirs(self._get_key_root(key), os.path.dirname(key))
 
+    def _remove_empty_dirs(self, key_root, key_dir_name):
         while key_dir_name:
-            dir_name = self._get_filename(key_dir_name)
+            dir_name = werkzeug.utils.safe_join(key_root, key_dir_name)
             try:
                 os.rmdir(dir_name)
             except FileNotFoundError:
@@ -43,47 +200,329 @@ class FileAnnex(AnnexBase):
             key_dir_name = os.path.dirname(key_dir_name)
 
     def delete_many(self, keys):
+        keys = tuple(keys)
         for key in keys:
-            self.delete(key)
+            self._delete_file(key)
+
+        # Update the index for all keys in one transaction.
+        index = self._get_index()
+        if index is not None:
+            index.delete_many(keys)
+
+    def delete_prefix(self, prefix):
+        # Remove whole directories at once, rather than listing and deleting
+        # each key. Like list_keys, the prefix is a path, and can be a key.
+        key_prefix = self._get_key_prefix(prefix)
+
+        if key_prefix and os.path.isfile(self._get_filename(key_prefix)):
+            self._delete_file(key_prefix)
+
+        # With sharding, the directory can be in every shard.
+        if not self._shard_width:
+            key_roots = (self._root_path,)
+        else:
+            key_roots = self._get_shard_roots()
+
+        for key_root in key_roots:
+            self._remove_key_dir(key_root, key_prefix)
+
+        index = self._get_index()
+        if index is not None:
+            index.delete_prefix(key_prefix)
+
+    def _remove_key_dir(self, key_root, key_prefix):
+        if key_prefix:
+            dir_name = werkzeug.utils.safe_join(key_root, key_prefix)
+
+            # Like listing, leave symlinked directories alone.
+            if not os.path.isdir(dir_name) or os.path.islink(dir_name):
+                return
+
+            shutil.rmtree(dir_name)
+            self._remove_empty_dirs(key_root, os.path.dirname(key_prefix))
+            return
+
+        # Keep the annex's own files at the root, like the index.
+        with os.scandir(key_root) as dir_entries:
+            for entry in dir_entries:
+                if entry.name.startswith(RESERVED_PREFIX):
+                    continue
+
+                if not entry.is_dir():
+                    os.unlink(entry.path)
+                elif not entry.is_symlink():
+                    shutil.rmtree(entry.path)
 
     def get_file(self, key, out_file):
         in_filename = self._get_filename(key)
 
         if isinstance(out_file, str):
-            shutil.copyfile(in_filename, out_file)
+            with _raise_not_found(key):
+                shutil.copyfile(in_filename, out_file)
+        else:
+            with self._open_file(key) as in_fp:
+                utils.copy_fileobj(in_fp, out_file)
+
+    def list_keys(self, prefix, *, start_after=None, limit=None):
+        index = self._get_index()
+        if index is None:
+            keys = self._iter_keys(prefix, start_after)
+        else:
+            keys = (
+                key
+                for key, _, _ in index.iter_rows(
+                    self._get_key_prefix(prefix), start_after=start_after
+                )
+            )
+
+        return itertools.islice(keys, limit)
+
+    def list_entries(
+        self, prefix, *, recursive=True, start_after=None, limit=None
+    ):
+        if recursive:
+            # The index, or the stat calls made while walking the files, have
+            # everything a KeyInfo needs.
+            index = self._get_index()
+            if index is None:
+                rows = self._iter_file_rows(prefix, start_after)
+            else:
+                rows = index.iter_rows(
+                    self._get_key_prefix(prefix), start_after=start_after
+                )
+
+            entries = itertools.starmap(self._get_key_info, rows)
+        elif not self._shard_width:
+            entries = self._iter_dir_entries(
+                self._root_path, prefix, start_after
+            )
+        else:
+            # The same directory can be in several shards, so merge their
+            # listings, and only list each directory once.
+            entries = (
+                next(group)
+                for _, group in itertools.groupby(
+                    heapq.merge(
+                        *(
+                            self._iter_dir_entries(
+                                shard_root, prefix, start_after
+                            )
+                            for shard_root in self._get_shard_roots()
+                        ),
+                        key=get_entry_key,
+                    ),
+                    key=get_entry_key,
+                )
+            )
+
+        return itertools.islice(entries, limit)
+
+    def _iter_dir_entries(self, key_root, prefix, start_after):
+        root = werkzeug.utils.safe_join(key_root, prefix)
+        root_key = os.path.relpath(root, key_root)
+
+        if root_key == os.curdir:
+            dir_entries = self._scandir_sorted(root)
+            key_prefix = ""
+        elif prefix.endswith("/"):
+            dir_entries = self._scandir_sorted(root)
+            key_prefix = f"{root_key}/"
         else:
-            with open(in_filename, "rb") as in_fp:
-                shutil.copyfileobj(in_fp, out_file)
-
-    def list_keys(self, prefix):
-        root = self._get_filename(prefix)
-        filenames = (
-            (root,)
-            if os.path.isfile(root)
-            else tuple(
-                os.path.join(root, filename)
-                for root, _dirnames, filenames in os.walk(root)
-                for filename in filenames
+            # Without a trailing "/", list the key or directory itself, like
+            # S3 does for a prefix up to the delimiter.
+            dir_entries = (
+                (name, entry)
+                for name, entry in self._scandir_sorted(os.path.dirname(root))
+                if entry.name == os.path.basename(root)
+            )
+            key_prefix = root_key[: -len(os.path.basename(root))]
+
+        for name, entry in dir_entries:
+            if name.startswith(RESERVED_PREFIX):
+                continue
+
+            key = f"{key_prefix}{name}"
+            if start_after is not None and key <= start_after:
+                continue
+
+            if name.endswith("/"):
+                if not entry.is_symlink():
+                    yield KeyInfo(key, None, None, None, None)
+                continue
+
+            try:
+                stat_result = entry.stat()
+            except FileNotFoundError:
+                continue
+
+            yield self._get_key_info(
+                key, stat_result.st_size, stat_result.st_mtime_ns
+            )
+
+    def _get_key_prefix(self, prefix):
+        # Normalize the prefix the same way as listing the files does.
+        key_prefix = os.path.relpath(
+            werkzeug.utils.safe_join(self._root_path, prefix), self._root_path
+        )
+        return "" if key_prefix == os.curdir else key_prefix
+
+    def _iter_keys(self, prefix, start_after):
+        if not self._shard_width:
+            return self._iter_shard_keys(self._root_path, prefix, start_after)
+
+        # Each shard lists its keys in order, and every key is in exactly one
+        # shard, so merging the shards' listings gives all keys in order.
+        return heapq.merge(
+            *(
+                self._iter_shard_keys(shard_root, prefix, start_after)
+                for shard_root in self._get_shard_roots()
             )
         )
 
-        return tuple(
-            os.path.relpath(filename, self._root_path)
-            for filename in filenames
+    def _get_shard_roots(self):
+        try:
+            with os.scandir(self._root_path) as dir_entries:
+                return [
+                    entry.path
+                    for entry in dir_entries
+                    if not entry.name.startswith(RESERVED_PREFIX)
+                    and entry.is_dir(follow_symlinks=False)
+                ]
+        except FileNotFoundError:
+            return []
+
+    def _iter_shard_keys(self, key_root, prefix, start_after):
+        root = werkzeug.utils.safe_join(key_root, prefix)
+        root_key = os.path.relpath(root, key_root)
+
+        if os.path.isfile(root):
+            if start_after is None or root_key > start_after:
+                yield root_key
+            return
+
+        key_prefix = "" if root_key == os.curdir else f"{root_key}/"
+        yield from self._walk_keys(root, key_prefix, start_after)
+
+    def _scandir_sorted(self, dir_name):
+        try:
+            with os.scandir(dir_name) as dir_entries:
+                # Sort directories as if their names had the trailing "/",
+                # so keys come out in the same order S3 lists them.
+                return sorted(
+                    (
+                        f"{entry.name}/" if entry.is_dir() else entry.name,
+                        entry,
+                    )
+                    for entry in dir_entries
+                )
+        except (FileNotFoundError, NotADirectoryError):
+            return []
+
+    def _walk_keys(self, dir_name, key_prefix, start_after):
+        for name, entry in self._scandir_sorted(dir_name):
+            if name.startswith(RESERVED_PREFIX):
+                continue
+
+            key = f"{key_prefix}{name}"
+
+            if not name.endswith("/"):
+                if start_after is None or key > start_after:
+                    yield key
+                continue
+
+            # Like os.walk, don't descend into symlinked directories.
+            if entry.is_symlink():
+                continue
+
+            # Skip subtrees whose keys all sort before start_after.
+            if (
+                start_after is not None
+                and key < start_after
+                and not start_after.startswith(key)
+            ):
+                continue
+
+            yield from self._walk_keys(entry.path, key, start_after)
+
+    def open_read(self, key):
+        return self._open_file(key)
+
+    def _open_file(self, key):
+        with _raise_not_found(key):
+            return open(self._get_filename(key), "rb")
+
+    def open_write(self, key, *, content_encoding=None):
+        # There is nowhere to store the content encoding with a local file, so
+        # it's accepted for compatibility with other backends, and readers
+        # need to detect it from the content instead.
+        self._ensure_key_dir(key)
+
+        filename = self._get_filename(key)
+        temp_file = open(self._get_temp_filename(filename), "xb")
+        return AtomicFileWriter(
+            temp_file, filename, lambda: self._update_index(key)
         )
 
-    def save_file(self, key, in_file):
-        out_filename = self._get_filename(key)
+    def open_mapped(self, key):
+        with self._open_file(key) as in_fp:
+            try:
+                return mmap.mmap(in_fp.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                # Empty files can't be mapped.
+                if os.fstat(in_fp.fileno()).st_size:
+                    raise  # pragma: no cover
+
+                return memoryview(b"")
+
+    def save_file(self, key, in_file, *, content_encoding=None):
+        # As with open_write, the content encoding isn't stored.
         self._ensure_key_dir(key)
+        self._write_file(key, in_file)
 
-        if isinstance(in_file, str):
-            shutil.copyfile(in_file, out_filename)
-        else:
-            with open(out_filename, "wb") as out_fp:
-                shutil.copyfileobj(in_file, out_fp)
+    def save_many(self, items):
+        # Keys in a batch tend to share directories, so only check each
+        # directory once rather than once per key.
+        ensured_dir_names = set()
+
+        def save_file(key, in_file):
+            dir_name = os.path.dirname(self._get_filename(key))
+            if dir_name not in ensured_dir_names:
+                self._ensure_key_dir(key)
+                ensured_dir_names.add(dir_name)
+
+            self._write_file(key, in_file)
+
+        return self._map_items(save_file, items)
+
+    def _write_file(self, key, in_file):
+        # Write to a temporary file and move it into place, so readers never
+        # see a partially written file.
+        out_filename = self._get_filename(key)
+        temp_filename = self._get_temp_filename(out_filename)
+
+        try:
+            if isinstance(in_file, str):
+                shutil.copyfile(in_file, temp_filename)
+            else:
+                with open(temp_filename, "xb") as out_fp:
+                    utils.copy_fileobj(in_file, out_fp)
+
+            os.replace(temp_filename, out_filename)
+        except BaseException:
+            _unlink_missing_ok(temp_filename)
+            raise
+
+        self._update_index(key)
+
+    def _get_temp_filename(self, filename):
+        # The temporary file needs to be in the same directory for the rename
+        # to be atomic.
+        return os.path.join(
+            os.path.dirname(filename), f"{TEMP_PREFIX}{uuid.uuid4().hex}"
+        )
 
     def _ensure_key_dir(self, key):
-        dir_name = self._get_filename(os.path.dirname(key))
+        dir_name = os.path.dirname(self._get_filename(key))
         if os.path.exists(dir_name):
             return
 
@@ -95,14 +534,165 @@ class FileAnnex(AnnexBase):
 
         os.makedirs(dir_name, exist_ok=True)
 
-    def send_file(self, key):
-        if Version(flask.__version__) >= Version("2.2.0"):
-            download_name = {"download_name": os.path.basename(key)}
-        else:
-            download_name = {"attachment_filename": os.path.basename(key)}
+    def stat(self, key):
+        with _raise_not_found(key):
+            stat_result = os.stat(self._get_filename(key))
+        if not stat.S_ISREG(stat_result.st_mode):
+            raise FileNotFoundError(f"key {key} does not exist")
+
+        return self._get_key_info(
+            key, stat_result.st_size, stat_result.st_mtime_ns
+        )
+
+    def _get_key_info(self, key, size, mtime_ns):
+        return KeyInfo(
+            key,
+            size,
+            datetime.fromtimestamp(mtime_ns / 1e9, timezone.utc),
+            # This is the same ETag format as nginx uses for static files.
+            f'"{mtime_ns:x}-{size:x}"',
+            mimetypes.guess_type(key)[0],
+        )
+
+    def _check_index(self):
+        if self._index is None:
+            raise ValueError("annex has no index; create it with index=True")
+
+    def rebuild_index(self):
+        # Replace the index with the keys of the files, returning the number
+        # of keys. Files saved or deleted while this runs may be missed.
+        self._check_index()
+
+        rows = list(self._iter_file_rows())
+        self._index.replace_all(rows)
+        return len(rows)
+
+    def verify_index(self):
+        # Return the keys for which the index doesn't match the files, sorted.
+        # Both listings are in key order, so walk them side by side.
+        self._check_index()
+
+        file_rows = self._iter_file_rows()
+        index_rows = self._index.iter_rows("")
+
+        out_of_sync_keys = []
+
+        file_row = next(file_rows, None)
+        index_row = next(index_rows, None)
+        while file_row is not None or index_row is not None:
+            if index_row is None or (
+                file_row is not None and file_row[0] < index_row[0]
+            ):
+                out_of_sync_keys.append(file_row[0])
+                file_row = next(file_rows, None)
+            elif file_row is None or index_row[0] < file_row[0]:
+                out_of_sync_keys.append(index_row[0])
+                index_row = next(index_rows, None)
+            else:
+                if tuple(file_row) != tuple(index_row):
+                    out_of_sync_keys.append(file_row[0])
+
+                file_row = next(file_rows, None)
+                index_row = next(index_rows, None)
+
+        return out_of_sync_keys
+
+    def _iter_file_rows(self, prefix="", start_after=None):
+        for key in self._iter_keys(prefix, start_after):
+            try:
+                stat_result = os.stat(self._get_filename(key))
+            except FileNotFoundError:
+                continue
+
+            yield key, stat_result.st_size, stat_result.st_mtime_ns
+
+    def migrate(self, *, from_shard_width):
+        # Move files stored with another shard width into this annex's layout,
+        # returning the number of keys moved. This isn't safe to run while
+        # anything else uses the root path.
+        staging_path = os.path.join(self._root_path, MIGRATE_DIR_NAME)
+
+        staged_marker_path = os.path.join(
+            staging_path, MIGRATE_STAGED_FILENAME
+        )
+
+        # First move everything into a staging directory, so files already in
+        # the new layout are never mistaken for ones in the old layout. Until
+        # the marker exists, everything left at the root is still in the old
+        # layout, so an interrupted migration finishes staging before moving
+        # files back out. After that, the root only has files in the new
+        # layout, so resume from the staging directory alone.
+        if not os.path.exists(staged_marker_path):
+            with os.scandir(self._root_path) as dir_entries:
+                entries = [
+                    entry
+                    for entry in dir_entries
+                    if not entry.name.startswith(RESERVED_PREFIX)
+                ]
+
+            os.makedirs(staging_path, exist_ok=True)
+            for entry in entries:
+                os.rename(entry.path, os.path.join(staging_path, entry.name))
+
+            with open(staged_marker_path, "wb"):
+                pass
+
+        staging_annex = FileAnnex(staging_path, shard_width=from_shard_width)
+
+        num_keys = 0
+        for key in staging_annex.list_keys(""):
+            # This creates the new directories and removes the old ones as
+            # they empty.
+            os.renames(
+                staging_annex._get_filename(key), self._get_filename(key)
+            )
+            num_keys += 1
+
+        # Anything left is leftover temporary files and empty directories.
+        shutil.rmtree(staging_path, ignore_errors=True)
+        return num_keys
+
+    def send_file(self, key, *, download_name=None):
+        download_name = download_name or os.path.basename(key)
+
+        # Serve the file by its path relative to the root, which includes the
+        # shard directory if there is one.
+        filename = self._get_relative_filename(key)
+
+        if self._offload:
+            return self._send_file_offloaded(filename, download_name)
+
         return flask.send_from_directory(
-            self._root_path, key, as_attachment=True, **download_name
+            self._root_path,
+            filename,
+            as_attachment=True,
+            **{utils.get_download_name_arg(): download_name},
         )
 
+    def _send_file_offloaded(self, filename, download_name):
+        app = flask.current_app
+
+        # Build the same response as flask.send_from_directory, including
+        # resolving the root path relative to the app, but with an empty body
+        # and an X-Sendfile header for the front proxy to serve.
+        response = werkzeug.utils.send_from_directory(
+            os.path.join(app.root_path, self._root_path),
+            filename,
+            flask.request.environ,
+            as_attachment=True,
+            download_name=download_name,
+            use_x_sendfile=True,
+            response_class=app.response_class,
+            max_age=app.get_send_file_max_age,
+        )
+
+        if self._offload == OFFLOAD_X_ACCEL_REDIRECT:
+            del response.headers["X-Sendfile"]
+            response.headers["X-Accel-Redirect"] = (
+                f"{self._offload_prefix.rstrip('/')}/{url_quote(filename)}"
+            )
+
+        return response
+
     def get_upload_info(self, key):
         raise NotImplementedError("file annex does not support upload info")
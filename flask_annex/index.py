@@ -0,0 +1,134 @@
+import sqlite3
+import threading
+
+# -----------------------------------------------------------------------------
+
+# Listings read the index a page at a time rather than through one open
+# cursor, so they don't hold a read transaction for as long as the caller
+# iterates, and can be iterated from any thread.
+PAGE_SIZE = 1000
+
+# Without a rowid, rows are stored in key order, so prefix listings are range
+# scans over the table itself.
+CREATE_TABLE = """
+    CREATE TABLE IF NOT EXISTS keys (
+        key TEXT PRIMARY KEY,
+        size INTEGER NOT NULL,
+        mtime_ns INTEGER NOT NULL
+    ) WITHOUT ROWID
+"""
+
+# -----------------------------------------------------------------------------
+
+
+class KeyIndex:
+    def __init__(self, filename):
+        self._filename = filename
+
+        # SQLite connections can't be shared across threads.
+        self._local = threading.local()
+
+    def _get_connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is not None:
+            return connection
+
+        connection = sqlite3.connect(self._filename)
+
+        # WAL lets listings read while another thread or process writes.
+        # Syncing only on checkpoints is still safe against corruption, and
+        # a lost update on power loss is what verify and rebuild are for.
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.execute(CREATE_TABLE)
+
+        self._local.connection = connection
+        return connection
+
+    def put(self, key, size, mtime_ns):
+        with self._get_connection() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO keys VALUES (?, ?, ?)",
+                (key, size, mtime_ns),
+            )
+
+    def delete_many(self, keys):
+        with self._get_connection() as connection:
+            connection.executemany(
+                "DELETE FROM keys WHERE key = ?", ((key,) for key in keys)
+            )
+
+    def delete_prefix(self, prefix):
+        # This deletes the same keys as iter_rows lists for the prefix.
+        with self._get_connection() as connection:
+            if not prefix:
+                connection.execute("DELETE FROM keys")
+                return
+
+            connection.execute(
+                "DELETE FROM keys WHERE key = ? OR (key > ? AND key < ?)",
+                (prefix, f"{prefix}/", f"{prefix}0"),
+            )
+
+    def replace_all(self, rows):
+        with self._get_connection() as connection:
+            connection.execute("DELETE FROM keys")
+            connection.executemany("INSERT INTO keys VALUES (?, ?, ?)", rows)
+
+    def iter_rows(self, prefix, *, start_after=None):
+        # The prefix is a path, as for listing files. It matches the key
+        # itself, and keys under it as a directory, but not other keys that
+        # start with the same characters. Keys under it sort between
+        # "prefix/" and "prefix0", as "0" follows "/".
+        if prefix:
+            if start_after is None or prefix > start_after:
+                row = (
+                    self._get_connection()
+                    .execute(
+                        "SELECT key, size, mtime_ns FROM keys WHERE key = ?",
+                        (prefix,),
+                    )
+                    .fetchone()
+                )
+                if row is not None:
+                    yield row
+
+            after = f"{prefix}/"
+            before = f"{prefix}0"
+        else:
+            after = ""
+            before = None
+
+        if start_after is not None:
+            after = max(after, start_after)
+
+        while True:
+            rows = self._get_page(after, before)
+            yield from rows
+
+            if len(rows) < PAGE_SIZE:
+                return
+
+            after = rows[-1][0]
+
+    def _get_page(self, after, before):
+        if before is None:
+            return (
+                self._get_connection()
+                .execute(
+                    "SELECT key, size, mtime_ns FROM keys "
+                    "WHERE key > ? ORDER BY key LIMIT ?",
+                    (after, PAGE_SIZE),
+                )
+                .fetchall()
+            )
+
+        return (
+            self._get_connection()
+            .execute(
+                "SELECT key, size, mtime_ns FROM keys "
+                "WHERE key > ? AND key < ? ORDER BY key LIMIT ?",
+                (after, before, PAGE_SIZE),
+            )
+            .fetchall()
+        )
@@ -0,0 +1,114 @@
+import bisect
+import math
+import threading
+from blinker import ANY
+from collections import namedtuple
+
+from . import signals
+
+# -----------------------------------------------------------------------------
+
+# Upper bounds of the duration histogram buckets, in seconds. These span local
+# disk reads to slow object store transfers.
+DEFAULT_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+    math.inf,
+)
+
+OperationStats = namedtuple(
+    "OperationStats",
+    ("count", "errors", "duration", "nbytes", "histogram"),
+)
+
+# -----------------------------------------------------------------------------
+
+
+class OperationMetrics:
+    def __init__(self, num_buckets):
+        self.count = 0
+        self.errors = 0
+        self.duration = 0.0
+        self.nbytes = 0
+        self.histogram = [0] * num_buckets
+
+
+# -----------------------------------------------------------------------------
+
+
+class MetricsAggregator:
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self._buckets = tuple(buckets)
+
+        self._lock = threading.Lock()
+        self._metrics = {}
+
+    @property
+    def buckets(self):
+        return self._buckets
+
+    def connect(self, sender=ANY):
+        # Aggregate operations on sender, or on all annexes by default. Signals
+        # only hold receivers weakly, so keep a reference to the aggregator.
+        signals.operation_finished.connect(self._record, sender=sender)
+
+    def disconnect(self):
+        signals.operation_finished.disconnect(self._record)
+
+    def __enter__(self):
+        self.connect()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.disconnect()
+
+    def _record(
+        self, sender, *, operation, backend, duration, nbytes, error, **kwargs
+    ):
+        bucket_index = bisect.bisect_left(self._buckets, duration)
+
+        with self._lock:
+            metrics = self._metrics.get((backend, operation))
+            if metrics is None:
+                metrics = self._metrics[(backend, operation)] = (
+                    OperationMetrics(len(self._buckets))
+                )
+
+            metrics.count += 1
+            if error is not None:
+                metrics.errors += 1
+            metrics.duration += duration
+            if nbytes:
+                metrics.nbytes += nbytes
+            if bucket_index < len(self._buckets):
+                metrics.histogram[bucket_index] += 1
+
+    def snapshot(self):
+        # Return OperationStats for each (backend, operation) seen so far. The
+        # histogram counts operations per bucket, not cumulatively.
+        with self._lock:
+            return {
+                name: OperationStats(
+                    metrics.count,
+                    metrics.errors,
+                    metrics.duration,
+                    metrics.nbytes,
+                    tuple(metrics.histogram),
+                )
+                for name, metrics in self._metrics.items()
+            }
+
+    def reset(self):
+        with self._lock:
+            self._metrics.clear()
@@ -0,0 +1,422 @@
+import functools
+import heapq
+import itertools
+import logging
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from . import utils
+from .base import AnnexBase, SpooledWriter
+
+# -----------------------------------------------------------------------------
+
+# Weight of the newest sample in each replica's moving average of latency.
+DEFAULT_LATENCY_DECAY = 0.2
+
+# A failed read counts as a read that took this long, in seconds, so a
+# failing replica drops behind the others until it recovers.
+ERROR_LATENCY = 10
+
+logger = logging.getLogger(__name__)
+
+# -----------------------------------------------------------------------------
+
+
+class MirroredAnnex(AnnexBase):
+    # Every write goes to all annexes at once, and succeeds if at least
+    # write_quorum of them succeed. Writes return as soon as enough annexes
+    # succeed, so a slow annex doesn't hold them up, and the rest catch up in
+    # the background, staying stale until they do. Reads go to the annex that
+    # has been fastest so far, and fall back to the others on errors.
+
+    def __init__(
+        self,
+        annexes,
+        *,
+        write_quorum=None,
+        latency_decay=DEFAULT_LATENCY_DECAY,
+        repair_interval=None,
+    ):
+        self._annexes = tuple(annexes)
+        if not self._annexes:
+            raise ValueError("mirrored annex needs at least one annex")
+
+        if write_quorum is None:
+            write_quorum = len(self._annexes)
+        if not 1 <= write_quorum <= len(self._annexes):
+            raise ValueError(
+                f"write quorum {write_quorum} must be between 1 and the "
+                f"number of annexes, {len(self._annexes)}"
+            )
+        self._write_quorum = write_quorum
+        self._latency_decay = latency_decay
+
+        self._lock = threading.Lock()
+        self._latencies = [0.0] * len(self._annexes)
+
+        # Keys whose last write or delete failed on some annexes, mapped to
+        # the indexes of the annexes that took it, so repair knows which copy
+        # is current. Listings can't show an overwrite that only some annexes
+        # took, so this is how repair finds those. It's only kept in memory,
+        # so after a restart, repair only finds keys that annexes are missing.
+        self._stale = {}
+
+        # Writes submit one call per annex, so size the pool to let as many
+        # writes run at once as the other batch operations do.
+        self._executor = ThreadPoolExecutor(
+            len(self._annexes) * self._max_concurrency,
+            thread_name_prefix="annex-mirror",
+        )
+
+        self._closed = threading.Event()
+        if repair_interval is None:
+            self._repair_thread = None
+        else:
+            self._repair_thread = threading.Thread(
+                target=self._run_repair,
+                args=(repair_interval,),
+                name="annex-repair",
+                daemon=True,
+            )
+            self._repair_thread.start()
+
+    @property
+    def latencies(self):
+        with self._lock:
+            return tuple(self._latencies)
+
+    def close(self):
+        self._closed.set()
+        if self._repair_thread is not None:
+            self._repair_thread.join()
+
+        self._executor.shutdown()
+
+    def _run_repair(self, interval):
+        while not self._closed.wait(interval):
+            try:
+                self.repair()
+            except Exception:
+                logger.exception("failed to repair mirrored annex")
+
+    # -------------------------------------------------------------------------
+
+    def _write_all(self, keys, func, *, cleanup=None):
+        # Call func with each annex concurrently, returning the results once
+        # enough succeed, or raising the first error if too few did. Annexes
+        # that failed are left for repair, and ones still going are left stale
+        # until they finish. A failed write still waits for every annex, so it
+        # can't land after a retry. cleanup runs once every call is done.
+        futures = {
+            self._executor.submit(func, annex): index
+            for index, annex in enumerate(self._annexes)
+        }
+
+        results = []
+        errors = []
+        current = []
+        pending = set(futures)
+        while pending and len(results) < self._write_quorum:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in sorted(done, key=futures.get):
+                try:
+                    result = future.result()
+                except Exception as e:
+                    errors.append(e)
+                    continue
+
+                results.append(result)
+
+                # Results are per-key errors, if any. These still count
+                # toward the quorum, but leave the annex out of date.
+                if not result:
+                    current.append(futures[future])
+
+        current.sort()
+        if len(current) < len(self._annexes):
+            self._mark_stale(keys, current)
+        else:
+            self._mark_current(keys)
+
+        if pending:
+            self._finish_later(
+                keys,
+                current,
+                {future: futures[future] for future in pending},
+                cleanup,
+            )
+        elif cleanup is not None:
+            cleanup()
+
+        if len(results) < self._write_quorum:
+            raise errors[0]
+
+        return results
+
+    def _finish_later(self, keys, current, pending, cleanup):
+        # Bring the keys' state up to date as the calls still going finish.
+        remaining = len(pending)
+
+        def on_done(future):
+            nonlocal remaining
+
+            index = pending[future]
+            try:
+                caught_up = not future.result()
+            except Exception:
+                caught_up = False
+
+            with self._lock:
+                if caught_up:
+                    current.append(index)
+
+                for key in keys:
+                    stale = self._stale.get(key)
+                    if stale is current:
+                        if len(current) == len(self._annexes):
+                            del self._stale[key]
+                    elif stale is None:
+                        # A later write reached every annex, but this call
+                        # may have undone it on this one.
+                        self._stale[key] = [
+                            other
+                            for other in range(len(self._annexes))
+                            if other != index
+                        ]
+                    elif index in stale:
+                        # Likewise for a later write that reached this one.
+                        stale.remove(index)
+
+                remaining -= 1
+                finished = not remaining
+
+            if finished and cleanup is not None:
+                cleanup()
+
+        for future in pending:
+            future.add_done_callback(on_done)
+
+    def _mark_stale(self, keys, current):
+        # Keys share the list, which repair checks by identity to tell if a
+        # write came in meanwhile.
+        with self._lock:
+            for key in keys:
+                self._stale[key] = current
+
+    def _mark_current(self, keys):
+        with self._lock:
+            for key in keys:
+                self._stale.pop(key, None)
+
+    def _get_read_order(self):
+        with self._lock:
+            return sorted(
+                range(len(self._annexes)), key=self._latencies.__getitem__
+            )
+
+    def _record_latency(self, index, latency):
+        with self._lock:
+            self._latencies[index] += self._latency_decay * (
+                latency - self._latencies[index]
+            )
+
+    def _read(self, method_name, key, *args, rewind=None, **kwargs):
+        # Try annexes from fastest to slowest, returning the first success.
+        # rewind undoes partial output from a failed read, returning False if
+        # it can't, in which case the error is raised as is.
+        first_error = None
+        for index in self._get_read_order():
+            method = getattr(self._annexes[index], method_name)
+
+            start = time.perf_counter()
+            try:
+                result = method(key, *args, **kwargs)
+            except Exception as e:
+                # Don't penalize annexes that just don't have the key, as
+                # that's a normal miss when every annex lacks it.
+                if not isinstance(e, FileNotFoundError):
+                    self._record_latency(index, ERROR_LATENCY)
+
+                if rewind is not None and not rewind():
+                    raise
+
+                if first_error is None or isinstance(
+                    first_error, FileNotFoundError
+                ):
+                    first_error = e
+                continue
+
+            self._record_latency(index, time.perf_counter() - start)
+            return result
+
+        raise first_error
+
+    # -------------------------------------------------------------------------
+
+    def delete(self, key):
+        self._write_all((key,), lambda annex: annex.delete(key))
+
+    def delete_many(self, keys):
+        keys = tuple(keys)
+        results = self._write_all(keys, lambda annex: annex.delete_many(keys))
+        return [error for errors in results if errors for error in errors]
+
+    def get_file(self, key, out_file):
+        if isinstance(out_file, str):
+            return self._read("get_file", key, out_file)
+
+        try:
+            position = out_file.tell()
+        except (AttributeError, OSError):
+            position = None
+
+        def rewind():
+            # Without a position to go back to, partial output can't be
+            # undone.
+            if position is None:
+                return False
+
+            out_file.seek(position)
+            out_file.truncate()
+            return True
+
+        return self._read("get_file", key, out_file, rewind=rewind)
+
+    def list_keys(self, prefix, *, start_after=None, limit=None):
+        # Keys on any annex are listed, so keys that only some annexes have,
+        # which reads fail over for, are listed too.
+        keys = heapq.merge(
+            *(
+                annex.list_keys(prefix, start_after=start_after)
+                for annex in self._annexes
+            )
+        )
+        return itertools.islice(
+            (key for key, _ in itertools.groupby(keys)), limit
+        )
+
+    def open_mapped(self, key):
+        return self._read("open_mapped", key)
+
+    def open_read(self, key):
+        return self._read("open_read", key)
+
+    def open_write(self, key, *, content_encoding=None):
+        return SpooledWriter(self, key, content_encoding)
+
+    def save_file(self, key, in_file, *, content_encoding=None):
+        # Each annex reads the file by name, so they can all read at once. A
+        # file object can only be read once, so copy it to a file first, which
+        # is kept until slow annexes are done with it. A file passed by name
+        # might be gone by then, which leaves those annexes for repair.
+        if isinstance(in_file, str):
+            self._write_all(
+                (key,),
+                lambda annex: annex.save_file(
+                    key, in_file, content_encoding=content_encoding
+                ),
+            )
+            return
+
+        temp_file = tempfile.NamedTemporaryFile(
+            prefix=".mirror-", delete=False
+        )
+        try:
+            with temp_file:
+                utils.copy_fileobj(in_file, temp_file.file)
+        except BaseException:
+            os.remove(temp_file.name)
+            raise
+
+        self._write_all(
+            (key,),
+            lambda annex: annex.save_file(
+                key, temp_file.name, content_encoding=content_encoding
+            ),
+            cleanup=functools.partial(os.remove, temp_file.name),
+        )
+
+    def stat(self, key):
+        return self._read("stat", key)
+
+    def send_file(self, key, **kwargs):
+        return self._read("send_file", key, **kwargs)
+
+    def get_upload_info(self, key):
+        raise NotImplementedError(
+            "mirrored annex does not support upload info, as direct uploads "
+            "would only reach one annex"
+        )
+
+    # -------------------------------------------------------------------------
+
+    def repair(self, prefix=""):
+        # Bring keys whose last write failed on some annexes up to date from
+        # an annex that took it, then copy keys that some annexes are missing
+        # from an annex that has them, returning the sorted repaired keys.
+        # Listings alone can't tell a missed write from a missed delete, so a
+        # delete that failed on some annexes, and was forgotten since, is
+        # undone, as the safer of the two.
+        with self._lock:
+            stale = {
+                key: current
+                for key, current in self._stale.items()
+                if key.startswith(prefix)
+            }
+
+        repaired = set()
+        for key, current in stale.items():
+            self._repair_stale_key(key, current)
+            repaired.add(key)
+
+        listings = (
+            zip(annex.list_keys(prefix), itertools.repeat(index))
+            for index, annex in enumerate(self._annexes)
+        )
+
+        for key, entries in itertools.groupby(
+            heapq.merge(*listings), key=lambda entry: entry[0]
+        ):
+            if key in repaired:
+                continue
+
+            indexes = [index for _, index in entries]
+            if len(indexes) == len(self._annexes):
+                continue
+
+            self._repair_key(key, indexes, indexes)
+            repaired.add(key)
+
+        return sorted(repaired)
+
+    def _repair_stale_key(self, key, current):
+        # Without an annex known to be current, any copy is taken as current,
+        # as listings are.
+        sources = current or range(len(self._annexes))
+        for index in sources:
+            if self._annexes[index].exists(key):
+                self._repair_key(key, (index,), current or (index,))
+                break
+        else:
+            for index, annex in enumerate(self._annexes):
+                if index not in current:
+                    annex.delete(key)
+
+        # Only forget the key if no write came in meanwhile.
+        with self._lock:
+            if self._stale.get(key) is current:
+                del self._stale[key]
+
+    def _repair_key(self, key, sources, current):
+        # Copy the key from the first source to every annex that isn't
+        # current.
+        with tempfile.TemporaryDirectory(prefix=".mirror-") as temp_dir:
+            temp_filename = os.path.join(temp_dir, "repair")
+            self._annexes[sources[0]].get_file(key, temp_filename)
+
+            for index, annex in enumerate(self._annexes):
+                if index not in current:
+                    annex.save_file(key, temp_filename)
@@ -1,25 +1,402 @@
-import boto3
+import contextlib
 import flask
+import functools
+import heapq
+import io
+import itertools
+import math
 import mimetypes
-from botocore.config import Config
+import operator
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING
+from urllib.parse import quote as url_quote
 
-from .base import AnnexBase
+from . import utils
+from .base import AnnexBase, AnnexWriter, KeyInfo, get_entry_key
+
+# boto3 and botocore are slow to import, so they're only imported when an annex
+# first needs a client.
+if TYPE_CHECKING:
+    from botocore.config import Config
 
 # -----------------------------------------------------------------------------
 
 DEFAULT_EXPIRES_IN = 300
 
+# Objects up to this size are uploaded with a single PUT request. This is
+# twice boto's default, as splitting smaller objects costs more in extra
+# requests than it gains in parallelism.
+DEFAULT_MULTIPART_THRESHOLD = 16 * 1024**2
+
+# Without a configured chunk size, large objects are split so that every
+# worker gets a part, within these bounds.
+MIN_MULTIPART_CHUNKSIZE = 8 * 1024**2
+MAX_MULTIPART_CHUNKSIZE = 64 * 1024**2
+
+# S3 rejects multipart uploads with more parts than this, or with parts other
+# than the last smaller than this.
+MAX_MULTIPART_PARTS = 10000
+MIN_PART_SIZE = 5 * 1024**2
+
+# open_write doesn't know the size up front, so its parts double in size every
+# this many parts, to fit files of up to nearly 5 TiB, S3's largest, in the
+# part limit even at the smallest part size.
+PARTS_PER_SIZE_DOUBLING = 1000
+
+# open_read fetches objects in blocks of this size, and caches this many.
+DEFAULT_READ_BLOCK_SIZE = 1024**2
+DEFAULT_READ_MAX_BLOCKS = 16
+
+# The most keys S3 returns from a single ListObjectsV2 request.
+LIST_PAGE_SIZE = 1000
+
+# S3 rejects DeleteObjects requests with more keys than this.
+DELETE_BATCH_SIZE = 1000
+
 MISSING = object()
 
+# Clients are slow to create and hold a lot of memory, but are thread safe, so
+# annexes with the same settings share one per process.
+_clients = {}
+_clients_lock = threading.Lock()
+
+# -----------------------------------------------------------------------------
+
+
+def get_client_key(client_options):
+    region, access_key_id, secret_access_key, max_pool_connections, config = (
+        client_options
+    )
+
+    # Key on the options of the merged config, which are what the client ends
+    # up with. Config itself isn't hashable, so use its public options that
+    # differ from those of the pool config alone. Callers only pass a config
+    # once they've imported botocore, so merging here doesn't import it early.
+    config_options = {"max_pool_connections": max_pool_connections}
+    if config is not None:
+        pool_config = get_pool_config(max_pool_connections)
+        config = pool_config.merge(config)
+        config_options.update(
+            (option, getattr(config, option))
+            for option in config.OPTION_DEFAULTS
+            if getattr(config, option) != getattr(pool_config, option)
+        )
+
+    return (
+        region,
+        access_key_id,
+        secret_access_key,
+        tuple(
+            sorted(
+                (option, repr(value))
+                for option, value in config_options.items()
+            )
+        ),
+    )
+
+
+def get_pool_config(max_pool_connections):
+    from botocore.config import Config
+
+    # Bulk operations share the client across worker threads, so give it
+    # enough pooled connections that the workers don't queue for them.
+    return Config(max_pool_connections=max_pool_connections)
+
+
+def check_part_size(part_size):
+    if part_size is not None and part_size < MIN_PART_SIZE:
+        raise ValueError(
+            f"part size {part_size} is below the S3 minimum of "
+            f"{MIN_PART_SIZE}"
+        )
+
+
+@contextlib.contextmanager
+def raise_not_found(key):
+    # S3 reports missing keys as client errors, but callers such as mirrored
+    # and tiered annexes need the same error every annex raises for them.
+    from botocore.exceptions import ClientError
+
+    try:
+        yield
+    except ClientError as e:
+        if e.response["Error"]["Code"] in ("404", "NoSuchKey"):
+            raise FileNotFoundError(f"key {key} does not exist") from e
+
+        raise
+
+
+def get_client(client_key, client_options):
+    client = _clients.get(client_key)
+    if client is not None:
+        return client
+
+    with _clients_lock:
+        client = _clients.get(client_key)
+        if client is None:
+            client = _clients[client_key] = create_client(*client_options)
+
+    return client
+
+
+def create_client(
+    region, access_key_id, secret_access_key, max_pool_connections, config
+):
+    import boto3
+
+    pool_config = get_pool_config(max_pool_connections)
+
+    return boto3.client(
+        "s3",
+        region,
+        aws_access_key_id=access_key_id,
+        aws_secret_access_key=secret_access_key,
+        config=pool_config.merge(config) if config else pool_config,
+    )
+
+
+def _reset_clients():
+    global _clients_lock
+
+    # A forked process can't share the parent's connections, so it creates its
+    # own clients. The lock may have been held by another thread at the fork.
+    _clients.clear()
+    _clients_lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_clients)
+
+# -----------------------------------------------------------------------------
+
 
 def is_defined(obj):
     return obj is not MISSING and obj is not None
 
 
+def get_remaining_size(in_file):
+    try:
+        position = in_file.tell()
+        size = in_file.seek(0, os.SEEK_END) - position
+        in_file.seek(position)
+    except (AttributeError, OSError):
+        return None
+
+    return size
+
+
+# -----------------------------------------------------------------------------
+
+
+class S3ObjectReader(io.RawIOBase):
+    def __init__(self, client, bucket_name, key_info, block_size, max_blocks):
+        self._client = client
+        self._bucket_name = bucket_name
+        self._key_info = key_info
+        self._block_size = block_size
+        self._blocks = utils.LruCache(max_blocks)
+        self._position = 0
+
+    @property
+    def size(self):
+        return self._key_info.size
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            position = offset
+        elif whence == io.SEEK_CUR:
+            position = self._position + offset
+        elif whence == io.SEEK_END:
+            position = self.size + offset
+        else:
+            raise ValueError(f"invalid whence {whence}")
+
+        if position < 0:
+            raise ValueError(f"negative seek position {position}")
+
+        self._position = position
+        return position
+
+    def readinto(self, buffer):
+        view = memoryview(buffer).cast("B")
+
+        read_size = 0
+        while read_size < len(view) and self._position < self.size:
+            block_index, block_offset = divmod(
+                self._position, self._block_size
+            )
+            block = self._get_block(block_index)
+
+            chunk = block[block_offset : block_offset + len(view) - read_size]
+            view[read_size : read_size + len(chunk)] = chunk
+
+            read_size += len(chunk)
+            self._position += len(chunk)
+
+        return read_size
+
+    def _get_block(self, block_index):
+        block = self._blocks.get(block_index)
+        if block is not None:
+            return block
+
+        start = block_index * self._block_size
+        end = min(start + self._block_size, self.size) - 1
+
+        # Fail rather than mix blocks from different versions of the object.
+        with raise_not_found(self._key_info.key):
+            response = self._client.get_object(
+                Bucket=self._bucket_name,
+                Key=self._key_info.key,
+                Range=f"bytes={start}-{end}",
+                IfMatch=self._key_info.etag,
+            )
+        block = response["Body"].read()
+
+        self._blocks.set(block_index, block)
+        return block
+
+
+class S3MultipartWriter(AnnexWriter):
+    def __init__(self, annex, key, part_size, content_encoding=None):
+        self._annex = annex
+        self._key = key
+        self._part_size = part_size
+        self._content_encoding = content_encoding
+
+        self._buffer = bytearray()
+        self._upload_id = None
+        self._executor = None
+        self._parts = []
+
+        # Block writes while the maximum number of parts are uploading, which
+        # bounds the memory held by buffered parts.
+        self._uploading = threading.BoundedSemaphore(annex._max_concurrency)
+
+    @property
+    def _client(self):
+        return self._annex._client
+
+    @property
+    def _bucket_name(self):
+        return self._annex._bucket_name
+
+    def write(self, data):
+        self._buffer += data
+
+        while len(self._buffer) >= (part_size := self._get_part_size()):
+            part = bytes(self._buffer[:part_size])
+            del self._buffer[:part_size]
+            self._upload_part(part)
+
+        return len(data)
+
+    def _get_part_size(self):
+        return self._part_size * 2 ** (
+            len(self._parts) // PARTS_PER_SIZE_DOUBLING
+        )
+
+    def _upload_part(self, data):
+        if self._upload_id is None:
+            response = self._client.create_multipart_upload(
+                Bucket=self._bucket_name,
+                Key=self._key,
+                **self._get_extra_args(),
+            )
+            self._upload_id = response["UploadId"]
+            self._executor = ThreadPoolExecutor(self._annex._max_concurrency)
+
+        # Fail fast rather than keep writing after a part upload failed.
+        for part in self._parts:
+            if part.done() and part.exception():
+                raise part.exception()
+
+        self._uploading.acquire()
+        part = self._executor.submit(
+            self._send_part, len(self._parts) + 1, data
+        )
+        part.add_done_callback(lambda _: self._uploading.release())
+        self._parts.append(part)
+
+    def _get_extra_args(self):
+        return self._annex._get_extra_args(self._key, self._content_encoding)
+
+    def _send_part(self, part_number, data):
+        response = self._client.upload_part(
+            Bucket=self._bucket_name,
+            Key=self._key,
+            UploadId=self._upload_id,
+            PartNumber=part_number,
+            Body=data,
+        )
+        return {"ETag": response["ETag"], "PartNumber": part_number}
+
+    def _commit(self):
+        self._annex._invalidate_presigned_urls(self._key)
+
+        # Files smaller than one part don't need a multipart upload.
+        if self._upload_id is None:
+            self._client.put_object(
+                Bucket=self._bucket_name,
+                Key=self._key,
+                Body=bytes(self._buffer),
+                **self._get_extra_args(),
+            )
+            return
+
+        if self._buffer:
+            self._upload_part(bytes(self._buffer))
+            self._buffer.clear()
+
+        parts = [part.result() for part in self._parts]
+        self._executor.shutdown()
+
+        self._client.complete_multipart_upload(
+            Bucket=self._bucket_name,
+            Key=self._key,
+            UploadId=self._upload_id,
+            MultipartUpload={"Parts": parts},
+        )
+
+    def _abort(self):
+        self._buffer.clear()
+        if self._upload_id is None:
+            return
+
+        self._executor.shutdown(cancel_futures=True)
+        self._client.abort_multipart_upload(
+            Bucket=self._bucket_name,
+            Key=self._key,
+            UploadId=self._upload_id,
+        )
+
+
 # -----------------------------------------------------------------------------
 
 
 class S3Annex(AnnexBase):
+    _config_types = {
+        "expires_in": int,
+        "max_content_length": int,
+        "max_concurrency": int,
+        "presigned_url_cache_size": int,
+        "multipart_threshold": utils.parse_size,
+        "multipart_chunksize": utils.parse_size,
+        "use_threads": utils.parse_bool,
+    }
+
     def __init__(
         self,
         bucket_name,
@@ -29,64 +406,260 @@ class S3Annex(AnnexBase):
         secret_access_key=None,
         expires_in=DEFAULT_EXPIRES_IN,
         max_content_length=MISSING,
-        config: Config | None = None,
+        max_concurrency=utils.DEFAULT_MAX_CONCURRENCY,
+        presigned_url_cache_size=0,
+        multipart_threshold=DEFAULT_MULTIPART_THRESHOLD,
+        multipart_chunksize=None,
+        use_threads=True,
+        config: "Config | None" = None,
     ):
-        self._client = boto3.client(
-            "s3",
+        check_part_size(multipart_chunksize)
+
+        self._max_concurrency = max_concurrency
+        self._multipart_threshold = multipart_threshold
+        self._multipart_chunksize = multipart_chunksize
+        self._use_threads = use_threads
+
+        self._client_options = (
             region,
-            aws_access_key_id=access_key_id,
-            aws_secret_access_key=secret_access_key,
-            config=config,
+            access_key_id,
+            secret_access_key,
+            max_concurrency,
+            config,
         )
+        self._client_key = get_client_key(self._client_options)
 
         self._bucket_name = bucket_name
         self._expires_in = expires_in
         self._max_content_length = max_content_length
 
+        # Cached URLs are keyed on the key and response overrides, and
+        # grouped by key, so saves and deletes drop all URLs for the key.
+        self._presigned_url_cache = (
+            utils.LruCache(
+                presigned_url_cache_size, get_group=operator.itemgetter(0)
+            )
+            if presigned_url_cache_size
+            else None
+        )
+
+    @property
+    def _client(self):
+        # Create the client on first use, so annexes that are never used, like
+        # in processes that don't touch S3, cost nothing.
+        return get_client(self._client_key, self._client_options)
+
     def delete(self, key):
         self._client.delete_object(Bucket=self._bucket_name, Key=key)
+        self._invalidate_presigned_urls(key)
 
     def delete_many(self, keys):
-        # casting to tuple because keys might be iterable
-        objects = tuple({"Key": key} for key in keys)
-        if not objects:
-            # boto fails if the array is empty.
-            return
+        # Batches are pulled from keys lazily, so this never holds more than
+        # the in-flight batches in memory. An empty keys makes no request,
+        # which matters because boto fails if the array is empty.
+        return self._delete_batches(utils.iter_chunks(keys, DELETE_BATCH_SIZE))
+
+    def delete_prefix(self, prefix):
+        # Each page of the listing is a delete batch, submitted as soon as it
+        # arrives, so listing later pages overlaps deleting earlier ones.
+        page_iterator = self._paginate_list(
+            prefix, None, None, page_size=DELETE_BATCH_SIZE
+        )
+        return self._delete_batches(
+            tuple(item["Key"] for item in page["Contents"])
+            for page in page_iterator
+            if "Contents" in page
+        )
+
+    def _delete_batches(self, batches):
+        errors = []
+        for batch_errors in utils.map_concurrent(
+            self._delete_batch, batches, self._max_concurrency
+        ):
+            errors.extend(batch_errors)
+
+        return errors
 
-        self._client.delete_objects(
+    def _delete_batch(self, keys):
+        for key in keys:
+            self._invalidate_presigned_urls(key)
+
+        response = self._client.delete_objects(
             Bucket=self._bucket_name,
-            Delete={"Objects": objects},
+            Delete={
+                "Objects": [{"Key": key} for key in keys],
+                "Quiet": True,
+            },
         )
+        return response.get("Errors", ())
 
     def get_file(self, key, out_file):
-        if isinstance(out_file, str):
-            self._client.download_file(self._bucket_name, key, out_file)
+        self._get_file(key, out_file)
+
+    def _get_file(self, key, out_file, *, use_threads=True):
+        # Getting the size here would cost an extra request, so use the
+        # configuration for an object of unknown size.
+        transfer_config = self._get_transfer_config(
+            None, use_threads=use_threads
+        )
+
+        with raise_not_found(key):
+            if isinstance(out_file, str):
+                self._client.download_file(
+                    self._bucket_name, key, out_file, Config=transfer_config
+                )
+            else:
+                self._client.download_fileobj(
+                    self._bucket_name, key, out_file, Config=transfer_config
+                )
+
+    def get_many(self, pairs):
+        # The bulk pool already runs max_concurrency transfers at once, so
+        # run each on its pool thread rather than on a pool of its own.
+        return self._map_items(
+            functools.partial(self._get_file, use_threads=False), pairs
+        )
+
+    def _get_transfer_config(self, size, *, use_threads=True):
+        chunksize = self._multipart_chunksize
+        if chunksize is not None:
+            # Grow parts past the configured size if the file wouldn't fit in
+            # the part limit otherwise.
+            if size is not None:
+                chunksize = max(
+                    chunksize, math.ceil(size / MAX_MULTIPART_PARTS)
+                )
         else:
-            self._client.download_fileobj(self._bucket_name, key, out_file)
+            if size is None:
+                chunksize = MIN_MULTIPART_CHUNKSIZE
+            else:
+                chunksize = max(
+                    min(
+                        math.ceil(size / self._max_concurrency),
+                        MAX_MULTIPART_CHUNKSIZE,
+                    ),
+                    MIN_MULTIPART_CHUNKSIZE,
+                    math.ceil(size / MAX_MULTIPART_PARTS),
+                )
 
-    def list_keys(self, prefix):
-        paginator = self._client.get_paginator("list_objects_v2")
-        page_iterator = paginator.paginate(
-            Bucket=self._bucket_name, Prefix=prefix
+        from boto3.s3.transfer import TransferConfig
+
+        return TransferConfig(
+            multipart_threshold=self._multipart_threshold,
+            multipart_chunksize=chunksize,
+            max_concurrency=self._max_concurrency,
+            use_threads=self._use_threads and use_threads,
+        )
+
+    def list_entries(
+        self, prefix, *, recursive=True, start_after=None, limit=None
+    ):
+        # The listing already has everything but the content type, which is
+        # what uploads set from the key anyway.
+        page_iterator = self._paginate_list(
+            prefix, start_after, limit, delimiter=None if recursive else "/"
+        )
+
+        entries = (
+            entry
+            for page in page_iterator
+            for entry in heapq.merge(
+                (
+                    KeyInfo(
+                        item["Key"],
+                        item["Size"],
+                        item["LastModified"],
+                        item["ETag"],
+                        mimetypes.guess_type(item["Key"])[0],
+                    )
+                    for item in page.get("Contents", ())
+                ),
+                (
+                    KeyInfo(item["Prefix"], None, None, None, None)
+                    for item in page.get("CommonPrefixes", ())
+                ),
+                key=get_entry_key,
+            )
+            # A prefix can sort before start_after while holding keys after
+            # it, so S3 may list it again.
+            if start_after is None or entry.key > start_after
         )
+        return itertools.islice(entries, limit)
+
+    def list_keys(self, prefix, *, start_after=None, limit=None):
+        page_iterator = self._paginate_list(prefix, start_after, limit)
 
-        return (
+        keys = (
             item["Key"]
             for page in page_iterator
             if "Contents" in page
             for item in page["Contents"]
         )
+        return itertools.islice(keys, limit)
 
-    def save_file(self, key, in_file):
-        # Get the content type from the key, rather than letting Boto try to
-        # figure it out from the file's name, which may be uninformative. It's
-        # better to do it here so S3 doesn't have a wrong content type, rather
-        # than at read time as with content disposition.
-        content_type = mimetypes.guess_type(key)[0]
-        if content_type:
-            extra_args = {"ContentType": content_type}
-        else:
-            extra_args = None
+    def _paginate_list(
+        self,
+        prefix,
+        start_after,
+        limit,
+        *,
+        delimiter=None,
+        page_size=LIST_PAGE_SIZE,
+    ):
+        paginate_kwargs = {
+            "Bucket": self._bucket_name,
+            "Prefix": prefix,
+            "PaginationConfig": {"PageSize": page_size},
+        }
+        if start_after is not None:
+            paginate_kwargs["StartAfter"] = start_after
+        if delimiter is not None:
+            paginate_kwargs["Delimiter"] = delimiter
+        if limit:
+            # Avoid fetching full pages of keys the caller won't consume. With
+            # a delimiter, pages hold both keys and common prefixes, which
+            # MaxItems doesn't limit together, so only islice applies it.
+            paginate_kwargs["PaginationConfig"]["PageSize"] = min(
+                limit, page_size
+            )
+            if delimiter is None:
+                paginate_kwargs["PaginationConfig"]["MaxItems"] = limit
+
+        paginator = self._client.get_paginator("list_objects_v2")
+        return paginator.paginate(**paginate_kwargs)
+
+    def open_read(
+        self,
+        key,
+        *,
+        block_size=DEFAULT_READ_BLOCK_SIZE,
+        max_blocks=DEFAULT_READ_MAX_BLOCKS,
+    ):
+        return S3ObjectReader(
+            self._client,
+            self._bucket_name,
+            self.stat(key),
+            block_size,
+            max_blocks,
+        )
+
+    def open_write(self, key, *, part_size=None, content_encoding=None):
+        check_part_size(part_size)
+        return S3MultipartWriter(
+            self,
+            key,
+            part_size or self._multipart_chunksize or MIN_MULTIPART_CHUNKSIZE,
+            content_encoding,
+        )
+
+    def save_file(self, key, in_file, *, content_encoding=None):
+        self._save_file(key, in_file, content_encoding=content_encoding)
+
+    def _save_file(
+        self, key, in_file, *, content_encoding=None, use_threads=True
+    ):
+        self._invalidate_presigned_urls(key)
+        extra_args = self._get_extra_args(key, content_encoding) or None
 
         if isinstance(in_file, str):
             self._client.upload_file(
@@ -94,6 +667,9 @@ class S3Annex(AnnexBase):
                 self._bucket_name,
                 key,
                 extra_args,
+                Config=self._get_transfer_config(
+                    os.path.getsize(in_file), use_threads=use_threads
+                ),
             )
         else:
             self._client.upload_fileobj(
@@ -101,22 +677,121 @@ class S3Annex(AnnexBase):
                 self._bucket_name,
                 key,
                 extra_args,
+                Config=self._get_transfer_config(
+                    get_remaining_size(in_file), use_threads=use_threads
+                ),
             )
 
-    def generate_presigned_url(self, key, content_disposition=None):
+    def save_many(self, items):
+        # Like get_many, keep each transfer on its bulk pool thread.
+        return self._map_items(
+            functools.partial(self._save_file, use_threads=False), items
+        )
+
+    def _get_extra_args(self, key, content_encoding=None):
+        extra_args = {}
+
+        # Get the content type from the key, rather than letting Boto try to
+        # figure it out from the file's name, which may be uninformative. It's
+        # better to do it here so S3 doesn't have a wrong content type, rather
+        # than at read time as with content disposition.
+        content_type = mimetypes.guess_type(key)[0]
+        if content_type:
+            extra_args["ContentType"] = content_type
+
+        # S3 serves this back on downloads, so clients decode the content.
+        if content_encoding:
+            extra_args["ContentEncoding"] = content_encoding
+
+        return extra_args
+
+    def generate_presigned_url(
+        self, key, content_disposition=None, content_type=None
+    ):
         content_disposition = content_disposition or "attachment"
+
+        if self._presigned_url_cache is None:
+            return self._sign_url(
+                key, content_disposition, content_type, self._expires_in
+            )
+
+        # Reuse a URL for the rest of the time bucket in which it was signed.
+        # Buckets are half of expires_in long, and URLs expire expires_in
+        # after the start of their bucket, so a reused URL always has at
+        # least half of expires_in left. Reusing URLs saves signing and lets
+        # browsers and CDNs cache downloads. Boto always signs with the
+        # current time, so processes that sign the same key in the same
+        # bucket still get different URLs, though they expire together.
+        now = int(time.time())
+        bucket_length = max(self._expires_in // 2, 1)
+        time_bucket = now // bucket_length
+
+        cache_key = (key, content_disposition, content_type)
+        cached = self._presigned_url_cache.get(cache_key)
+        if cached and cached[0] == time_bucket:
+            return cached[1]
+
+        # A save or delete while signing drops the URLs for the key, so don't
+        # cache this one if that happened.
+        generation = self._presigned_url_cache.generation
+        url = self._sign_url(
+            key,
+            content_disposition,
+            content_type,
+            time_bucket * bucket_length + self._expires_in - now,
+        )
+        self._presigned_url_cache.set(
+            cache_key, (time_bucket, url), generation=generation
+        )
+        return url
+
+    def _sign_url(self, key, content_disposition, content_type, expires_in):
+        params = {
+            "Bucket": self._bucket_name,
+            "Key": key,
+            "ResponseContentDisposition": content_disposition,
+        }
+        if content_type:
+            params["ResponseContentType"] = content_type
+
         return self._client.generate_presigned_url(
             ClientMethod="get_object",
-            Params={
-                "Bucket": self._bucket_name,
-                "Key": key,
-                "ResponseContentDisposition": content_disposition,
-            },
-            ExpiresIn=self._expires_in,
+            Params=params,
+            ExpiresIn=expires_in,
+        )
+
+    def _invalidate_presigned_urls(self, key):
+        if self._presigned_url_cache is not None:
+            self._presigned_url_cache.pop_group(key)
+
+    def stat(self, key):
+        with raise_not_found(key):
+            response = self._client.head_object(
+                Bucket=self._bucket_name, Key=key
+            )
+
+        return KeyInfo(
+            key,
+            response["ContentLength"],
+            response["LastModified"],
+            response["ETag"],
+            response.get("ContentType"),
         )
 
-    def send_file(self, key, content_disposition=None):
-        url = self.generate_presigned_url(key, content_disposition)
+    def send_file(self, key, content_disposition=None, *, download_name=None):
+        # Serve a download name with its own content type, like Flask does,
+        # as the key may not have the same extension.
+        content_type = None
+        if download_name:
+            content_type = mimetypes.guess_type(download_name)[0]
+            if content_disposition is None:
+                content_disposition = (
+                    f"attachment; filename*=UTF-8''{url_quote(download_name)}"
+                )
+
+        url = self.generate_presigned_url(
+            key, content_disposition, content_type
+        )
         return flask.redirect(url)
 
     def get_upload_info(self, key, max_content_length=MISSING):
@@ -0,0 +1,164 @@
+import contextvars
+
+import functools
+import inspect
+import os
+import time
+from blinker import Namespace
+
+# -----------------------------------------------------------------------------
+
+_signals = Namespace()
+
+# Both are sent with the annex as the sender, and operation, key, and backend
+# as keyword arguments. operation_finished also gets duration in seconds,
+# nbytes if the operation transferred a known number of bytes, and error if it
+# raised. Operations that return lazy results, like list_keys, are timed until
+# they return, not until the results are consumed.
+operation_started = _signals.signal("annex-operation-started")
+operation_finished = _signals.signal("annex-operation-finished")
+
+# These operations take a key, or a prefix for listings, as their first
+# argument. The others work on batches of keys.
+KEY_OPERATIONS = frozenset(
+    (
+        "delete",
+        "delete_prefix",
+        "exists",
+        "get_file",
+        "list_entries",
+        "list_keys",
+        "open_mapped",
+        "open_read",
+        "open_write",
+        "save_file",
+        "send_file",
+        "stat",
+        "get_upload_info",
+    )
+)
+BATCH_OPERATIONS = frozenset(
+    ("delete_many", "get_many", "save_many", "stat_many")
+)
+OPERATIONS = KEY_OPERATIONS | BATCH_OPERATIONS
+
+# These operations transfer a file, which they take as their second argument.
+FILE_OPERATIONS = frozenset(("get_file", "save_file"))
+
+# The annex whose operation is running, so operations that an annex
+# implements with its own other operations, like exists with stat, are only
+# reported once.
+_current_annex = contextvars.ContextVar("current_annex", default=None)
+
+# -----------------------------------------------------------------------------
+
+
+def _get_file_position(file):
+    if isinstance(file, str):
+        return None
+
+    try:
+        return file.tell()
+    except (AttributeError, OSError, ValueError):
+        return None
+
+
+def _get_nbytes(file, start_position):
+    # Without wrapping the file, which would defeat zero-copy transfers, the
+    # bytes transferred are what the file's position moved by, or the size of
+    # the file for a filename.
+    try:
+        if isinstance(file, str):
+            return os.path.getsize(file)
+
+        if start_position is None:
+            return None
+
+        return file.tell() - start_position
+    except (AttributeError, OSError, ValueError):
+        return None
+
+
+def instrument(operation, func):
+    # Bind the arguments to find the key and file, so they're found however
+    # the caller passes them. Look them up by position in the signature, as
+    # not every operation names them the same.
+    signature = inspect.signature(func)
+    arg_names = tuple(signature.parameters)
+    key_arg = arg_names[1] if operation in KEY_OPERATIONS else None
+    file_arg = arg_names[2] if operation in FILE_OPERATIONS else None
+
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        # Keep this check first and cheap, as it's all that runs without any
+        # receivers.
+        if not (operation_started.receivers or operation_finished.receivers):
+            return func(self, *args, **kwargs)
+
+        if _current_annex.get() is self:
+            return func(self, *args, **kwargs)
+
+        try:
+            arguments = signature.bind(self, *args, **kwargs).arguments
+        except TypeError:
+            # Let the call itself raise for bad arguments.
+            arguments = {}
+
+        key = arguments.get(key_arg)
+        file = arguments.get(file_arg)
+        if file is not None:
+            start_position = _get_file_position(file)
+
+        backend = type(self).__name__
+        operation_started.send(
+            self, operation=operation, key=key, backend=backend
+        )
+
+        token = _current_annex.set(self)
+        start = time.perf_counter()
+        try:
+            result = func(self, *args, **kwargs)
+        except BaseException as e:
+            error = e
+            raise
+        else:
+            error = None
+            return result
+        finally:
+            duration = time.perf_counter() - start
+            _current_annex.reset(token)
+
+            if error is not None:
+                nbytes = None
+            elif file is not None:
+                nbytes = _get_nbytes(file, start_position)
+            elif operation == "open_mapped":
+                nbytes = len(result)
+            else:
+                nbytes = None
+
+            operation_finished.send(
+                self,
+                operation=operation,
+                key=key,
+                backend=backend,
+                duration=duration,
+                nbytes=nbytes,
+                error=error,
+            )
+
+    wrapper._annex_operation = True
+    return wrapper
+
+
+def instrument_operations(cls):
+    # Wrap the operations that cls defines itself. Inherited ones are already
+    # wrapped on the class that defines them.
+    for operation in OPERATIONS:
+        func = cls.__dict__.get(operation)
+        if func is None or getattr(func, "_annex_operation", False):
+            continue
+
+        setattr(cls, operation, instrument(operation, func))
+
+    return cls
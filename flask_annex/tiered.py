@@ -0,0 +1,335 @@
+import contextlib
+import heapq
+import itertools
+import logging
+import tempfile
+import threading
+from collections import Counter, namedtuple
+
+from .base import SPOOL_MAX_SIZE, AnnexBase, SpooledWriter
+
+# -----------------------------------------------------------------------------
+
+# Cold keys need this many reads since the last rebalance, with counts halving
+# at each rebalance, before they are considered for promotion.
+DEFAULT_PROMOTE_AFTER = 2
+
+DEFAULT_REBALANCE_INTERVAL = 60
+
+TierInfo = namedtuple(
+    "TierInfo", ("hot_size", "max_size", "promotions", "demotions")
+)
+
+logger = logging.getLogger(__name__)
+
+# -----------------------------------------------------------------------------
+
+
+class TieredAnnex(AnnexBase):
+    # Keys are written to the hot annex, usually a FileAnnex, and move between
+    # it and the cold annex, usually an S3Annex, as reads make them more or
+    # less popular. Reads try the hot annex first, so it's fine for a key to
+    # be in both.
+
+    def __init__(
+        self,
+        hot,
+        cold,
+        *,
+        max_size,
+        promote_after=DEFAULT_PROMOTE_AFTER,
+        rebalance_interval=DEFAULT_REBALANCE_INTERVAL,
+    ):
+        self._hot = hot
+        self._cold = cold
+        self._max_size = max_size
+        self._promote_after = promote_after
+
+        self._lock = threading.Lock()
+        self._accesses = Counter()
+
+        # Writes, deletes, and moves between tiers of a key hold its lock, so
+        # they never interleave. Reads don't take it. A key is always in at
+        # least one tier, but a save or promotion can add the hot copy after a
+        # read misses it and remove the cold copy before the read gets there,
+        # so reads check the hot tier again before giving up.
+        self._key_locks = {}
+        self._rebalance_lock = threading.Lock()
+
+        # Keys promoted without a write since, whose cold copy is still good,
+        # so demoting them doesn't need another upload.
+        self._clean = set()
+
+        self._hot_size = 0
+        self._promotions = 0
+        self._demotions = 0
+
+        self._closed = threading.Event()
+        if rebalance_interval is None:
+            self._rebalance_thread = None
+        else:
+            self._rebalance_thread = threading.Thread(
+                target=self._run_rebalance,
+                args=(rebalance_interval,),
+                name="annex-rebalance",
+                daemon=True,
+            )
+            self._rebalance_thread.start()
+
+    def tier_info(self):
+        with self._lock:
+            return TierInfo(
+                self._hot_size,
+                self._max_size,
+                self._promotions,
+                self._demotions,
+            )
+
+    def close(self):
+        self._closed.set()
+        if self._rebalance_thread is not None:
+            self._rebalance_thread.join()
+
+    def _run_rebalance(self, interval):
+        while not self._closed.wait(interval):
+            try:
+                self.rebalance()
+            except Exception:
+                logger.exception("failed to rebalance annex tiers")
+
+    def _record_access(self, key):
+        with self._lock:
+            self._accesses[key] += 1
+
+    @contextlib.contextmanager
+    def _lock_keys(self, keys):
+        # Lock in sorted order, so callers locking several keys can't
+        # deadlock.
+        keys = sorted(set(keys))
+
+        with self._lock:
+            locks = []
+            for key in keys:
+                lock, count = self._key_locks.get(key, (None, 0))
+                if lock is None:
+                    lock = threading.Lock()
+                self._key_locks[key] = (lock, count + 1)
+                locks.append(lock)
+
+        try:
+            with contextlib.ExitStack() as stack:
+                for lock in locks:
+                    stack.enter_context(lock)
+
+                yield
+        finally:
+            with self._lock:
+                for key in keys:
+                    lock, count = self._key_locks[key]
+                    if count == 1:
+                        del self._key_locks[key]
+                    else:
+                        self._key_locks[key] = (lock, count - 1)
+
+    # -------------------------------------------------------------------------
+
+    def rebalance(self):
+        # Keep the most read keys in the hot annex, up to max_size. New keys
+        # stay hot until there's no room left for them, and writes between
+        # rebalances can take the hot annex over max_size for a while.
+        with self._rebalance_lock:
+            self._rebalance()
+
+    def _rebalance(self):
+        with self._lock:
+            accesses = self._accesses
+            self._accesses = Counter(
+                {
+                    key: count // 2
+                    for key, count in accesses.items()
+                    if count > 1
+                }
+            )
+
+        hot_infos = {
+            key: key_info
+            for key, key_info in self._hot.stat_many(
+                self._hot.list_keys("")
+            ).items()
+            if key_info is not None
+        }
+        cold_infos = {
+            key: key_info
+            for key, key_info in self._cold.stat_many(
+                key
+                for key, count in accesses.items()
+                if count >= self._promote_after and key not in hot_infos
+            ).items()
+            if key_info is not None
+        }
+
+        def get_rank(key):
+            # Break ties in favor of keys that are already hot, then of the
+            # most recently written ones.
+            hot_info = hot_infos.get(key)
+            return (
+                accesses[key],
+                hot_info is not None,
+                hot_info.last_modified.timestamp() if hot_info else 0,
+            )
+
+        sizes = {
+            key: key_info.size
+            for key, key_info in itertools.chain(
+                hot_infos.items(), cold_infos.items()
+            )
+        }
+
+        keep = set()
+        budget = self._max_size
+        for key in sorted(sizes, key=get_rank, reverse=True):
+            if sizes[key] <= budget:
+                keep.add(key)
+                budget -= sizes[key]
+
+        # Demote first, to make room for the promotions.
+        for key in hot_infos.keys() - keep:
+            self._demote(key)
+        for key in cold_infos.keys() & keep:
+            self._promote(key)
+
+        with self._lock:
+            self._hot_size = self._max_size - budget
+
+    def _promote(self, key):
+        # Keep the cold copy, so demoting the key again is free unless it's
+        # written meanwhile.
+        with self._lock_keys((key,)):
+            if self._hot.exists(key):
+                return
+
+            with tempfile.SpooledTemporaryFile(SPOOL_MAX_SIZE) as spool:
+                try:
+                    self._cold.get_file(key, spool)
+                except FileNotFoundError:
+                    return
+
+                spool.seek(0)
+                self._hot.save_file(key, spool)
+
+            with self._lock:
+                self._clean.add(key)
+                self._promotions += 1
+
+    def _demote(self, key):
+        with self._lock_keys((key,)):
+            with self._lock:
+                clean = key in self._clean
+
+            if not clean:
+                with tempfile.SpooledTemporaryFile(SPOOL_MAX_SIZE) as spool:
+                    try:
+                        self._hot.get_file(key, spool)
+                    except FileNotFoundError:
+                        return
+
+                    spool.seek(0)
+                    self._cold.save_file(key, spool)
+
+            self._hot.delete(key)
+
+            with self._lock:
+                self._clean.discard(key)
+                self._demotions += 1
+
+    # -------------------------------------------------------------------------
+
+    def delete(self, key):
+        with self._lock_keys((key,)):
+            self._hot.delete(key)
+            self._cold.delete(key)
+            self._forget((key,))
+
+    def delete_many(self, keys):
+        keys = tuple(keys)
+        with self._lock_keys(keys):
+            self._hot.delete_many(keys)
+            errors = self._cold.delete_many(keys)
+            self._forget(keys)
+
+        return errors
+
+    def _forget(self, keys):
+        with self._lock:
+            for key in keys:
+                self._accesses.pop(key, None)
+                self._clean.discard(key)
+
+    def get_file(self, key, out_file):
+        return self._read(key, "get_file", out_file)
+
+    def open_read(self, key):
+        return self._read(key, "open_read")
+
+    def open_mapped(self, key):
+        return self._read(key, "open_mapped")
+
+    def _read(self, key, method_name, *args):
+        self._record_access(key)
+        return self._read_tiers(key, method_name, *args)
+
+    def _read_tiers(self, key, method_name, *args):
+        try:
+            return getattr(self._hot, method_name)(key, *args)
+        except FileNotFoundError:
+            pass
+
+        try:
+            return getattr(self._cold, method_name)(key, *args)
+        except FileNotFoundError:
+            return getattr(self._hot, method_name)(key, *args)
+
+    def list_keys(self, prefix, *, start_after=None, limit=None):
+        # Both annexes list keys in sorted order, so merge them, skipping the
+        # keys that are in both.
+        keys = heapq.merge(
+            self._hot.list_keys(prefix, start_after=start_after),
+            self._cold.list_keys(prefix, start_after=start_after),
+        )
+        return itertools.islice(
+            (key for key, _ in itertools.groupby(keys)), limit
+        )
+
+    def save_file(self, key, in_file, *, content_encoding=None):
+        # A hot FileAnnex doesn't store the content encoding, so keys demoted
+        # from it lose it.
+        with self._lock_keys((key,)):
+            self._hot.save_file(
+                key, in_file, content_encoding=content_encoding
+            )
+
+            # Remove any old cold copy, so it can't come back when the new
+            # file is demoted.
+            with self._lock:
+                self._clean.discard(key)
+            self._cold.delete(key)
+
+    def open_write(self, key, *, content_encoding=None):
+        return SpooledWriter(self, key, content_encoding)
+
+    def stat(self, key):
+        return self._read_tiers(key, "stat")
+
+    def send_file(self, key, **kwargs):
+        self._record_access(key)
+
+        if self._hot.exists(key):
+            return self._hot.send_file(key, **kwargs)
+
+        return self._cold.send_file(key, **kwargs)
+
+    def get_upload_info(self, key):
+        raise NotImplementedError(
+            "tiered annex does not support upload info, as direct uploads "
+            "would bypass the hot tier"
+        )
@@ -1,13 +1,348 @@
+import contextvars
+
+import errno
+import functools
+import importlib.metadata
+import io
+import itertools
 import os
+import queue
+import re
+import shutil
+import stat
+import threading
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 
 # -----------------------------------------------------------------------------
 
+DEFAULT_MAX_CONCURRENCY = 10
+
+TRUE_VALUES = frozenset(("1", "true", "yes", "on"))
+FALSE_VALUES = frozenset(("0", "false", "no", "off"))
+
+SIZE_RE = re.compile(r"^\s*(\d+)\s*([a-z]*)\s*$", re.IGNORECASE)
+SIZE_UNITS = {
+    "": 1,
+    "b": 1,
+    "k": 1024,
+    "kb": 1000,
+    "kib": 1024,
+    "m": 1024**2,
+    "mb": 1000**2,
+    "mib": 1024**2,
+    "g": 1024**3,
+    "gb": 1000**3,
+    "gib": 1024**3,
+}
 
-def get_config_from_env(namespace):
+# Copy at most this much per zero-copy system call; Linux caps sendfile at
+# just under 2 GiB per call anyway.
+ZERO_COPY_CHUNK_SIZE = 2**30
+
+# These errors on the first zero-copy call mean that the kernel or file system
+# doesn't support that method for these files, so we try the next method.
+ZERO_COPY_UNSUPPORTED_ERRNOS = frozenset(
+    (
+        errno.EBADF,
+        errno.EINVAL,
+        errno.ENOSYS,
+        errno.ENOTSOCK,
+        errno.EOPNOTSUPP,
+        errno.EXDEV,
+    )
+)
+
+# -----------------------------------------------------------------------------
+
+
+def get_config_from_env(namespace, types=None):
     prefix = f"{namespace}_"
+    types = types or {}
+
+    config = {}
+    for key, value in os.environ.items():
+        if not key.startswith(prefix):
+            continue
+
+        name = key[len(prefix) :].lower()
+        config[name] = types[name](value) if name in types else value
+
+    return config
+
+
+def parse_bool(value):
+    value = value.strip().lower()
+    if value in TRUE_VALUES:
+        return True
+    if value in FALSE_VALUES:
+        return False
+
+    raise ValueError(f"invalid boolean {value}")
+
+
+def parse_size(value):
+    match = SIZE_RE.match(value)
+    if not match or match.group(2).lower() not in SIZE_UNITS:
+        raise ValueError(f"invalid size {value}")
+
+    number, unit = match.groups()
+    return int(number) * SIZE_UNITS[unit.lower()]
+
+
+# -----------------------------------------------------------------------------
+
+
+@functools.cache
+def get_download_name_arg():
+    # The Flask version doesn't change while running, so only check it once,
+    # rather than on every request.
+    from packaging.version import Version
+
+    if Version(importlib.metadata.version("flask")) >= Version("2.2.0"):
+        return "download_name"
+
+    return "attachment_filename"
+
+
+# -----------------------------------------------------------------------------
+
+
+def _copy_file_range(in_fd, out_fd, offset, count):
+    return os.copy_file_range(in_fd, out_fd, count, offset)
+
+
+def _sendfile(in_fd, out_fd, offset, count):
+    return os.sendfile(out_fd, in_fd, offset, count)
+
+
+ZERO_COPY_METHODS = tuple(
+    method
+    for method, name in (
+        (_copy_file_range, "copy_file_range"),
+        (_sendfile, "sendfile"),
+    )
+    if hasattr(os, name)
+)
+
+
+def _get_plain_fd(file):
+    # Only plain files read and write the bytes at their descriptor as is.
+    # Wrappers like GzipFile also have fileno, but transform the data, so the
+    # kernel must not copy around them.
+    if isinstance(
+        file, (io.BufferedReader, io.BufferedWriter, io.BufferedRandom)
+    ):
+        raw = file.raw
+    else:
+        raw = file
+
+    if not isinstance(raw, io.FileIO):
+        return None
+
+    try:
+        return file.fileno()
+    except (OSError, ValueError):
+        return None
+
+
+def copy_fileobj(in_file, out_file):
+    # Let the kernel copy the data when both sides are plain files, rather
+    # than copying through a Python buffer like shutil.copyfileobj does.
+    in_fd = _get_plain_fd(in_file)
+    out_fd = _get_plain_fd(out_file)
+    if in_fd is None or out_fd is None:
+        shutil.copyfileobj(in_file, out_file)
+        return
+
+    in_stat = os.fstat(in_fd)
+    if not stat.S_ISREG(in_stat.st_mode):
+        shutil.copyfileobj(in_file, out_file)
+        return
+
+    # Honor the current position of in_file, then leave it at the end of
+    # what we copied, as shutil.copyfileobj would.
+    offset = in_file.tell()
+    out_file.flush()
+
+    copied = _copy_fd_range(in_fd, out_fd, offset, in_stat.st_size - offset)
+    if copied is None:
+        shutil.copyfileobj(in_file, out_file)
+        return
+
+    in_file.seek(offset + copied)
+
+
+def _copy_fd_range(in_fd, out_fd, offset, count):
+    if count <= 0:
+        return 0
+
+    for copy_range in ZERO_COPY_METHODS:
+        copied = 0
+        try:
+            while copied < count:
+                sent = copy_range(
+                    in_fd,
+                    out_fd,
+                    offset + copied,
+                    min(count - copied, ZERO_COPY_CHUNK_SIZE),
+                )
+                if not sent:
+                    break
+
+                copied += sent
+        except OSError as e:
+            if copied or e.errno not in ZERO_COPY_UNSUPPORTED_ERRNOS:
+                raise
+
+            continue
+
+        # Some file systems report no data rather than an error when they
+        # don't support a method.
+        if copied:
+            return copied
+
+    return None
+
+
+# -----------------------------------------------------------------------------
+
+
+def iter_chunks(iterable, size):
+    iterator = iter(iterable)
+    while chunk := tuple(itertools.islice(iterator, size)):
+        yield chunk
+
+
+def map_concurrent(func, iterable, max_workers):
+    # Unlike Executor.map, this consumes the iterable lazily, keeping at most
+    # max_workers calls in flight, and yields results as they complete. Calls
+    # run in copies of the caller's context, so they see its context
+    # variables, like the running operation that signals tracks.
+    with ThreadPoolExecutor(max_workers) as executor:
+        pending = set()
+        for item in iterable:
+            if len(pending) >= max_workers:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+
+            pending.add(
+                executor.submit(contextvars.copy_context().run, func, item)
+            )
+
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+
+
+def start_concurrent(func, iterable, max_workers):
+    # Like map_concurrent, but the calls start now, fed from a background
+    # thread, rather than when the caller first iterates. Results queue up
+    # until the caller takes them, and the calls all run even if it never
+    # does.
+    results = queue.SimpleQueue()
+    done = object()
+
+    def run():
+        try:
+            for result in map_concurrent(func, iterable, max_workers):
+                results.put((result, None))
+        except Exception as e:
+            results.put((None, e))
+        finally:
+            results.put((done, None))
+
+    threading.Thread(
+        target=contextvars.copy_context().run,
+        args=(run,),
+        name="annex-batch",
+        daemon=True,
+    ).start()
+
+    def iter_results():
+        while True:
+            result, error = results.get()
+            if error is not None:
+                raise error
+            if result is done:
+                return
+
+            yield result
+
+    return iter_results()
+
+
+# -----------------------------------------------------------------------------
+
+
+class LruCache:
+    def __init__(self, max_size, get_group=None):
+        self._max_size = max_size
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+        # With get_group, items are also indexed by the group it returns for
+        # their keys, so pop_group can drop a group without a scan.
+        self._get_group = get_group
+        self._groups = {}
+
+        # pop_group bumps this. Callers can read it before computing a value,
+        # then pass it to set, which skips the value if a group was popped
+        # meanwhile, as the value might be stale.
+        self._generation = 0
+
+    def __len__(self):
+        return len(self._items)
+
+    @property
+    def generation(self):
+        return self._generation
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                self._items.move_to_end(key)
+            except KeyError:
+                return default
+
+            return self._items[key]
+
+    def set(self, key, value, *, generation=None):
+        with self._lock:
+            if generation is not None and generation != self._generation:
+                return
+
+            self._items[key] = value
+            self._items.move_to_end(key)
+            if self._get_group is not None:
+                self._groups.setdefault(self._get_group(key), set()).add(key)
+
+            while len(self._items) > self._max_size:
+                evicted_key, _ = self._items.popitem(last=False)
+                self._remove_from_group(evicted_key)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            if key not in self._items:
+                return default
+
+            self._remove_from_group(key)
+            return self._items.pop(key)
+
+    def pop_group(self, group):
+        with self._lock:
+            self._generation += 1
+            for key in self._groups.pop(group, ()):
+                del self._items[key]
+
+    def _remove_from_group(self, key):
+        if self._get_group is None:
+            return
 
-    return {
-        key[len(prefix) :].lower(): value
-        for key, value in os.environ.items()
-        if key.startswith(prefix)
-    }
+        group = self._get_group(key)
+        keys = self._groups[group]
+        keys.discard(key)
+        if not keys:
+            del self._groups[group]
@@ -50,7 +50,7 @@ setup(
     packages=[
         "flask_annex",
     ],
-    install_requires=("Flask >= 2.0", "packaging >= 17.0"),
+    install_requires=("blinker >= 1.4", "Flask >= 2.0", "packaging >= 17.0"),
     extras_require={
         "s3": ("boto3 >= 1.4.0",),
         "tests": ("pytest", "pytest-cov"),
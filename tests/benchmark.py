@@ -0,0 +1,108 @@
+import json
+import statistics
+import time
+import tracemalloc
+
+# -----------------------------------------------------------------------------
+
+DEFAULT_ROUNDS = 20
+
+# A benchmark regresses when its median latency grows by more than this.
+REGRESSION_THRESHOLD = 0.25
+
+# -----------------------------------------------------------------------------
+
+
+def get_percentiles(durations):
+    if len(durations) < 2:
+        return {"p50": durations[0], "p90": durations[0], "p99": durations[0]}
+
+    quantiles = statistics.quantiles(durations, n=100, method="inclusive")
+    return {"p50": quantiles[49], "p90": quantiles[89], "p99": quantiles[98]}
+
+
+def measure(func, *, rounds, setup=None, nbytes=0):
+    durations = []
+    for _ in range(rounds):
+        if setup:
+            setup()
+
+        start = time.perf_counter()
+        func()
+        durations.append(time.perf_counter() - start)
+
+    # Tracing allocations slows everything down, so measure peak memory on a
+    # separate round rather than folding it into the timings.
+    if setup:
+        setup()
+
+    tracemalloc.start()
+    try:
+        func()
+        _, peak_memory = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    total = sum(durations)
+    result = {
+        "rounds": rounds,
+        "mean": total / rounds,
+        **get_percentiles(durations),
+        "ops_per_sec": rounds / total if total else None,
+        "peak_memory": peak_memory,
+    }
+    if nbytes:
+        result["bytes_per_sec"] = nbytes * rounds / total if total else None
+
+    return result
+
+
+# -----------------------------------------------------------------------------
+
+
+class BenchmarkRecorder:
+    def __init__(self, rounds):
+        self.rounds = rounds
+        self.results = {}
+
+    def measure(self, name, func, *, rounds=None, setup=None, nbytes=0):
+        self.results[name] = measure(
+            func,
+            rounds=rounds or self.rounds,
+            setup=setup,
+            nbytes=nbytes,
+        )
+        return self.results[name]
+
+    def save(self, path):
+        with open(path, "w") as f:
+            json.dump(self.results, f, indent=2, sort_keys=True)
+            f.write("\n")
+
+    def compare(self, path, threshold=REGRESSION_THRESHOLD):
+        with open(path) as f:
+            baseline = json.load(f)
+
+        regressions = []
+        for name, result in sorted(self.results.items()):
+            if name not in baseline:
+                continue
+
+            ratio = result["p50"] / baseline[name]["p50"]
+            if ratio > 1 + threshold:
+                regressions.append((name, baseline[name]["p50"], ratio))
+
+        return regressions
+
+
+def format_result(name, result):
+    line = (
+        f"{name}: p50={result['p50'] * 1e3:.3f}ms "
+        f"p90={result['p90'] * 1e3:.3f}ms "
+        f"p99={result['p99'] * 1e3:.3f}ms "
+        f"peak_memory={result['peak_memory'] / 1024:.1f}KiB"
+    )
+    if "bytes_per_sec" in result:
+        line += f" throughput={result['bytes_per_sec'] / 2**20:.1f}MiB/s"
+
+    return line
@@ -1,6 +1,96 @@
 import pytest
 from flask import Flask
 
+from .benchmark import DEFAULT_ROUNDS, BenchmarkRecorder, format_result
+
+# -----------------------------------------------------------------------------
+
+try:
+    import boto3
+    from moto import mock_aws
+except ImportError:
+    boto3 = None
+
+# -----------------------------------------------------------------------------
+
+
+def pytest_addoption(parser):
+    group = parser.getgroup("bench", "annex benchmarks")
+    group.addoption(
+        "--bench",
+        action="store_true",
+        help="run annex benchmarks",
+    )
+    group.addoption(
+        "--bench-rounds",
+        type=int,
+        default=None,
+        help="number of timed rounds per benchmark",
+    )
+    group.addoption(
+        "--bench-save",
+        metavar="PATH",
+        help="save benchmark results as JSON to PATH",
+    )
+    group.addoption(
+        "--bench-compare",
+        metavar="PATH",
+        help="report benchmarks that regressed against the JSON at PATH",
+    )
+
+
+def pytest_configure(config):
+    config.addinivalue_line(
+        "markers", "bench: annex benchmark; only runs with --bench"
+    )
+    config.addinivalue_line(
+        "markers", "requires_s3: needs boto3 and moto to run"
+    )
+
+    config.bench_recorder = BenchmarkRecorder(
+        config.getoption("bench_rounds") or DEFAULT_ROUNDS
+    )
+
+
+def pytest_collection_modifyitems(config, items):
+    run_bench = config.getoption("--bench")
+    skip_bench = pytest.mark.skip(reason="benchmarks need --bench to run")
+    skip_s3 = pytest.mark.skip(reason="S3 support not installed")
+
+    for item in items:
+        if "bench" in item.keywords and not run_bench:
+            item.add_marker(skip_bench)
+        if "requires_s3" in item.keywords and boto3 is None:
+            item.add_marker(skip_s3)
+
+
+def pytest_terminal_summary(terminalreporter, config):
+    recorder = config.bench_recorder
+    if not recorder.results:
+        return
+
+    terminalreporter.section("annex benchmarks")
+    for name, result in sorted(recorder.results.items()):
+        terminalreporter.write_line(format_result(name, result))
+
+    save_path = config.getoption("bench_save")
+    if save_path:
+        recorder.save(save_path)
+        terminalreporter.write_line(f"saved benchmark results to {save_path}")
+
+    compare_path = config.getoption("bench_compare")
+    if compare_path:
+        regressions = recorder.compare(compare_path)
+        for name, baseline_p50, ratio in regressions:
+            terminalreporter.write_line(
+                f"REGRESSION {name}: p50 {ratio:.2f}x baseline "
+                f"({baseline_p50 * 1e3:.3f}ms)",
+                red=True,
+            )
+        if not regressions:
+            terminalreporter.write_line("no benchmark regressions")
+
+
 # -----------------------------------------------------------------------------
 
 
@@ -15,3 +105,28 @@ def app():
 @pytest.fixture
 def client(app):
     return app.test_client()
+
+
+@pytest.fixture
+def s3_bucket():
+    with mock_aws():
+        bucket = boto3.resource("s3").Bucket("flask-annex")
+        bucket.create()
+
+        yield bucket
+
+
+@pytest.fixture
+def bucket_name(s3_bucket):
+    return s3_bucket.name
+
+
+@pytest.fixture
+def bench(request):
+    recorder = request.config.bench_recorder
+    group = request.cls.__name__ if request.cls else request.module.__name__
+
+    def run_benchmark(name, func, **kwargs):
+        return recorder.measure(f"{group}::{name}", func, **kwargs)
+
+    return run_benchmark
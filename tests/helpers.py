@@ -1,6 +1,11 @@
 import flask
+import gc
+import io
 import json
+import os
 import pytest
+import time
+import zipfile
 from io import BytesIO
 
 # -----------------------------------------------------------------------------
@@ -21,6 +26,11 @@ def get_upload_info(client, key, **kwargs):
 
 # -----------------------------------------------------------------------------
 
+BENCH_SIZES = (1024, 64 * 1024, 4 * 1024 * 1024, 64 * 1024 * 1024)
+BENCH_KEY_COUNTS = (10, 100, 1000)
+
+# -----------------------------------------------------------------------------
+
 
 class AbstractTestAnnex:
     @pytest.fixture
@@ -98,6 +108,241 @@ class AbstractTestAnnex:
             "foo/baz.json",
         ]
 
+    def test_list_keys_sorted(self, annex):
+        annex.save_file("foo/bar/qux.txt", BytesIO(b"3\n"))
+        annex.save_file("foo/bar-qux.txt", BytesIO(b"4\n"))
+
+        assert list(annex.list_keys("")) == [
+            "foo/bar-qux.txt",
+            "foo/bar.txt",
+            "foo/bar/qux.txt",
+            "foo/baz.json",
+        ]
+
+    def test_list_keys_start_after(self, annex):
+        annex.save_file("foo/bar/qux.txt", BytesIO(b"3\n"))
+        annex.save_file("qux/foo.txt", BytesIO(b"4\n"))
+
+        assert list(annex.list_keys("", start_after="foo/bar.txt")) == [
+            "foo/bar/qux.txt",
+            "foo/baz.json",
+            "qux/foo.txt",
+        ]
+        assert list(annex.list_keys("foo", start_after="foo/bar/qux.txt")) == [
+            "foo/baz.json",
+        ]
+        assert not list(annex.list_keys("foo", start_after="foo/baz.json"))
+
+    def test_list_keys_limit(self, annex):
+        annex.save_file("foo/qux.txt", BytesIO(b"3\n"))
+
+        assert list(annex.list_keys("foo/", limit=2)) == [
+            "foo/bar.txt",
+            "foo/baz.json",
+        ]
+        assert list(
+            annex.list_keys("foo/", start_after="foo/bar.txt", limit=1)
+        ) == ["foo/baz.json"]
+
+    def test_list_keys_nonexistent(self, annex):
+        assert not list(annex.list_keys("@@nonexistent/"))
+
+    def test_list_entries(self, annex):
+        annex.save_file("foo/bar/qux.txt", BytesIO(b"3\n"))
+
+        entries = list(annex.list_entries("foo/"))
+        assert [entry.key for entry in entries] == [
+            "foo/bar.txt",
+            "foo/bar/qux.txt",
+            "foo/baz.json",
+        ]
+
+        for entry in entries:
+            key_info = annex.stat(entry.key)
+            assert entry.size == key_info.size
+            assert entry.last_modified.tzinfo is not None
+            assert entry.etag
+            assert entry.content_type == key_info.content_type
+
+    def test_list_entries_not_recursive(self, annex):
+        annex.save_file("foo/bar/qux.txt", BytesIO(b"3\n"))
+        annex.save_file("foo/bar/quux/corge.txt", BytesIO(b"4\n"))
+        annex.save_file("qux.txt", BytesIO(b"5\n"))
+
+        entries = list(annex.list_entries("", recursive=False))
+        assert entries[0] == ("foo/", None, None, None, None)
+        assert [entry.key for entry in entries] == ["foo/", "qux.txt"]
+        assert entries[1].size == 2
+        assert [
+            entry.key for entry in annex.list_entries("foo/", recursive=False)
+        ] == ["foo/bar.txt", "foo/bar/", "foo/baz.json"]
+        assert [
+            entry.key
+            for entry in annex.list_entries("foo/bar/", recursive=False)
+        ] == ["foo/bar/quux/", "foo/bar/qux.txt"]
+
+        # Without the trailing "/", the directory itself is listed.
+        assert [
+            entry.key for entry in annex.list_entries("foo", recursive=False)
+        ] == ["foo/"]
+
+    def test_list_entries_start_after(self, annex):
+        annex.save_file("foo/bar/qux.txt", BytesIO(b"3\n"))
+
+        assert [
+            entry.key
+            for entry in annex.list_entries(
+                "foo/", recursive=False, start_after="foo/bar.txt"
+            )
+        ] == ["foo/bar/", "foo/baz.json"]
+        assert [
+            entry.key
+            for entry in annex.list_entries(
+                "foo/", recursive=False, start_after="foo/bar/"
+            )
+        ] == ["foo/baz.json"]
+        assert [
+            entry.key
+            for entry in annex.list_entries(
+                "foo/", recursive=False, start_after="foo/bar", limit=1
+            )
+        ] == ["foo/bar.txt"]
+        assert [
+            entry.key
+            for entry in annex.list_entries(
+                "foo/", start_after="foo/bar.txt", limit=1
+            )
+        ] == ["foo/bar/qux.txt"]
+
+    def test_list_entries_nonexistent(self, annex):
+        assert not list(annex.list_entries("@@nonexistent/"))
+        assert not list(annex.list_entries("@@nonexistent/", recursive=False))
+
+    def test_stat(self, annex):
+        key_info = annex.stat("foo/bar.txt")
+
+        assert key_info.key == "foo/bar.txt"
+        assert key_info.size == 2
+        assert key_info.last_modified.tzinfo is not None
+        assert key_info.etag
+        assert key_info.content_type == "text/plain"
+
+    def test_stat_etag_changed(self, annex):
+        etag = annex.stat("foo/bar.txt").etag
+        time.sleep(0.01)
+        annex.save_file("foo/bar.txt", BytesIO(b"10\n"))
+
+        assert annex.stat("foo/bar.txt").etag != etag
+
+    def test_stat_nonexistent(self, annex):
+        with pytest.raises(FileNotFoundError):
+            annex.stat("foo/@@nonexistent")
+
+        with pytest.raises(FileNotFoundError):
+            annex.stat("foo")
+
+        with pytest.raises(FileNotFoundError):
+            annex.stat("foo/bar.txt/qux")
+
+    def test_get_file_nonexistent(self, annex):
+        with pytest.raises(FileNotFoundError):
+            annex.get_file("foo/@@nonexistent", BytesIO())
+
+        with pytest.raises(FileNotFoundError):
+            annex.open_read("foo/@@nonexistent")
+
+        with pytest.raises(FileNotFoundError):
+            annex.get_file("foo", BytesIO())
+
+    def test_exists(self, annex):
+        assert annex.exists("foo/bar.txt")
+        assert not annex.exists("foo/@@nonexistent")
+        assert not annex.exists("foo")
+        assert not annex.exists("foo/bar.txt/qux")
+
+    def test_stat_many(self, annex):
+        key_infos = annex.stat_many(
+            iter(("foo/baz.json", "foo/@@nonexistent", "foo/bar.txt"))
+        )
+
+        assert list(key_infos) == [
+            "foo/baz.json",
+            "foo/@@nonexistent",
+            "foo/bar.txt",
+        ]
+        assert key_infos["foo/baz.json"].content_type == "application/json"
+        assert key_infos["foo/@@nonexistent"] is None
+        assert key_infos["foo/bar.txt"].size == 2
+
+    def test_open_mapped(self, annex):
+        with annex.open_mapped("foo/baz.json") as data:
+            assert data[:] == b"2\n"
+
+            with memoryview(data) as view:
+                assert view.readonly
+
+    def test_open_mapped_nonexistent(self, annex):
+        with pytest.raises(FileNotFoundError):
+            annex.open_mapped("foo/@@nonexistent")
+
+    def test_open_read(self, annex):
+        annex.save_file("foo/qux.txt", BytesIO(b"0123456789"))
+
+        with annex.open_read("foo/qux.txt") as in_fp:
+            assert in_fp.seekable()
+            assert in_fp.read(3) == b"012"
+            assert in_fp.tell() == 3
+
+            in_fp.seek(-2, os.SEEK_END)
+            assert in_fp.read() == b"89"
+            assert in_fp.read() == b""
+
+            in_fp.seek(4)
+            in_fp.seek(2, os.SEEK_CUR)
+            assert in_fp.read(2) == b"67"
+
+    def test_open_read_zip(self, annex):
+        zip_file = BytesIO()
+        with zipfile.ZipFile(zip_file, "w") as zip_fp:
+            zip_fp.writestr("foo.txt", b"1\n" * 1000)
+            zip_fp.writestr("bar.txt", b"2\n")
+
+        zip_file.seek(0)
+        annex.save_file("foo/qux.zip", zip_file)
+
+        with annex.open_read("foo/qux.zip") as in_fp:
+            with zipfile.ZipFile(in_fp) as zip_fp:
+                assert zip_fp.read("bar.txt") == b"2\n"
+
+    def test_open_write(self, annex):
+        with annex.open_write("qux/foo.txt") as out_fp:
+            out_fp.write(b"3")
+            out_fp.write(b"\n")
+
+        assert_key_value(annex, "qux/foo.txt", b"3\n")
+
+    def test_open_write_text(self, annex):
+        with io.TextIOWrapper(annex.open_write("qux/foo.txt")) as out_fp:
+            out_fp.write("3\n")
+
+        assert_key_value(annex, "qux/foo.txt", b"3\n")
+
+    def test_open_write_error(self, annex):
+        with pytest.raises(ValueError):
+            with annex.open_write("foo/bar.txt") as out_fp:
+                out_fp.write(b"3\n")
+                raise ValueError()
+
+        assert_key_value(annex, "foo/bar.txt", b"1\n")
+
+    def test_open_write_not_closed(self, annex):
+        out_fp = annex.open_write("qux/foo.txt")
+        out_fp.write(b"3\n")
+        del out_fp
+        gc.collect()
+
+        assert not annex.exists("qux/foo.txt")
+
     def test_save_file(self, annex):
         annex.save_file("qux/foo.txt", BytesIO(b"3\n"))
         assert_key_value(annex, "qux/foo.txt", b"3\n")
@@ -126,3 +371,188 @@ class AbstractTestAnnex:
         assert tuple(annex.list_keys(""))
         annex.delete_many(("foo/bar.txt", "foo/baz.json", "foo/@@nonexistent"))
         assert not tuple(annex.list_keys(""))
+
+    def test_delete_prefix(self, annex):
+        annex.save_file("foo/bar/qux.txt", BytesIO(b"3\n"))
+        annex.save_file("foo-bar.txt", BytesIO(b"4\n"))
+        annex.save_file("qux/foo.txt", BytesIO(b"5\n"))
+
+        assert not annex.delete_prefix("foo/bar/")
+        assert list(annex.list_keys("")) == [
+            "foo-bar.txt",
+            "foo/bar.txt",
+            "foo/baz.json",
+            "qux/foo.txt",
+        ]
+
+        annex.delete_prefix("foo/")
+        annex.delete_prefix("qux/foo.txt")
+        assert list(annex.list_keys("")) == ["foo-bar.txt"]
+
+        with pytest.raises(FileNotFoundError):
+            annex.stat("foo/bar.txt")
+
+    def test_delete_prefix_all(self, annex):
+        annex.delete_prefix("")
+        assert not list(annex.list_keys(""))
+
+        annex.save_file("foo/bar.txt", BytesIO(b"5\n"))
+        assert_key_value(annex, "foo/bar.txt", b"5\n")
+
+    def test_delete_prefix_nonexistent(self, annex):
+        assert not annex.delete_prefix("@@nonexistent/")
+        assert list(annex.list_keys("")) == ["foo/bar.txt", "foo/baz.json"]
+
+    def test_save_many(self, annex):
+        results = annex.save_many(
+            (f"qux/{i}.txt", BytesIO(f"{i}\n".encode())) for i in range(20)
+        )
+        assert sorted(results) == sorted(
+            (f"qux/{i}.txt", None) for i in range(20)
+        )
+
+        for i in range(20):
+            assert_key_value(annex, f"qux/{i}.txt", f"{i}\n".encode())
+
+    def test_save_many_not_iterated(self, annex):
+        results = annex.save_many(
+            (f"qux/{i}.txt", BytesIO(f"{i}\n".encode())) for i in range(3)
+        )
+
+        # The saves run without iterating the results, which then only wait
+        # for them to finish.
+        for _ in range(100):
+            if len(list(annex.list_keys("qux/"))) == 3:
+                break
+            time.sleep(0.01)
+
+        assert len(list(annex.list_keys("qux/"))) == 3
+        assert len(list(results)) == 3
+
+    def test_get_many(self, annex):
+        out_files = {
+            "foo/bar.txt": BytesIO(),
+            "foo/baz.json": BytesIO(),
+            "foo/@@nonexistent": BytesIO(),
+        }
+
+        errors = dict(annex.get_many(out_files.items()))
+        assert errors["foo/bar.txt"] is None
+        assert errors["foo/baz.json"] is None
+        assert isinstance(errors["foo/@@nonexistent"], Exception)
+
+        assert out_files["foo/bar.txt"].getvalue() == b"1\n"
+        assert out_files["foo/baz.json"].getvalue() == b"2\n"
+
+    @pytest.mark.bench
+    @pytest.mark.parametrize("size", BENCH_SIZES)
+    def test_bench_save_file(self, annex, bench, size):
+        data = os.urandom(size)
+        bench(
+            f"save_file[{size}]",
+            lambda: annex.save_file("bench/file", BytesIO(data)),
+            nbytes=size,
+        )
+
+    @pytest.mark.bench
+    @pytest.mark.parametrize("size", BENCH_SIZES)
+    def test_bench_get_file(self, annex, bench, size):
+        annex.save_file("bench/file", BytesIO(os.urandom(size)))
+        bench(
+            f"get_file[{size}]",
+            lambda: annex.get_file("bench/file", BytesIO()),
+            nbytes=size,
+        )
+
+    @pytest.mark.bench
+    @pytest.mark.parametrize("size", BENCH_SIZES)
+    def test_bench_save_file_from_file(self, tmpdir, annex, bench, size):
+        in_file = tmpdir.join("in")
+        in_file.write_binary(os.urandom(size))
+
+        # Open the file each round, as some annexes close it after saving.
+        def save_file():
+            with in_file.open("rb") as in_fp:
+                annex.save_file("bench/file", in_fp)
+
+        bench(f"save_file_from_file[{size}]", save_file, nbytes=size)
+
+    @pytest.mark.bench
+    @pytest.mark.parametrize("size", BENCH_SIZES)
+    def test_bench_get_file_to_file(self, tmpdir, annex, bench, size):
+        annex.save_file("bench/file", BytesIO(os.urandom(size)))
+
+        with tmpdir.join("out").open("wb") as out_fp:
+
+            def get_file():
+                out_fp.seek(0)
+                out_fp.truncate()
+                annex.get_file("bench/file", out_fp)
+
+            bench(f"get_file_to_file[{size}]", get_file, nbytes=size)
+
+    @pytest.mark.bench
+    @pytest.mark.parametrize("count", BENCH_KEY_COUNTS)
+    def test_bench_list_keys(self, annex, bench, count):
+        for i in range(count):
+            annex.save_file(f"bench/{i}/file.txt", BytesIO(b"0\n"))
+
+        bench(
+            f"list_keys[{count}]",
+            lambda: tuple(annex.list_keys("bench/")),
+            rounds=5,
+        )
+
+    @pytest.mark.bench
+    @pytest.mark.parametrize("count", BENCH_KEY_COUNTS)
+    def test_bench_delete_many(self, annex, bench, count):
+        keys = tuple(f"bench/{i}/file.txt" for i in range(count))
+
+        def setup():
+            for key in keys:
+                annex.save_file(key, BytesIO(b"0\n"))
+
+        bench(
+            f"delete_many[{count}]",
+            lambda: annex.delete_many(keys),
+            rounds=3,
+            setup=setup,
+        )
+
+    @pytest.mark.bench
+    @pytest.mark.parametrize("count", BENCH_KEY_COUNTS)
+    def test_bench_delete_prefix(self, annex, bench, count):
+        keys = tuple(f"bench/{i}/file.txt" for i in range(count))
+
+        def setup():
+            for key in keys:
+                annex.save_file(key, BytesIO(b"0\n"))
+
+        bench(
+            f"delete_prefix[{count}]",
+            lambda: annex.delete_prefix("bench/"),
+            rounds=3,
+            setup=setup,
+        )
+
+    @pytest.mark.bench
+    @pytest.mark.parametrize("count", BENCH_KEY_COUNTS)
+    def test_bench_save_many(self, annex, bench, count):
+        def save_many():
+            for _, error in annex.save_many(
+                (f"bench/{i}/file.txt", BytesIO(b"0\n")) for i in range(count)
+            ):
+                assert error is None
+
+        bench(f"save_many[{count}]", save_many, rounds=3)
+
+    @pytest.mark.bench
+    def test_bench_send_file(self, annex, bench, client):
+        bench("send_file", lambda: client.get("/files/foo/baz.json"))
+
+    @pytest.mark.bench
+    def test_bench_get_upload_info(self, annex, bench, client):
+        bench(
+            "get_upload_info",
+            lambda: get_upload_info(client, "foo/qux.txt"),
+        )
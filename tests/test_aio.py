@@ -0,0 +1,165 @@
+import asyncio
+import pytest
+import threading
+from io import BytesIO
+
+from flask_annex.aio import AsyncAnnex
+
+# -----------------------------------------------------------------------------
+
+
+async def collect(async_iterator):
+    return [item async for item in async_iterator]
+
+
+async def get_value(annex, key):
+    out_file = BytesIO()
+    await annex.get_file(key, out_file)
+    return out_file.getvalue()
+
+
+# -----------------------------------------------------------------------------
+
+
+class AbstractTestAsyncAnnex:
+    @pytest.fixture
+    def annex(self, annex_base):
+        async def save_files():
+            await annex_base.save_file("foo/bar.txt", BytesIO(b"1\n"))
+            await annex_base.save_file("foo/baz.json", BytesIO(b"2\n"))
+
+        asyncio.run(save_files())
+
+        yield annex_base
+        annex_base.close()
+
+    def test_get_file(self, annex):
+        assert asyncio.run(get_value(annex, "foo/bar.txt")) == b"1\n"
+
+    def test_save_file(self, annex):
+        async def save_and_get():
+            await annex.save_file("qux/foo.txt", BytesIO(b"3\n"))
+            return await get_value(annex, "qux/foo.txt")
+
+        assert asyncio.run(save_and_get()) == b"3\n"
+
+    def test_concurrent_transfers(self, annex):
+        async def save_and_get_many():
+            await asyncio.gather(
+                *(
+                    annex.save_file(f"qux/{i}.txt", BytesIO(f"{i}\n".encode()))
+                    for i in range(20)
+                )
+            )
+            return await asyncio.gather(
+                *(get_value(annex, f"qux/{i}.txt") for i in range(20))
+            )
+
+        assert asyncio.run(save_and_get_many()) == [
+            f"{i}\n".encode() for i in range(20)
+        ]
+
+    def test_list_keys(self, annex, monkeypatch):
+        monkeypatch.setattr("flask_annex.aio.LIST_KEYS_BATCH_SIZE", 1)
+
+        assert asyncio.run(collect(annex.list_keys("foo/"))) == [
+            "foo/bar.txt",
+            "foo/baz.json",
+        ]
+        assert asyncio.run(collect(annex.list_keys("foo/", limit=1))) == [
+            "foo/bar.txt",
+        ]
+
+    def test_list_entries(self, annex, monkeypatch):
+        monkeypatch.setattr("flask_annex.aio.LIST_KEYS_BATCH_SIZE", 1)
+
+        entries = asyncio.run(collect(annex.list_entries("", recursive=False)))
+        assert entries == [("foo/", None, None, None, None)]
+
+        entries = asyncio.run(collect(annex.list_entries("foo/")))
+        assert [entry.key for entry in entries] == [
+            "foo/bar.txt",
+            "foo/baz.json",
+        ]
+
+    def test_delete(self, annex):
+        async def delete_and_list():
+            await annex.delete("foo/bar.txt")
+            return await collect(annex.list_keys(""))
+
+        assert asyncio.run(delete_and_list()) == ["foo/baz.json"]
+
+    def test_delete_many(self, annex):
+        async def delete_and_list():
+            await annex.delete_many(("foo/bar.txt", "foo/baz.json"))
+            return await collect(annex.list_keys(""))
+
+        assert asyncio.run(delete_and_list()) == []
+
+    def test_context_manager(self, annex):
+        async def use_annex():
+            async with annex:
+                return await get_value(annex, "foo/bar.txt")
+
+        assert asyncio.run(use_annex()) == b"1\n"
+        with pytest.raises(RuntimeError):
+            asyncio.run(get_value(annex, "foo/bar.txt"))
+
+    def test_context_manager_in_flight(self, annex):
+        released = threading.Event()
+
+        async def release():
+            await asyncio.sleep(0.01)
+            released.set()
+
+        async def use_annex():
+            # The loop must keep running while the exit waits for the
+            # transfer, or nothing would release it.
+            async with annex:
+                transfer = asyncio.create_task(annex._run(released.wait, 1))
+                release_task = asyncio.create_task(release())
+                await asyncio.sleep(0)
+
+            await release_task
+            return await transfer
+
+        assert asyncio.run(use_annex())
+
+
+class TestAsyncFileAnnex(AbstractTestAsyncAnnex):
+    @pytest.fixture
+    def annex_base(self, tmpdir):
+        return AsyncAnnex("file", tmpdir.strpath, max_workers=4)
+
+    def test_send_file(self, app, annex):
+        with app.test_request_context():
+            response = asyncio.run(annex.send_file("foo/baz.json"))
+
+        assert response.status_code == 200
+        assert response.mimetype == "application/json"
+
+
+class TestAsyncFileAnnexFromEnv(TestAsyncFileAnnex):
+    @pytest.fixture
+    def annex_base(self, monkeypatch, tmpdir):
+        monkeypatch.setenv("FLASK_ANNEX_STORAGE", "file")
+        monkeypatch.setenv("FLASK_ANNEX_MAX_WORKERS", "4")
+        monkeypatch.setenv("FLASK_ANNEX_FILE_ROOT_PATH", tmpdir.strpath)
+
+        return AsyncAnnex.from_env("FLASK_ANNEX")
+
+
+@pytest.mark.requires_s3
+class TestAsyncS3Annex(AbstractTestAsyncAnnex):
+    @pytest.fixture
+    def annex_base(self, bucket_name):
+        return AsyncAnnex("s3", bucket_name, max_workers=4)
+
+    def test_send_file(self, app, annex):
+        with app.test_request_context():
+            response = asyncio.run(annex.send_file("foo/baz.json"))
+
+        assert response.status_code == 302
+        assert "response-content-disposition=attachment" in (
+            response.headers["Location"]
+        )
@@ -0,0 +1,197 @@
+import pytest
+import threading
+import time
+from io import BytesIO
+from unittest.mock import Mock
+
+from flask_annex import Annex
+from flask_annex.cache import CachedAnnex
+from flask_annex.file import FileAnnex
+
+from .helpers import AbstractTestAnnex, assert_key_value
+
+# -----------------------------------------------------------------------------
+
+
+@pytest.fixture
+def backing_annex(tmpdir):
+    return Annex("file", tmpdir.join("annex").mkdir().strpath)
+
+
+@pytest.fixture
+def cache_path(tmpdir):
+    return tmpdir.join("cache").mkdir().strpath
+
+
+# -----------------------------------------------------------------------------
+
+
+class TestCachedAnnex(AbstractTestAnnex):
+    @pytest.fixture
+    def annex_base(self, backing_annex, cache_path):
+        return CachedAnnex(backing_annex, cache_path, max_size=1000)
+
+    def test_send_file(self, client):
+        response = client.get("/files/foo/baz.json")
+        assert response.status_code == 200
+        assert response.mimetype == "application/json"
+
+    def test_cache_hit(self, annex, backing_annex, monkeypatch):
+        get_file = Mock(wraps=backing_annex.get_file)
+        monkeypatch.setattr(backing_annex, "get_file", get_file)
+
+        assert_key_value(annex, "foo/bar.txt", b"1\n")
+        assert_key_value(annex, "foo/bar.txt", b"1\n")
+
+        assert get_file.call_count == 1
+        assert annex.cache_info() == (1, 1, 2, 1000)
+
+    def test_revalidate(self, annex, backing_annex, monkeypatch):
+        annex._revalidate_after = 0
+        assert_key_value(annex, "foo/bar.txt", b"1\n")
+
+        # Still a hit when the ETag is unchanged.
+        assert_key_value(annex, "foo/bar.txt", b"1\n")
+        assert annex.cache_info().hits == 1
+
+        # Write behind the cache's back.
+        time.sleep(0.01)
+        backing_annex.save_file("foo/bar.txt", BytesIO(b"5\n"))
+
+        assert_key_value(annex, "foo/bar.txt", b"5\n")
+        assert annex.cache_info().misses == 2
+
+    def test_no_revalidate(self, annex, backing_annex, monkeypatch):
+        assert_key_value(annex, "foo/bar.txt", b"1\n")
+
+        stat = Mock(wraps=backing_annex.stat)
+        monkeypatch.setattr(backing_annex, "stat", stat)
+
+        assert_key_value(annex, "foo/bar.txt", b"1\n")
+        stat.assert_not_called()
+
+    def test_invalidate_on_save(self, annex):
+        assert_key_value(annex, "foo/bar.txt", b"1\n")
+        annex.save_file("foo/bar.txt", BytesIO(b"5\n"))
+
+        assert_key_value(annex, "foo/bar.txt", b"5\n")
+        assert annex.cache_info() == (0, 2, 2, 1000)
+
+    def test_invalidate_on_delete(self, annex):
+        assert_key_value(annex, "foo/bar.txt", b"1\n")
+        assert_key_value(annex, "foo/baz.json", b"2\n")
+
+        annex.delete("foo/bar.txt")
+        assert annex.cache_info().size == 2
+
+        annex.delete_many(iter(("foo/baz.json",)))
+        assert annex.cache_info().size == 0
+
+        with pytest.raises(FileNotFoundError):
+            annex.get_file("foo/bar.txt", BytesIO())
+
+    def test_evict(self, annex, backing_annex, monkeypatch):
+        annex._max_size = 4
+        annex.save_file("foo/qux.txt", BytesIO(b"3\n"))
+
+        assert_key_value(annex, "foo/bar.txt", b"1\n")
+        assert_key_value(annex, "foo/baz.json", b"2\n")
+        assert_key_value(annex, "foo/bar.txt", b"1\n")
+        assert_key_value(annex, "foo/qux.txt", b"3\n")
+        assert annex.cache_info() == (1, 3, 4, 4)
+
+        # foo/baz.json was least recently used, so it was evicted.
+        assert_key_value(annex, "foo/bar.txt", b"1\n")
+        assert_key_value(annex, "foo/baz.json", b"2\n")
+        assert annex.cache_info() == (2, 4, 4, 4)
+
+    def test_single_fetch(self, annex, backing_annex, monkeypatch):
+        started = threading.Event()
+        release = threading.Event()
+
+        def get_file(key, out_file):
+            started.set()
+            release.wait()
+            backing_annex.__class__.get_file(backing_annex, key, out_file)
+
+        get_file = Mock(side_effect=get_file)
+        monkeypatch.setattr(backing_annex, "get_file", get_file)
+
+        results = []
+
+        def read():
+            out_file = BytesIO()
+            annex.get_file("foo/bar.txt", out_file)
+            results.append(out_file.getvalue())
+
+        threads = [threading.Thread(target=read) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+
+        started.wait()
+        time.sleep(0.05)
+        release.set()
+
+        for thread in threads:
+            thread.join()
+
+        assert results == [b"1\n"] * 8
+        assert get_file.call_count == 1
+
+    def test_existing_files(self, backing_annex, cache_path):
+        cache = Annex("file", cache_path)
+        cache.save_file("foo/bar.txt", BytesIO(b"9\n"))
+        time.sleep(0.01)
+        cache.save_file("foo/qux.txt", BytesIO(b"8\n"))
+
+        # Files from earlier runs count toward the budget, oldest first.
+        annex = CachedAnnex(backing_annex, cache_path, max_size=2)
+        assert annex.cache_info().size == 2
+        assert list(cache.list_keys("")) == ["foo/qux.txt"]
+
+        # Their ETags are unknown, so they're fetched again.
+        assert_key_value(annex, "foo/bar.txt", b"1\n")
+        assert list(cache.list_keys("")) == ["foo/bar.txt"]
+
+    def test_removed_by_other_process(self, annex, cache_path):
+        assert_key_value(annex, "foo/bar.txt", b"1\n")
+        Annex("file", cache_path).delete("foo/bar.txt")
+
+        assert_key_value(annex, "foo/bar.txt", b"1\n")
+        assert annex.cache_info() == (1, 2, 2, 1000)
+
+    def test_get_file_bad_output(
+        self, annex, backing_annex, monkeypatch, tmpdir
+    ):
+        get_file = Mock(wraps=backing_annex.get_file)
+        monkeypatch.setattr(backing_annex, "get_file", get_file)
+
+        out_filename = tmpdir.join("missing", "out").strpath
+        with pytest.raises(FileNotFoundError):
+            annex.get_file("foo/bar.txt", out_filename)
+
+        assert get_file.call_count == 1
+
+    def test_temp_files_not_listed(self, annex, backing_annex, monkeypatch):
+        def get_file(key, out_file):
+            # The fetch is in progress here.
+            assert not list(annex._cache.list_keys(""))
+            backing_annex.__class__.get_file(backing_annex, key, out_file)
+
+        monkeypatch.setattr(backing_annex, "get_file", get_file)
+        assert_key_value(annex, "foo/bar.txt", b"1\n")
+
+    def test_evict_outside_lock(self, annex, monkeypatch):
+        annex._max_size = 2
+
+        def delete(key):
+            assert not annex._lock.locked()
+            FileAnnex.delete(annex._cache, key)
+
+        delete = Mock(side_effect=delete)
+        monkeypatch.setattr(annex._cache, "delete", delete)
+
+        assert_key_value(annex, "foo/bar.txt", b"1\n")
+        assert_key_value(annex, "foo/baz.json", b"2\n")
+        annex.delete("foo/baz.json")
+        assert delete.call_count == 2
@@ -0,0 +1,244 @@
+import gzip
+import os
+import pytest
+from io import BytesIO
+from unittest.mock import Mock
+
+from flask_annex import Annex
+from flask_annex.cache import CachedAnnex
+from flask_annex.compress import CompressedAnnex
+from flask_annex.dedup import DedupAnnex
+from flask_annex.mirror import MirroredAnnex
+from flask_annex.tiered import TieredAnnex
+
+from .helpers import AbstractTestAnnex, assert_key_value
+
+# -----------------------------------------------------------------------------
+
+DATA = b'{"foo": "bar"}\n' * 100
+
+# -----------------------------------------------------------------------------
+
+
+@pytest.fixture(params=("cache", "dedup", "mirror", "tiered"))
+def wrap_annex(request, tmpdir):
+    # Wrap a backing annex in each wrapper that compressed annexes can stack
+    # over.
+    def wrap_annex(backing_annex):
+        if request.param == "cache":
+            return CachedAnnex(
+                backing_annex,
+                tmpdir.join("cache").mkdir().strpath,
+                max_size=10000,
+            )
+        if request.param == "dedup":
+            return DedupAnnex(backing_annex)
+        if request.param == "mirror":
+            annex = MirroredAnnex((backing_annex,))
+            request.addfinalizer(annex.close)
+            return annex
+
+        return TieredAnnex(
+            backing_annex,
+            Annex("file", tmpdir.join("cold").mkdir().strpath),
+            max_size=10000,
+            rebalance_interval=None,
+        )
+
+    return wrap_annex
+
+
+# -----------------------------------------------------------------------------
+
+
+def get_stored(annex, key):
+    out_file = BytesIO()
+    annex._annex.get_file(key, out_file)
+    return out_file.getvalue()
+
+
+# -----------------------------------------------------------------------------
+
+
+class AbstractTestCompressedAnnex(AbstractTestAnnex):
+    @pytest.fixture
+    def annex_base(self, backing_annex):
+        return CompressedAnnex(backing_annex)
+
+    def test_compressed(self, annex):
+        annex.save_file("qux/foo.json", BytesIO(DATA))
+
+        stored = get_stored(annex, "qux/foo.json")
+        assert len(stored) < len(DATA)
+        assert gzip.decompress(stored) == DATA
+
+        assert_key_value(annex, "qux/foo.json", DATA)
+        assert annex.stat("qux/foo.json").size == len(stored)
+
+    def test_compressed_filename(self, tmpdir, annex):
+        in_file = tmpdir.join("in")
+        in_file.write_binary(DATA)
+        annex.save_file("qux/foo.json", in_file.strpath)
+
+        out_filename = tmpdir.join("out").strpath
+        annex.get_file("qux/foo.json", out_filename)
+        assert open(out_filename, "rb").read() == DATA
+
+    def test_compressed_filename_nonexistent(self, tmpdir, annex):
+        out_file = tmpdir.join("out")
+        out_file.write_binary(b"1\n")
+
+        with pytest.raises(FileNotFoundError):
+            annex.get_file("qux/@@nonexistent.json", out_file.strpath)
+        assert out_file.read_binary() == b"1\n"
+
+    def test_compressed_get_file(self, annex, monkeypatch):
+        annex.save_file("qux/foo.json", BytesIO(DATA))
+
+        # This downloads through the backing annex in one go.
+        open_read = Mock(wraps=annex._annex.open_read)
+        monkeypatch.setattr(annex._annex, "open_read", open_read)
+        assert_key_value(annex, "qux/foo.json", DATA)
+        assert not open_read.called
+
+    def test_compressed_open_read(self, annex):
+        annex.save_file("qux/foo.json", BytesIO(DATA))
+
+        with annex.open_read("qux/foo.json") as in_fp:
+            in_fp.seek(len(DATA) - 4)
+            assert in_fp.read() == DATA[-4:]
+
+    def test_not_compressed(self, annex):
+        annex.save_file("qux/foo.txt", BytesIO(DATA))
+        assert get_stored(annex, "qux/foo.txt") == DATA
+
+    def test_already_encoded(self, annex):
+        data = gzip.compress(DATA)
+        annex.save_file("qux/foo.json.gz", BytesIO(data))
+
+        assert get_stored(annex, "qux/foo.json.gz") == data
+        assert_key_value(annex, "qux/foo.json.gz", data)
+
+    def test_stored_uncompressed(self, annex):
+        annex._annex.save_file("qux/foo.json", BytesIO(DATA))
+        assert_key_value(annex, "qux/foo.json", DATA)
+
+        with annex.open_read("qux/foo.json") as in_fp:
+            assert in_fp.read() == DATA
+
+    def test_content_types(self, backing_annex):
+        annex = CompressedAnnex(backing_annex, content_types=("text/plain",))
+        annex.save_file("qux/foo.txt", BytesIO(DATA))
+        annex.save_file("qux/foo.json", BytesIO(DATA))
+
+        assert gzip.decompress(get_stored(annex, "qux/foo.txt")) == DATA
+        assert get_stored(annex, "qux/foo.json") == DATA
+
+
+class TestCompressedWrappedAnnex(AbstractTestCompressedAnnex):
+    @pytest.fixture
+    def backing_annex(self, tmpdir, wrap_annex):
+        return wrap_annex(Annex("file", tmpdir.join("annex").mkdir().strpath))
+
+    def test_send_file(self, client):
+        response = client.get("/files/foo/baz.json")
+        assert response.status_code == 200
+        assert response.headers["Content-Encoding"] == "gzip"
+        assert gzip.decompress(response.get_data()) == b"2\n"
+
+
+class TestCompressedFileAnnex(AbstractTestCompressedAnnex):
+    @pytest.fixture
+    def backing_annex(self, tmpdir):
+        return Annex("file", tmpdir.strpath)
+
+    def test_send_file(self, client):
+        response = client.get("/files/foo/baz.json")
+        assert response.status_code == 200
+        assert response.mimetype == "application/json"
+        assert response.headers["Content-Encoding"] == "gzip"
+        assert response.headers["Vary"] == "Accept-Encoding"
+        assert gzip.decompress(response.get_data()) == b"2\n"
+
+    def test_send_file_accept_encoding(self, client):
+        response = client.get(
+            "/files/foo/baz.json", headers={"Accept-Encoding": "br, gzip"}
+        )
+        assert response.headers["Content-Encoding"] == "gzip"
+
+        response = client.get(
+            "/files/foo/baz.json", headers={"Accept-Encoding": "identity"}
+        )
+        assert response.status_code == 200
+        assert response.mimetype == "application/json"
+        assert "Content-Encoding" not in response.headers
+        assert response.headers["Vary"] == "Accept-Encoding"
+        assert response.get_data() == b"2\n"
+
+    def test_send_file_recorded(self, annex, client, monkeypatch):
+        open_read = Mock(wraps=annex._annex.open_read)
+        monkeypatch.setattr(annex._annex, "open_read", open_read)
+
+        response = client.get("/files/foo/baz.json")
+        assert response.headers["Content-Encoding"] == "gzip"
+        assert not open_read.called
+
+    def test_send_file_stored_uncompressed(self, annex, client):
+        # Written behind the annex's back, so it checks the content again.
+        annex._annex.save_file("foo/baz.json", BytesIO(b"3\n"))
+
+        response = client.get("/files/foo/baz.json")
+        assert "Content-Encoding" not in response.headers
+        assert response.get_data() == b"3\n"
+
+    def test_send_file_not_compressed(self, client):
+        response = client.get("/files/foo/bar.txt")
+        assert response.status_code == 200
+        assert "Content-Encoding" not in response.headers
+        assert response.get_data() == b"1\n"
+
+
+@pytest.mark.requires_s3
+class TestCompressedS3Annex(AbstractTestCompressedAnnex):
+    @pytest.fixture
+    def backing_annex(self, bucket_name):
+        return Annex("s3", bucket_name)
+
+    def test_send_file(self, client):
+        response = client.get("/files/foo/baz.json")
+        assert response.status_code == 302
+        assert "Content-Encoding" not in response.headers
+
+    def test_content_encoding(self, annex, s3_bucket):
+        annex.save_file("qux/foo.json", BytesIO(DATA))
+
+        s3_object = s3_bucket.Object("qux/foo.json")
+        assert s3_object.content_encoding == "gzip"
+        assert s3_object.content_type == "application/json"
+
+    def test_content_encoding_multipart(self, annex, s3_bucket):
+        annex._annex._multipart_chunksize = 5 * 1024 * 1024
+        # Random data doesn't compress, so it still spans multiple parts.
+        data = os.urandom(6 * 1024 * 1024)
+        annex.save_file("qux/foo.csv", BytesIO(data))
+
+        s3_object = s3_bucket.Object("qux/foo.csv")
+        assert s3_object.content_encoding == "gzip"
+        assert_key_value(annex, "qux/foo.csv", data)
+
+
+@pytest.mark.requires_s3
+def test_content_encoding_wrapped(wrap_annex, s3_bucket):
+    annex = CompressedAnnex(wrap_annex(Annex("s3", s3_bucket.name)))
+
+    annex.save_file("qux/foo.json", BytesIO(DATA))
+    assert_key_value(annex, "qux/foo.json", DATA)
+
+    # The encoding reaches S3 through the wrapper. Dedup annexes store the
+    # content as a blob.
+    stored = [
+        s3_object.Object()
+        for s3_object in s3_bucket.objects.all()
+        if s3_object.key.startswith(("qux/", "blobs/"))
+    ]
+    assert [s3_object.content_encoding for s3_object in stored] == ["gzip"]
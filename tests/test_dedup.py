@@ -0,0 +1,159 @@
+import pytest
+from io import BytesIO
+from unittest.mock import Mock
+
+from flask_annex import Annex
+from flask_annex.dedup import DedupAnnex
+
+from .helpers import AbstractTestAnnex, assert_key_value
+
+# -----------------------------------------------------------------------------
+
+
+def list_blobs(annex):
+    return list(annex._annex.list_keys("blobs/"))
+
+
+# -----------------------------------------------------------------------------
+
+
+class AbstractTestDedupAnnex(AbstractTestAnnex):
+    @pytest.fixture
+    def annex_base(self, backing_annex):
+        return DedupAnnex(backing_annex)
+
+    def test_dedup(self, annex, tmp_path_factory):
+        # Keep the file out of tmpdir, which a backing annex may use.
+        empty_file = tmp_path_factory.mktemp("in") / "empty"
+        empty_file.write_bytes(b"")
+
+        annex.save_file("qux/bar.txt", BytesIO(b"1\n"))
+        annex.save_file("qux/baz.txt", str(empty_file))
+
+        assert len(list_blobs(annex)) == 3
+        assert_key_value(annex, "qux/bar.txt", b"1\n")
+
+    def test_dedup_skips_upload(self, annex, backing_annex, monkeypatch):
+        save_file = Mock(wraps=backing_annex.save_file)
+        monkeypatch.setattr(backing_annex, "save_file", save_file)
+
+        annex.save_file("qux/bar.txt", BytesIO(b"1\n"))
+
+        saved_keys = [call.args[0] for call in save_file.call_args_list]
+        assert not any(key.startswith("blobs/") for key in saved_keys)
+
+    def test_dedup_same_key(self, annex, backing_annex, monkeypatch):
+        save_file = Mock(wraps=backing_annex.save_file)
+        monkeypatch.setattr(backing_annex, "save_file", save_file)
+
+        annex.save_file("foo/bar.txt", BytesIO(b"1\n"))
+        save_file.assert_not_called()
+
+    def test_delete_refcounted(self, annex):
+        annex.save_file("qux/bar.txt", BytesIO(b"1\n"))
+        blobs = list_blobs(annex)
+
+        annex.delete("foo/bar.txt")
+        assert list_blobs(annex) == blobs
+        assert_key_value(annex, "qux/bar.txt", b"1\n")
+
+        annex.delete_many(("qux/bar.txt",))
+        assert len(list_blobs(annex)) == 1
+
+    def test_delete_many_batched(self, annex, backing_annex, monkeypatch):
+        annex.save_file("qux/bar.txt", BytesIO(b"1\n"))
+
+        delete = Mock(wraps=backing_annex.delete)
+        monkeypatch.setattr(backing_annex, "delete", delete)
+        delete_many = Mock(wraps=backing_annex.delete_many)
+        monkeypatch.setattr(backing_annex, "delete_many", delete_many)
+
+        errors = annex.delete_many(
+            ("foo/bar.txt", "foo/baz.json", "foo/@@nonexistent")
+        )
+        assert list(errors) == []
+        assert not delete.called
+
+        # One call for the pointers and references, and one for the blob of
+        # foo/baz.json. qux/bar.txt still uses the blob of foo/bar.txt.
+        assert delete_many.call_count == 2
+        assert len(delete_many.call_args_list[0].args[0]) == 4
+        assert len(list_blobs(annex)) == 1
+        assert_key_value(annex, "qux/bar.txt", b"1\n")
+
+    def test_replace_releases_blob(self, annex):
+        annex.save_file("foo/bar.txt", BytesIO(b"5\n"))
+        annex.save_file("foo/baz.json", BytesIO(b"5\n"))
+
+        # Keys with different extensions still share the blob.
+        assert len(list_blobs(annex)) == 1
+        assert len(list(annex._annex.list_keys("refs/"))) == 2
+
+    def test_content_encoding_separate_blob(self, annex):
+        annex.save_file(
+            "qux/bar.txt", BytesIO(b"1\n"), content_encoding="gzip"
+        )
+
+        # The same bytes, stored with an encoding, don't share a blob.
+        assert len(list_blobs(annex)) == 3
+        assert_key_value(annex, "qux/bar.txt", b"1\n")
+
+    def test_content_type_from_key(self, annex):
+        annex.save_file("qux/baz.txt", BytesIO(b"2\n"))
+
+        assert len(list_blobs(annex)) == 2
+        assert annex.stat("foo/baz.json").content_type == "application/json"
+        assert annex.stat("qux/baz.txt").content_type == "text/plain"
+
+    def test_read_single_request(self, annex, backing_annex, monkeypatch):
+        stat = Mock(wraps=backing_annex.stat)
+        monkeypatch.setattr(backing_annex, "stat", stat)
+
+        assert_key_value(annex, "foo/bar.txt", b"1\n")
+        stat.assert_not_called()
+
+
+class TestDedupFileAnnex(AbstractTestDedupAnnex):
+    @pytest.fixture
+    def backing_annex(self, tmpdir):
+        return Annex("file", tmpdir.strpath)
+
+    def test_send_file(self, client):
+        response = client.get("/files/foo/baz.json")
+        assert response.status_code == 200
+        assert response.mimetype == "application/json"
+        assert response.headers["Content-Disposition"] == (
+            "attachment; filename=baz.json"
+        )
+        assert response.get_data() == b"2\n"
+
+
+@pytest.mark.requires_s3
+class TestDedupS3Annex(AbstractTestDedupAnnex):
+    @pytest.fixture
+    def backing_annex(self, bucket_name):
+        return Annex("s3", bucket_name)
+
+    def test_send_file(self, client):
+        response = client.get("/files/foo/baz.json")
+        assert response.status_code == 302
+
+        s3_url = response.headers["Location"]
+        assert "/blobs/" in s3_url
+        assert "filename%2A%3DUTF-8%27%27baz.json" in s3_url
+        assert "response-content-type=application%2Fjson" in s3_url
+
+    def test_content_encoding_stored(self, annex, s3_bucket):
+        annex.save_file(
+            "qux/bar.txt", BytesIO(b"1\n"), content_encoding="gzip"
+        )
+        annex.save_file("qux/baz.txt", BytesIO(b"1\n"))
+
+        for key, content_encoding in (
+            ("foo/bar.txt", None),
+            ("qux/bar.txt", "gzip"),
+            ("qux/baz.txt", None),
+        ):
+            blob_key = annex._get_blob_key_for(key)
+            blob = s3_bucket.Object(blob_key)
+            assert blob.content_encoding == content_encoding
@@ -1,7 +1,14 @@
+import bz2
+import errno
+import gzip
+import os
 import pytest
 from io import BytesIO
+from unittest.mock import Mock
 
 from flask_annex import Annex
+from flask_annex.__main__ import main
+from flask_annex.file import INDEX_FILENAME
 
 from .helpers import AbstractTestAnnex, assert_key_value, get_upload_info
 
@@ -25,6 +32,110 @@ class TestFileAnnex(AbstractTestAnnex):
         annex.save_file("foo/qux.txt", BytesIO(b"6\n"))
         assert_key_value(annex, "foo/qux.txt", b"6\n")
 
+    def test_save_file_from_file(self, tmpdir, annex):
+        in_file = tmpdir.join("in")
+        in_file.write_binary(b"xx4\n")
+
+        with in_file.open("rb") as in_fp:
+            in_fp.read(2)
+            annex.save_file("qux/foo.txt", in_fp)
+            assert in_fp.tell() == 4
+
+        assert_key_value(annex, "qux/foo.txt", b"4\n")
+
+    def test_save_file_from_file_fallback(self, tmpdir, annex, monkeypatch):
+        def copy_range(*args):
+            raise OSError(errno.EXDEV, "cross-device link")
+
+        monkeypatch.setattr(
+            "flask_annex.utils.ZERO_COPY_METHODS", (copy_range,)
+        )
+
+        in_file = tmpdir.join("in")
+        in_file.write_binary(b"4\n")
+
+        with in_file.open("rb") as in_fp:
+            annex.save_file("qux/foo.txt", in_fp)
+
+        assert_key_value(annex, "qux/foo.txt", b"4\n")
+
+    @pytest.mark.parametrize("module", (gzip, bz2), ids=("gzip", "bz2"))
+    def test_save_file_from_compressed_file(self, tmpdir, annex, module):
+        content = b"0123456789\n" * 12
+        in_filename = tmpdir.join("in").strpath
+        with module.open(in_filename, "wb") as out_fp:
+            out_fp.write(content)
+
+        # These files have a fileno, but it's for the compressed bytes.
+        with module.open(in_filename, "rb") as in_fp:
+            annex.save_file("qux/foo.txt", in_fp)
+
+        assert_key_value(annex, "qux/foo.txt", content)
+
+    @pytest.mark.parametrize("module", (gzip, bz2), ids=("gzip", "bz2"))
+    def test_get_file_to_compressed_file(self, tmpdir, annex, module):
+        out_filename = tmpdir.join("out").strpath
+        with module.open(out_filename, "wb") as out_fp:
+            annex.get_file("foo/bar.txt", out_fp)
+
+        with module.open(out_filename, "rb") as in_fp:
+            assert in_fp.read() == b"1\n"
+
+    def test_get_file_to_file(self, tmpdir, annex):
+        out_file = tmpdir.join("out")
+
+        with out_file.open("wb") as out_fp:
+            out_fp.write(b"ab")
+            annex.get_file("foo/bar.txt", out_fp)
+            out_fp.write(b"cd")
+
+        assert out_file.read_binary() == b"ab1\ncd"
+
+    def test_save_file_error(self, annex, file_annex_path):
+        in_file = Mock(spec=("read",), read=Mock(side_effect=ValueError()))
+
+        with pytest.raises(ValueError):
+            annex.save_file("foo/bar.txt", in_file)
+
+        assert_key_value(annex, "foo/bar.txt", b"1\n")
+        assert sorted(os.listdir(os.path.join(file_annex_path, "foo"))) == [
+            "bar.txt",
+            "baz.json",
+        ]
+
+    def test_open_mapped_empty(self, annex):
+        annex.save_file("foo/qux.txt", BytesIO(b""))
+
+        with annex.open_mapped("foo/qux.txt") as data:
+            assert data[:] == b""
+
+    def test_list_keys_reserved(self, annex, file_annex_path):
+        with open(os.path.join(file_annex_path, "foo", ".annex-tmp-0"), "w"):
+            pass
+
+        assert list(annex.list_keys("foo")) == ["foo/bar.txt", "foo/baz.json"]
+
+    def test_delete_prefix_clean(self, annex):
+        annex.save_file("foo/bar/qux/quux.txt", BytesIO(b"3\n"))
+        dir_name = os.path.dirname(annex._get_filename("foo/bar/qux/quux.txt"))
+
+        # foo/bar only held foo/bar/qux, so it goes too.
+        annex.delete_prefix("foo/bar/qux")
+        assert not os.path.exists(os.path.dirname(dir_name))
+        assert_key_value(annex, "foo/bar.txt", b"1\n")
+
+        annex.delete_prefix("foo")
+        assert not os.path.exists(
+            os.path.dirname(annex._get_filename("foo/bar.txt"))
+        )
+        assert os.path.isdir(annex._root_path)
+
+    def test_list_entries_stat(self, annex):
+        expected = [annex.stat("foo/bar.txt"), annex.stat("foo/baz.json")]
+
+        assert list(annex.list_entries("foo/")) == expected
+        assert list(annex.list_entries("foo/", recursive=False)) == expected
+
     def test_send_file(self, client):
         response = client.get("/files/foo/baz.json")
         assert response.status_code == 200
@@ -67,9 +178,298 @@ class TestFileAnnexFromEnv(TestFileAnnex):
         return Annex.from_env("FLASK_ANNEX")
 
 
+class TestFileAnnexXSendfile(TestFileAnnex):
+    @pytest.fixture
+    def annex_base(self, file_annex_path):
+        return Annex("file", file_annex_path, offload="x-sendfile")
+
+    def test_send_file(self, client, file_annex_path):
+        response = client.get("/files/foo/baz.json")
+        assert response.status_code == 200
+        assert response.mimetype == "application/json"
+        assert response.headers["Content-Disposition"] == (
+            "attachment; filename=baz.json"
+        )
+        assert response.headers["X-Sendfile"] == os.path.join(
+            file_annex_path, "foo", "baz.json"
+        )
+        assert response.get_data() == b""
+
+
+class TestFileAnnexXAccelRedirect(TestFileAnnex):
+    @pytest.fixture
+    def annex_base(self, monkeypatch, file_annex_path):
+        monkeypatch.setenv("FLASK_ANNEX_STORAGE", "file")
+        monkeypatch.setenv("FLASK_ANNEX_FILE_ROOT_PATH", file_annex_path)
+        monkeypatch.setenv("FLASK_ANNEX_FILE_OFFLOAD", "x-accel-redirect")
+        monkeypatch.setenv("FLASK_ANNEX_FILE_OFFLOAD_PREFIX", "/protected/")
+
+        return Annex.from_env("FLASK_ANNEX")
+
+    def test_send_file(self, client):
+        response = client.get("/files/foo/baz.json")
+        assert response.status_code == 200
+        assert response.mimetype == "application/json"
+        assert "attachment" in response.headers["Content-Disposition"]
+        assert "X-Sendfile" not in response.headers
+        assert response.headers["X-Accel-Redirect"] == (
+            "/protected/foo/baz.json"
+        )
+        assert response.get_data() == b""
+
+    def test_send_file_quoted(self, annex, client):
+        annex.save_file("foo/qux quux.txt", BytesIO(b"6\n"))
+
+        response = client.get("/files/foo/qux quux.txt")
+        assert response.headers["X-Accel-Redirect"] == (
+            "/protected/foo/qux%20quux.txt"
+        )
+
+
+class TestFileAnnexSharded(TestFileAnnex):
+    @pytest.fixture
+    def annex_base(self, monkeypatch, file_annex_path):
+        monkeypatch.setenv("FLASK_ANNEX_STORAGE", "file")
+        monkeypatch.setenv("FLASK_ANNEX_FILE_ROOT_PATH", file_annex_path)
+        monkeypatch.setenv("FLASK_ANNEX_FILE_SHARD_WIDTH", "2")
+
+        return Annex.from_env("FLASK_ANNEX")
+
+    def test_layout(self, annex, file_annex_path):
+        shard = annex._get_shard("foo/bar.txt")
+        assert len(shard) == 2
+
+        assert os.path.isfile(
+            os.path.join(file_annex_path, shard, "foo", "bar.txt")
+        )
+        assert not os.path.exists(os.path.join(file_annex_path, "foo"))
+
+    def test_delete_cleans_shard(self, annex, file_annex_path):
+        shard = annex._get_shard("foo/bar.txt")
+        annex.delete("foo/bar.txt")
+
+        assert os.path.isdir(os.path.join(file_annex_path, shard))
+        assert not os.path.exists(os.path.join(file_annex_path, shard, "foo"))
+
+    def test_save_file_error(self, annex, file_annex_path):
+        in_file = Mock(spec=("read",), read=Mock(side_effect=ValueError()))
+
+        with pytest.raises(ValueError):
+            annex.save_file("foo/bar.txt", in_file)
+
+        assert_key_value(annex, "foo/bar.txt", b"1\n")
+        assert os.listdir(
+            os.path.dirname(annex._get_filename("foo/bar.txt"))
+        ) == ["bar.txt"]
+
+    def test_list_keys_reserved(self, annex, file_annex_path):
+        os.mkdir(os.path.join(file_annex_path, ".annex-migrate"))
+        with open(os.path.join(file_annex_path, ".annex-tmp-0"), "w"):
+            pass
+
+        assert list(annex.list_keys("foo")) == ["foo/bar.txt", "foo/baz.json"]
+
+
+class TestFileAnnexIndexed(TestFileAnnex):
+    @pytest.fixture
+    def annex_base(self, monkeypatch, file_annex_path):
+        monkeypatch.setenv("FLASK_ANNEX_STORAGE", "file")
+        monkeypatch.setenv("FLASK_ANNEX_FILE_ROOT_PATH", file_annex_path)
+        monkeypatch.setenv("FLASK_ANNEX_FILE_INDEX", "true")
+
+        return Annex.from_env("FLASK_ANNEX")
+
+    @pytest.fixture
+    def no_walk(self, annex, monkeypatch):
+        monkeypatch.setattr(
+            annex, "_iter_keys", Mock(side_effect=AssertionError)
+        )
+
+    def test_list_keys_indexed(self, annex, no_walk, file_annex_path):
+        annex.save_file("foo-bar.txt", BytesIO(b"3\n"))
+        with annex.open_write("foo/qux/quux.txt") as out_fp:
+            out_fp.write(b"4\n")
+
+        assert list(annex.list_keys("foo")) == [
+            "foo/bar.txt",
+            "foo/baz.json",
+            "foo/qux/quux.txt",
+        ]
+        assert list(annex.list_keys("foo/bar.txt")) == ["foo/bar.txt"]
+        assert list(annex.list_keys("./foo//qux/")) == ["foo/qux/quux.txt"]
+
+        annex.delete_many(("foo/bar.txt", "foo/qux/quux.txt"))
+        annex.delete("foo/baz.json")
+        assert list(annex.list_keys("")) == ["foo-bar.txt"]
+
+    def test_delete_prefix_indexed(self, annex, no_walk, file_annex_path):
+        annex.save_file("foo-bar.txt", BytesIO(b"3\n"))
+        annex.delete_prefix("foo")
+        assert list(annex.list_keys("")) == ["foo-bar.txt"]
+
+        annex.delete_prefix("")
+        assert not list(annex.list_keys(""))
+        assert os.path.isfile(os.path.join(file_annex_path, INDEX_FILENAME))
+
+    def test_list_entries_indexed(self, annex, no_walk):
+        assert list(annex.list_entries("foo")) == [
+            annex.stat("foo/bar.txt"),
+            annex.stat("foo/baz.json"),
+        ]
+
+    def test_list_keys_paged(self, annex, no_walk, monkeypatch):
+        monkeypatch.setattr("flask_annex.index.PAGE_SIZE", 2)
+        for i in range(5):
+            annex.save_file(f"foo/{i}.txt", BytesIO(b""))
+
+        assert list(annex.list_keys("foo")) == [
+            *(f"foo/{i}.txt" for i in range(5)),
+            "foo/bar.txt",
+            "foo/baz.json",
+        ]
+        assert list(annex.list_keys("", start_after="foo/3.txt")) == [
+            "foo/4.txt",
+            "foo/bar.txt",
+            "foo/baz.json",
+        ]
+
+    def test_verify_index(self, annex, file_annex_path):
+        assert annex.verify_index() == []
+
+        # Change the files behind the annex's back.
+        unindexed_annex = Annex("file", file_annex_path)
+        unindexed_annex.save_file("foo/qux.txt", BytesIO(b"3\n"))
+        unindexed_annex.save_file("foo/bar.txt", BytesIO(b"10\n"))
+        unindexed_annex.delete("foo/baz.json")
+
+        assert annex.verify_index() == [
+            "foo/bar.txt",
+            "foo/baz.json",
+            "foo/qux.txt",
+        ]
+
+        assert annex.rebuild_index() == 2
+        assert annex.verify_index() == []
+        assert list(annex.list_keys("")) == ["foo/bar.txt", "foo/qux.txt"]
+
+
 # -----------------------------------------------------------------------------
 
 
+def test_migrate(file_annex_path):
+    annex = Annex("file", file_annex_path)
+    for i in range(20):
+        annex.save_file(f"foo/{i}.txt", BytesIO(f"{i}\n".encode()))
+
+    sharded_annex = Annex("file", file_annex_path, shard_width=1)
+    assert sharded_annex.migrate(from_shard_width=0) == 20
+
+    assert list(sharded_annex.list_keys("")) == sorted(
+        f"foo/{i}.txt" for i in range(20)
+    )
+    assert_key_value(sharded_annex, "foo/7.txt", b"7\n")
+    assert not os.path.exists(os.path.join(file_annex_path, "foo"))
+    assert not os.path.exists(os.path.join(file_annex_path, ".annex-migrate"))
+
+    # Migrate back, to a layout where old shard names could look like keys.
+    assert annex.migrate(from_shard_width=1) == 20
+    assert list(annex.list_keys("")) == sorted(
+        f"foo/{i}.txt" for i in range(20)
+    )
+    assert sorted(os.listdir(file_annex_path)) == ["foo"]
+
+
+def test_migrate_resume(file_annex_path):
+    staging_path = os.path.join(file_annex_path, ".annex-migrate")
+    os.mkdir(staging_path)
+    open(os.path.join(staging_path, ".annex-staged"), "wb").close()
+    Annex("file", staging_path).save_file("foo/bar.txt", BytesIO(b"1\n"))
+
+    annex = Annex("file", file_annex_path, shard_width=2)
+    annex.save_file("foo/baz.json", BytesIO(b"2\n"))
+
+    assert annex.migrate(from_shard_width=0) == 1
+    assert list(annex.list_keys("")) == ["foo/bar.txt", "foo/baz.json"]
+
+
+def test_migrate_resume_staging(file_annex_path):
+    annex = Annex("file", file_annex_path)
+    annex.save_file("foo/bar.txt", BytesIO(b"1\n"))
+    annex.save_file("qux/baz.txt", BytesIO(b"2\n"))
+
+    # Stop after staging only some of the entries at the root.
+    staging_path = os.path.join(file_annex_path, ".annex-migrate")
+    os.mkdir(staging_path)
+    os.rename(
+        os.path.join(file_annex_path, "foo"), os.path.join(staging_path, "foo")
+    )
+
+    sharded_annex = Annex("file", file_annex_path, shard_width=2)
+    assert sharded_annex.migrate(from_shard_width=0) == 2
+    assert list(sharded_annex.list_keys("")) == ["foo/bar.txt", "qux/baz.txt"]
+    assert_key_value(sharded_annex, "qux/baz.txt", b"2\n")
+    assert not os.path.exists(staging_path)
+
+
+def test_migrate_cli(file_annex_path, capsys):
+    Annex("file", file_annex_path).save_file("foo/bar.txt", BytesIO(b"1\n"))
+
+    main(["migrate", file_annex_path, "--shard-width", "2"])
+    assert capsys.readouterr().out == "migrated 1 keys\n"
+
+    annex = Annex("file", file_annex_path, shard_width=2)
+    assert_key_value(annex, "foo/bar.txt", b"1\n")
+
+
+def test_index_built(file_annex_path):
+    Annex("file", file_annex_path).save_file("foo/bar.txt", BytesIO(b"1\n"))
+
+    annex = Annex("file", file_annex_path, index=True)
+    assert list(annex.list_keys("")) == ["foo/bar.txt"]
+    assert os.path.exists(
+        os.path.join(file_annex_path, ".annex-index.sqlite3")
+    )
+
+
+def test_index_sharded(file_annex_path):
+    annex = Annex("file", file_annex_path, shard_width=2, index=True)
+    annex.save_file("foo/bar.txt", BytesIO(b"1\n"))
+    annex.save_file("foo/baz.json", BytesIO(b"2\n"))
+
+    assert annex.verify_index() == []
+    assert annex.rebuild_index() == 2
+    assert list(annex.list_keys("foo/")) == ["foo/bar.txt", "foo/baz.json"]
+
+
+def test_index_cli(file_annex_path, capsys):
+    annex = Annex("file", file_annex_path, index=True)
+    annex.save_file("foo/bar.txt", BytesIO(b"1\n"))
+    Annex("file", file_annex_path).save_file("foo/baz.json", BytesIO(b"2\n"))
+
+    assert main(["verify-index", file_annex_path]) == 1
+    assert capsys.readouterr().out == "foo/baz.json\n"
+
+    main(["rebuild-index", file_annex_path])
+    assert capsys.readouterr().out == "indexed 2 keys\n"
+
+    assert main(["verify-index", file_annex_path]) == 0
+
+
+def test_index_missing(file_annex_path):
+    annex = Annex("file", file_annex_path)
+
+    with pytest.raises(ValueError, match="no index"):
+        annex.rebuild_index()
+
+    with pytest.raises(ValueError, match="no index"):
+        annex.verify_index()
+
+
+def test_error_unknown_offload(file_annex_path):
+    with pytest.raises(ValueError):
+        Annex("file", file_annex_path, offload="unknown")
+
+
 def test_error_nonexistent_root_path(tmpdir):
     with pytest.raises(IOError):
         annex = Annex("file", tmpdir.join("dummy").strpath)
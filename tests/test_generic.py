@@ -1,6 +1,6 @@
 import pytest
 
-from flask_annex import Annex
+from flask_annex import Annex, utils
 
 # -----------------------------------------------------------------------------
 
@@ -15,3 +15,57 @@ def test_unknown_annex_from_env(monkeypatch):
 
     with pytest.raises(ValueError):
         Annex.from_env("FLASK_ANNEX")
+
+
+def test_get_config_from_env_types(monkeypatch):
+    monkeypatch.setenv("FLASK_ANNEX_FOO", "foo")
+    monkeypatch.setenv("FLASK_ANNEX_COUNT", "3")
+    monkeypatch.setenv("FLASK_ANNEX_ENABLED", "off")
+
+    assert utils.get_config_from_env(
+        "FLASK_ANNEX", {"count": int, "enabled": utils.parse_bool}
+    ) == {"foo": "foo", "count": 3, "enabled": False}
+
+
+@pytest.mark.parametrize(
+    ("value", "expected"),
+    (("1", True), ("Yes", True), ("false", False), (" 0 ", False)),
+)
+def test_parse_bool(value, expected):
+    assert utils.parse_bool(value) is expected
+
+
+def test_parse_bool_invalid():
+    with pytest.raises(ValueError):
+        utils.parse_bool("maybe")
+
+
+@pytest.mark.parametrize(
+    ("value", "expected"),
+    (
+        ("1024", 1024),
+        ("5b", 5),
+        ("8MiB", 8 * 1024**2),
+        ("8 MB", 8 * 1000**2),
+        ("64k", 64 * 1024),
+        ("1GiB", 1024**3),
+    ),
+)
+def test_parse_size(value, expected):
+    assert utils.parse_size(value) == expected
+
+
+@pytest.mark.parametrize("value", ("", "MB", "1.5MB", "8 parsecs"))
+def test_parse_size_invalid(value):
+    with pytest.raises(ValueError):
+        utils.parse_size(value)
+
+
+def test_start_concurrent_error():
+    def iter_items():
+        yield 1
+        raise ValueError("bad item")
+
+    results = utils.start_concurrent(lambda item: item * 2, iter_items(), 2)
+    with pytest.raises(ValueError, match="bad item"):
+        list(results)
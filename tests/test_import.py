@@ -0,0 +1,114 @@
+import flask
+import importlib.metadata
+import pytest
+import subprocess
+import sys
+from io import BytesIO
+from unittest.mock import Mock
+
+from flask_annex import Annex, utils
+
+# -----------------------------------------------------------------------------
+
+# Importing all of flask_annex, once Flask itself is imported, must take less
+# than this. Importing boto3 alone takes longer.
+IMPORT_TIME_BUDGET = 0.05
+
+# These only load when an annex needs them.
+LAZY_MODULES = ("boto3", "botocore", "sqlite3", "packaging")
+
+# Sending a file through FileAnnex must take at most this much longer than
+# sending it with Flask directly.
+SEND_FILE_OVERHEAD_BUDGET = 0.0002
+
+SEND_FILE_ROUNDS = 200
+
+# -----------------------------------------------------------------------------
+
+
+def run_python(code, *args):
+    return subprocess.run(
+        (sys.executable, *args, "-c", code),
+        capture_output=True,
+        check=True,
+        text=True,
+    )
+
+
+def get_import_time():
+    result = run_python(
+        "import flask, werkzeug.utils; "
+        "import flask_annex.aio, flask_annex.file, flask_annex.s3",
+        "-X",
+        "importtime",
+    )
+
+    # Lines look like "import time: self | cumulative | name", with names
+    # indented by nesting, so sum the cumulative times of top-level imports.
+    import_time = 0
+    for line in result.stderr.splitlines():
+        _, cumulative, name = line.split("|")
+        if name.startswith(" flask_annex"):
+            import_time += int(cumulative) / 1e6
+
+    return import_time
+
+
+# -----------------------------------------------------------------------------
+
+
+def test_import_lazy():
+    result = run_python(
+        "import sys; "
+        "import flask_annex.aio, flask_annex.file, flask_annex.s3; "
+        "flask_annex.file.FileAnnex('.'); "
+        "flask_annex.s3.S3Annex('bucket'); "
+        f"print(*(name for name in {LAZY_MODULES!r} if name in sys.modules))"
+    )
+    assert result.stdout.split() == []
+
+
+@pytest.mark.bench
+def test_import_time():
+    # Take the best of a few runs, so a busy machine doesn't fail the test.
+    import_time = min(get_import_time() for _ in range(3))
+    assert 0 < import_time < IMPORT_TIME_BUDGET
+
+
+def test_send_file_precomputed(app, tmpdir, monkeypatch):
+    annex = Annex("file", tmpdir.strpath)
+    annex.save_file("foo/bar.txt", BytesIO(b"1\n"))
+
+    utils.get_download_name_arg.cache_clear()
+    get_version = Mock(wraps=importlib.metadata.version)
+    monkeypatch.setattr("importlib.metadata.version", get_version)
+
+    for _ in range(3):
+        with app.test_request_context():
+            annex.send_file("foo/bar.txt").close()
+
+    assert get_version.call_count == 1
+
+
+@pytest.mark.bench
+def test_send_file_overhead(app, tmpdir, bench):
+    annex = Annex("file", tmpdir.strpath)
+    annex.save_file("foo/bar.txt", BytesIO(b"1\n"))
+
+    def send_file_flask():
+        with app.test_request_context():
+            flask.send_from_directory(
+                tmpdir.strpath, "foo/bar.txt", as_attachment=True
+            ).close()
+
+    def send_file_annex():
+        with app.test_request_context():
+            annex.send_file("foo/bar.txt").close()
+
+    flask_p50 = bench(
+        "send_file[flask]", send_file_flask, rounds=SEND_FILE_ROUNDS
+    )["p50"]
+    annex_p50 = bench(
+        "send_file[annex]", send_file_annex, rounds=SEND_FILE_ROUNDS
+    )["p50"]
+    assert annex_p50 - flask_p50 < SEND_FILE_OVERHEAD_BUDGET
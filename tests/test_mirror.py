@@ -0,0 +1,299 @@
+import itertools
+import pytest
+import threading
+import time
+from io import BytesIO
+from unittest.mock import Mock
+
+from flask_annex import Annex
+from flask_annex.mirror import ERROR_LATENCY, MirroredAnnex
+
+from .helpers import AbstractTestAnnex, assert_key_value
+
+# -----------------------------------------------------------------------------
+
+
+def hold_save_file(replica, monkeypatch, *, calls=None):
+    # Make save_file on the replica hang until the returned event is set, for
+    # the first calls calls, or for all of them.
+    release = threading.Event()
+    save_file = replica.save_file
+    held = itertools.count()
+
+    def held_save_file(*args, **kwargs):
+        if calls is None or next(held) < calls:
+            release.wait(5)
+        return save_file(*args, **kwargs)
+
+    monkeypatch.setattr(replica, "save_file", held_save_file)
+    return release
+
+
+def wait_for(predicate):
+    for _ in range(500):
+        if predicate():
+            return
+        time.sleep(0.01)
+
+    raise AssertionError("timed out")
+
+
+# -----------------------------------------------------------------------------
+
+
+@pytest.fixture
+def replicas(tmpdir):
+    return tuple(
+        Annex("file", tmpdir.join(f"replica{i}").mkdir().strpath)
+        for i in range(2)
+    )
+
+
+# -----------------------------------------------------------------------------
+
+
+class TestMirroredAnnex(AbstractTestAnnex):
+    @pytest.fixture
+    def annex_base(self, replicas):
+        annex = MirroredAnnex(replicas)
+        yield annex
+        annex.close()
+
+    def test_send_file(self, client):
+        response = client.get("/files/foo/baz.json")
+        assert response.status_code == 200
+        assert response.mimetype == "application/json"
+
+    def test_save_all(self, annex, replicas):
+        for replica in replicas:
+            assert_key_value(replica, "foo/bar.txt", b"1\n")
+            assert_key_value(replica, "foo/baz.json", b"2\n")
+
+    def test_write_quorum(self, annex, replicas, monkeypatch):
+        monkeypatch.setattr(
+            replicas[1], "save_file", Mock(side_effect=OSError("full"))
+        )
+
+        with pytest.raises(OSError, match="full"):
+            annex.save_file("foo/qux.txt", BytesIO(b"3\n"))
+
+        annex._write_quorum = 1
+        annex.save_file("foo/qux.txt", BytesIO(b"4\n"))
+        assert_key_value(replicas[0], "foo/qux.txt", b"4\n")
+
+    def test_write_quorum_slow(self, annex, replicas, monkeypatch):
+        annex._write_quorum = 1
+        release = hold_save_file(replicas[1], monkeypatch)
+
+        # The hung replica doesn't hold up the write, but stays stale until it
+        # catches up.
+        annex.save_file("foo/bar.txt", BytesIO(b"5\n"))
+        assert_key_value(replicas[0], "foo/bar.txt", b"5\n")
+        assert annex._stale == {"foo/bar.txt": [0]}
+
+        release.set()
+        wait_for(lambda: not annex._stale)
+        assert_key_value(replicas[1], "foo/bar.txt", b"5\n")
+
+    def test_write_quorum_slow_overtaken(self, annex, replicas, monkeypatch):
+        annex._write_quorum = 1
+        release = hold_save_file(replicas[1], monkeypatch, calls=1)
+
+        annex.save_file("foo/bar.txt", BytesIO(b"5\n"))
+        annex.save_file("foo/bar.txt", BytesIO(b"6\n"))
+        wait_for(lambda: not annex._stale)
+        assert_key_value(replicas[1], "foo/bar.txt", b"6\n")
+
+        # The slow write lands after the later one, so repair must undo it.
+        release.set()
+        wait_for(lambda: annex._stale)
+        assert_key_value(replicas[1], "foo/bar.txt", b"5\n")
+
+        assert annex.repair() == ["foo/bar.txt"]
+        assert_key_value(replicas[1], "foo/bar.txt", b"6\n")
+
+    def test_delete_all(self, annex, replicas):
+        annex.delete("foo/bar.txt")
+        annex.delete_many(iter(("foo/baz.json",)))
+
+        for replica in replicas:
+            assert not list(replica.list_keys(""))
+
+    def test_read_fastest(self, annex, replicas, monkeypatch):
+        annex._latencies = [1.0, 0.5]
+        get_file = Mock(wraps=replicas[0].get_file)
+        monkeypatch.setattr(replicas[0], "get_file", get_file)
+
+        assert_key_value(annex, "foo/bar.txt", b"1\n")
+        get_file.assert_not_called()
+        assert annex.latencies[1] < 0.5
+
+    def test_read_failover(self, annex, replicas, monkeypatch):
+        def get_file(key, out_file):
+            out_file.write(b"partial")
+            raise OSError("broken")
+
+        monkeypatch.setattr(replicas[0], "get_file", get_file)
+
+        out_file = BytesIO(b"x")
+        out_file.seek(1)
+        annex.get_file("foo/bar.txt", out_file)
+        assert out_file.getvalue() == b"x1\n"
+
+        # The failing replica now reads last.
+        assert annex.latencies[0] == pytest.approx(ERROR_LATENCY * 0.2)
+        assert annex._get_read_order() == [1, 0]
+
+    def test_read_failover_missing(self, annex, replicas):
+        replicas[0].delete("foo/bar.txt")
+
+        assert_key_value(annex, "foo/bar.txt", b"1\n")
+        assert annex.stat("foo/bar.txt").size == 2
+        assert annex.latencies[0] == 0
+
+        annex.delete("foo/bar.txt")
+        with pytest.raises(FileNotFoundError):
+            annex.get_file("foo/bar.txt", BytesIO())
+
+    def test_read_error(self, annex, replicas, monkeypatch):
+        for replica in replicas:
+            monkeypatch.setattr(
+                replica, "stat", Mock(side_effect=OSError("broken"))
+            )
+
+        with pytest.raises(OSError, match="broken"):
+            annex.stat("foo/bar.txt")
+
+    def test_list_keys_merged(self, annex, replicas):
+        replicas[0].delete("foo/bar.txt")
+        replicas[1].save_file("foo/qux.txt", BytesIO(b"3\n"))
+
+        assert list(annex.list_keys("foo")) == [
+            "foo/bar.txt",
+            "foo/baz.json",
+            "foo/qux.txt",
+        ]
+        assert list(annex.list_keys("foo", limit=2)) == [
+            "foo/bar.txt",
+            "foo/baz.json",
+        ]
+
+    def test_repair(self, annex, replicas):
+        replicas[0].delete("foo/bar.txt")
+        replicas[1].save_file("foo/qux.txt", BytesIO(b"3\n"))
+
+        assert annex.repair() == ["foo/bar.txt", "foo/qux.txt"]
+        for replica in replicas:
+            assert list(replica.list_keys("")) == [
+                "foo/bar.txt",
+                "foo/baz.json",
+                "foo/qux.txt",
+            ]
+        assert_key_value(replicas[0], "foo/bar.txt", b"1\n")
+
+        assert annex.repair() == []
+
+    def test_repair_overwrite(self, annex, replicas, monkeypatch):
+        annex._write_quorum = 1
+        with monkeypatch.context() as m:
+            m.setattr(
+                replicas[1], "save_file", Mock(side_effect=OSError("full"))
+            )
+            annex.save_file("foo/bar.txt", BytesIO(b"5\n"))
+
+        # Both replicas list the key, so only the failed write shows that the
+        # second one is out of date.
+        assert_key_value(replicas[1], "foo/bar.txt", b"1\n")
+
+        assert annex.repair() == ["foo/bar.txt"]
+        assert_key_value(replicas[1], "foo/bar.txt", b"5\n")
+        assert annex._stale == {}
+
+    def test_repair_delete(self, annex, replicas, monkeypatch):
+        annex._write_quorum = 1
+        with monkeypatch.context() as m:
+            m.setattr(replicas[1], "delete", Mock(side_effect=OSError("busy")))
+            annex.delete("foo/bar.txt")
+
+        # Listings alone would copy the key back to the first replica.
+        assert annex.repair() == ["foo/bar.txt"]
+        for replica in replicas:
+            assert list(replica.list_keys("")) == ["foo/baz.json"]
+
+    def test_repair_rewritten(self, annex, replicas, monkeypatch):
+        annex._write_quorum = 1
+        with monkeypatch.context() as m:
+            m.setattr(
+                replicas[1], "save_file", Mock(side_effect=OSError("full"))
+            )
+            annex.save_file("foo/bar.txt", BytesIO(b"5\n"))
+
+        # A write that reaches every replica leaves nothing to repair.
+        annex.save_file("foo/bar.txt", BytesIO(b"6\n"))
+        wait_for(lambda: not annex._stale)
+        assert annex.repair() == []
+        assert_key_value(replicas[1], "foo/bar.txt", b"6\n")
+
+
+@pytest.mark.requires_s3
+class TestMirroredS3Annex(AbstractTestAnnex):
+    # The S3 replica reads first, so its misses must fail over like any
+    # other annex's.
+
+    @pytest.fixture
+    def replicas(self, tmpdir, bucket_name):
+        return (
+            Annex("s3", bucket_name),
+            Annex("file", tmpdir.join("replica").mkdir().strpath),
+        )
+
+    @pytest.fixture
+    def annex_base(self, replicas):
+        annex = MirroredAnnex(replicas)
+        yield annex
+        annex.close()
+
+    def test_send_file(self, client):
+        response = client.get("/files/foo/baz.json")
+        assert response.status_code == 302
+
+    def test_read_failover_missing(self, annex, replicas):
+        replicas[0].delete("foo/bar.txt")
+
+        assert_key_value(annex, "foo/bar.txt", b"1\n")
+        with annex.open_read("foo/bar.txt") as in_fp:
+            assert in_fp.read() == b"1\n"
+        assert annex.stat("foo/bar.txt").size == 2
+
+        # Misses don't count against the S3 replica.
+        assert annex._get_read_order() == [0, 1]
+
+        annex.delete("foo/bar.txt")
+        with pytest.raises(FileNotFoundError):
+            annex.get_file("foo/bar.txt", BytesIO())
+
+
+# -----------------------------------------------------------------------------
+
+
+def test_write_quorum_invalid(replicas):
+    with pytest.raises(ValueError):
+        MirroredAnnex(replicas, write_quorum=3)
+
+    with pytest.raises(ValueError):
+        MirroredAnnex(())
+
+
+def test_repair_thread(replicas):
+    replicas[0].save_file("foo/bar.txt", BytesIO(b"1\n"))
+
+    annex = MirroredAnnex(replicas, repair_interval=0.01)
+    try:
+        for _ in range(100):
+            if list(replicas[1].list_keys("")):
+                break
+            time.sleep(0.01)
+    finally:
+        annex.close()
+
+    assert_key_value(replicas[1], "foo/bar.txt", b"1\n")
@@ -1,5 +1,6 @@
 import base64
 import json
+import os
 import pytest
 from io import BytesIO
 from unittest.mock import Mock
@@ -14,7 +15,10 @@ try:
     import boto3
     import requests
     from botocore.config import Config
-    from moto import mock_aws
+    from botocore.exceptions import ClientError
+
+    from flask_annex import s3
+    from flask_annex.s3 import S3Annex
 except ImportError:
     pytestmark = pytest.mark.skipif(True, reason="S3 support not installed")
 
@@ -22,12 +26,13 @@ except ImportError:
 
 
 @pytest.fixture
-def bucket_name():
-    with mock_aws():
-        bucket = boto3.resource("s3").Bucket("flask-annex")
-        bucket.create()
+def create_client(monkeypatch):
+    # Start from an empty pool, so clients made by other tests don't count.
+    monkeypatch.setattr("flask_annex.s3._clients", {})
 
-        yield bucket.name
+    create_client = Mock(wraps=boto3.client)
+    monkeypatch.setattr("boto3.client", create_client)
+    return create_client
 
 
 def get_policy(upload_info):
@@ -157,6 +162,186 @@ class TestS3Annex(AbstractTestAnnex):
 
         mock.assert_not_called()
 
+    @pytest.mark.parametrize(
+        ("size", "expected_chunksize"),
+        (
+            (None, 8 * 1024**2),
+            (1024, 8 * 1024**2),
+            (200 * 1024**2, 20 * 1024**2),
+            (10 * 1024**3, 64 * 1024**2),
+            (1024**4, 1024**4 // 10000 + 1),
+        ),
+    )
+    def test_transfer_config_size_aware(self, size, expected_chunksize):
+        transfer_config = S3Annex("flask-annex")._get_transfer_config(size)
+        assert transfer_config.multipart_threshold == 16 * 1024**2
+        assert transfer_config.multipart_chunksize == expected_chunksize
+        assert transfer_config.max_request_concurrency == 10
+
+    def test_many_single_threaded(self, annex, monkeypatch):
+        upload_fileobj = Mock(wraps=annex._client.upload_fileobj)
+        monkeypatch.setattr(annex._client, "upload_fileobj", upload_fileobj)
+        download_fileobj = Mock(wraps=annex._client.download_fileobj)
+        monkeypatch.setattr(
+            annex._client, "download_fileobj", download_fileobj
+        )
+
+        # Transfers already run on the bulk pool, so they don't start threads
+        # of their own.
+        list(annex.save_many((("foo/qux.txt", BytesIO(b"5\n")),)))
+        list(annex.get_many((("foo/qux.txt", BytesIO()),)))
+        assert not upload_fileobj.call_args.kwargs["Config"].use_threads
+        assert not download_fileobj.call_args.kwargs["Config"].use_threads
+
+        annex.get_file("foo/qux.txt", BytesIO())
+        config = download_fileobj.call_args.kwargs["Config"]
+        assert config.use_threads == annex._use_threads
+
+    def test_open_read_blocks(self, annex, monkeypatch):
+        annex.save_file("foo/qux.txt", BytesIO(b"0123456789"))
+
+        get_object = Mock(wraps=annex._client.get_object)
+        monkeypatch.setattr(annex._client, "get_object", get_object)
+
+        in_fp = annex.open_read("foo/qux.txt", block_size=4, max_blocks=2)
+        assert in_fp.size == 10
+
+        assert in_fp.read(2) == b"01"
+        assert in_fp.read(2) == b"23"
+        assert get_object.call_count == 1
+        assert get_object.call_args.kwargs["Range"] == "bytes=0-3"
+
+        in_fp.seek(8)
+        assert in_fp.read() == b"89"
+        assert get_object.call_count == 2
+        assert get_object.call_args.kwargs["Range"] == "bytes=8-9"
+
+        # Reading the middle block evicts the first one.
+        in_fp.seek(0)
+        assert in_fp.read() == b"0123456789"
+        assert get_object.call_count == 4
+
+    def test_open_read_changed(self, annex):
+        in_fp = annex.open_read("foo/bar.txt")
+        annex.save_file("foo/bar.txt", BytesIO(b"5\n"))
+
+        with pytest.raises(ClientError):
+            in_fp.read()
+
+    def test_open_write_multipart(self, annex, monkeypatch):
+        upload_part = Mock(wraps=annex._client.upload_part)
+        monkeypatch.setattr(annex._client, "upload_part", upload_part)
+
+        part_size = 5 * 1024**2
+        with annex.open_write("foo/qux.txt", part_size=part_size) as out_fp:
+            for _ in range(11):
+                out_fp.write(b"8" * 1024**2)
+
+        assert upload_part.call_count == 3
+        assert annex.stat("foo/qux.txt").content_type == "text/plain"
+        assert_key_value(annex, "foo/qux.txt", b"8" * (11 * 1024**2))
+
+    def test_open_write_part_size_grows(self, annex, monkeypatch):
+        monkeypatch.setattr(s3, "PARTS_PER_SIZE_DOUBLING", 1)
+        upload_part = Mock(wraps=annex._client.upload_part)
+        monkeypatch.setattr(annex._client, "upload_part", upload_part)
+
+        part_size = 5 * 1024**2
+        data = b"8" * (16 * 1024**2)
+        with annex.open_write("foo/qux.txt", part_size=part_size) as out_fp:
+            out_fp.write(data)
+
+        assert [
+            len(call.kwargs["Body"]) for call in upload_part.call_args_list
+        ] == [part_size, 2 * part_size, 1024**2]
+        assert_key_value(annex, "foo/qux.txt", data)
+
+    def test_open_write_part_size_invalid(self, annex):
+        with pytest.raises(ValueError):
+            annex.open_write("foo/qux.txt", part_size=1024**2)
+
+    def test_open_write_multipart_error(self, annex, monkeypatch):
+        monkeypatch.setattr(
+            annex._client, "upload_part", Mock(side_effect=ValueError())
+        )
+        abort_multipart_upload = Mock(
+            wraps=annex._client.abort_multipart_upload
+        )
+        monkeypatch.setattr(
+            annex._client, "abort_multipart_upload", abort_multipart_upload
+        )
+
+        out_fp = annex.open_write("foo/qux.txt", part_size=5 * 1024**2)
+        out_fp.write(b"8" * (6 * 1024**2))
+
+        with pytest.raises(ValueError):
+            out_fp.close()
+
+        abort_multipart_upload.assert_called_once()
+        assert not annex.exists("foo/qux.txt")
+
+    def test_client_connection_pool(self, annex):
+        assert (
+            annex._client.meta.config.max_pool_connections
+            == annex._max_concurrency
+        )
+
+    def test_list_entries_listing_only(self, annex, monkeypatch):
+        annex.save_file("foo/bar/qux.txt", BytesIO(b"3\n"))
+        monkeypatch.setattr(
+            annex._client, "head_object", Mock(side_effect=AssertionError)
+        )
+
+        assert [entry.size for entry in annex.list_entries("foo/")] == [
+            2,
+            2,
+            2,
+        ]
+        assert [
+            entry.size for entry in annex.list_entries("foo/", recursive=False)
+        ] == [2, None, 2]
+
+    def test_delete_many_batches(self, annex, monkeypatch):
+        monkeypatch.setattr("flask_annex.s3.DELETE_BATCH_SIZE", 2)
+        for i in range(3):
+            annex.save_file(f"foo/{i}.txt", BytesIO(b"7\n"))
+
+        mock = Mock(wraps=annex._client.delete_objects)
+        monkeypatch.setattr(annex._client, "delete_objects", mock)
+
+        keys = iter(annex.list_keys("foo/"))
+        assert annex.delete_many(keys) == []
+
+        assert mock.call_count == 3
+        assert not tuple(annex.list_keys(""))
+
+    def test_delete_prefix_batches(self, annex, monkeypatch):
+        monkeypatch.setattr("flask_annex.s3.DELETE_BATCH_SIZE", 2)
+        for i in range(5):
+            annex.save_file(f"qux/{i}.txt", BytesIO(b"7\n"))
+
+        mock = Mock(wraps=annex._client.delete_objects)
+        monkeypatch.setattr(annex._client, "delete_objects", mock)
+
+        # Each page of 2 keys is one batch.
+        assert annex.delete_prefix("qux/") == []
+        assert mock.call_count == 3
+        assert list(annex.list_keys("")) == ["foo/bar.txt", "foo/baz.json"]
+
+    def test_delete_many_errors(self, annex, monkeypatch):
+        error = {
+            "Key": "foo/bar.txt",
+            "Code": "AccessDenied",
+            "Message": "Access Denied",
+        }
+        monkeypatch.setattr(
+            annex._client,
+            "delete_objects",
+            Mock(return_value={"Errors": [error]}),
+        )
+
+        assert annex.delete_many(("foo/bar.txt", "foo/baz.json")) == [error]
+
 
 class TestS3AnnexFromEnv(TestS3Annex):
     @pytest.fixture
@@ -180,6 +365,136 @@ class TestS3AnnexMaxContentLength(TestS3Annex):
         assert get_condition(conditions, "content-length-range") == [0, 1000]
 
 
+class TestS3AnnexPresignedUrlCache(TestS3Annex):
+    @pytest.fixture
+    def annex_base(self, bucket_name):
+        return Annex("s3", bucket_name, presigned_url_cache_size=2)
+
+    @pytest.fixture
+    def now(self, monkeypatch):
+        # This is at the start of a 150-second time bucket.
+        now = Mock(return_value=1_050_000)
+        monkeypatch.setattr("flask_annex.s3.time.time", now)
+        return now
+
+    @pytest.fixture
+    def sign(self, annex, monkeypatch):
+        sign = Mock(wraps=annex._client.generate_presigned_url)
+        monkeypatch.setattr(annex._client, "generate_presigned_url", sign)
+        return sign
+
+    def test_presigned_url_reused(self, annex, now, sign):
+        url = annex.generate_presigned_url("foo/bar.txt")
+
+        now.return_value += 149
+        assert annex.generate_presigned_url("foo/bar.txt") == url
+        assert sign.call_count == 1
+
+        annex.generate_presigned_url("foo/baz.json")
+        annex.generate_presigned_url("foo/bar.txt", "inline")
+        assert sign.call_count == 3
+
+    def test_presigned_url_expires(self, annex, now, sign):
+        annex.generate_presigned_url("foo/bar.txt")
+
+        now.return_value += 150
+        annex.generate_presigned_url("foo/bar.txt")
+        assert sign.call_count == 2
+
+    def test_presigned_url_evicted(self, annex, now, sign):
+        annex.generate_presigned_url("foo/bar.txt")
+        annex.generate_presigned_url("foo/baz.json")
+        annex.generate_presigned_url("foo/bar.txt")
+        assert sign.call_count == 2
+
+        annex.generate_presigned_url("foo/qux.txt")
+        annex.generate_presigned_url("foo/baz.json")
+        assert sign.call_count == 4
+
+    def test_presigned_url_evicted_dispositions(self, annex, now, sign):
+        # Each content disposition takes its own cache slot.
+        for i in range(3):
+            annex.generate_presigned_url("foo/bar.txt", f"inline; n={i}")
+        assert len(annex._presigned_url_cache) == 2
+
+        annex.generate_presigned_url("foo/bar.txt", "inline; n=2")
+        annex.generate_presigned_url("foo/bar.txt", "inline; n=0")
+        assert sign.call_count == 4
+
+    def test_presigned_url_invalidated(self, annex, now, sign):
+        annex.generate_presigned_url("foo/bar.txt")
+        annex.generate_presigned_url("foo/bar.txt", "inline")
+        annex.save_file("foo/bar.txt", BytesIO(b"5\n"))
+        assert len(annex._presigned_url_cache) == 0
+
+        annex.generate_presigned_url("foo/bar.txt")
+        annex.delete("foo/bar.txt")
+        annex.generate_presigned_url("foo/bar.txt")
+        assert sign.call_count == 4
+
+    def test_presigned_url_expires_with_bucket(self, annex, now, sign):
+        now.return_value += 100
+        annex.generate_presigned_url("foo/bar.txt")
+        assert sign.call_args.kwargs["ExpiresIn"] == 200
+
+    def test_presigned_url_invalidated_while_signing(
+        self, annex, now, sign, monkeypatch
+    ):
+        sign_url = annex._sign_url
+
+        def sign_url_and_save(*args):
+            url = sign_url(*args)
+            annex.save_file("foo/bar.txt", BytesIO(b"5\n"))
+            return url
+
+        monkeypatch.setattr(annex, "_sign_url", sign_url_and_save)
+        annex.generate_presigned_url("foo/bar.txt")
+        assert len(annex._presigned_url_cache) == 0
+
+
+class TestS3AnnexTransferConfig(TestS3Annex):
+    @pytest.fixture
+    def annex_base(self, monkeypatch, bucket_name):
+        monkeypatch.setenv("FLASK_ANNEX_STORAGE", "s3")
+        monkeypatch.setenv("FLASK_ANNEX_S3_BUCKET_NAME", bucket_name)
+        monkeypatch.setenv("FLASK_ANNEX_S3_MAX_CONCURRENCY", "4")
+        monkeypatch.setenv("FLASK_ANNEX_S3_MULTIPART_THRESHOLD", "5MiB")
+        monkeypatch.setenv("FLASK_ANNEX_S3_MULTIPART_CHUNKSIZE", "5MiB")
+        monkeypatch.setenv("FLASK_ANNEX_S3_USE_THREADS", "false")
+
+        return Annex.from_env("FLASK_ANNEX")
+
+    def test_transfer_config(self, annex):
+        transfer_config = annex._get_transfer_config(1024**3)
+        assert transfer_config.multipart_threshold == 5 * 1024**2
+        assert transfer_config.multipart_chunksize == 5 * 1024**2
+        assert transfer_config.max_request_concurrency == 4
+        assert transfer_config.use_threads is False
+
+    def test_transfer_config_part_limit(self, annex):
+        # 5 MiB parts would take more than 10000 parts.
+        transfer_config = annex._get_transfer_config(1024**4)
+        assert transfer_config.multipart_chunksize == 1024**4 // 10000 + 1
+
+    def test_transfer_config_chunksize_invalid(self, bucket_name):
+        with pytest.raises(ValueError):
+            Annex("s3", bucket_name, multipart_chunksize=1024**2)
+
+    def test_save_file_multipart(self, annex, monkeypatch):
+        create_multipart_upload = Mock(
+            wraps=annex._client.create_multipart_upload
+        )
+        monkeypatch.setattr(
+            annex._client, "create_multipart_upload", create_multipart_upload
+        )
+
+        data = b"8" * (6 * 1024**2)
+        annex.save_file("foo/qux.txt", BytesIO(data))
+
+        create_multipart_upload.assert_called_once()
+        assert_key_value(annex, "foo/qux.txt", data)
+
+
 class TestS3AnnexAdvancedConfig(TestS3Annex):
     @pytest.fixture
     def annex_base(self, bucket_name):
@@ -193,3 +508,120 @@ class TestS3AnnexAdvancedConfig(TestS3Annex):
             upload_info["url"]
             == "https://flask-annex.s3.dualstack.us-east-1.amazonaws.com/"
         )
+
+
+# -----------------------------------------------------------------------------
+
+
+def test_client_lazy(bucket_name, create_client):
+    annex = Annex("s3", bucket_name)
+    create_client.assert_not_called()
+
+    assert not annex.exists("foo/bar.txt")
+    assert not annex.exists("foo/baz.json")
+    create_client.assert_called_once()
+
+
+def test_client_shared(bucket_name, create_client):
+    annex = Annex("s3", bucket_name)
+    assert Annex("s3", "flask-annex-2")._client is annex._client
+    assert (
+        Annex(
+            "s3", bucket_name, config=Config(max_pool_connections=10)
+        )._client
+        is annex._client
+    )
+    assert create_client.call_count == 1
+
+    assert Annex("s3", bucket_name, region="eu-west-1")._client is not (
+        annex._client
+    )
+    assert Annex("s3", bucket_name, max_concurrency=2)._client is not (
+        annex._client
+    )
+    dualstack_annex = Annex(
+        "s3", bucket_name, config=Config(use_dualstack_endpoint=True)
+    )
+    assert dualstack_annex._client is not annex._client
+    assert create_client.call_count == 4
+
+    # Equal configs share a client, even as separate objects.
+    assert (
+        Annex(
+            "s3", bucket_name, config=Config(use_dualstack_endpoint=True)
+        )._client
+        is dualstack_annex._client
+    )
+    assert Annex(
+        "s3", bucket_name, config=Config(max_pool_connections=20)
+    )._client is not (annex._client)
+    assert create_client.call_count == 5
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="fork not supported")
+def test_client_after_fork(bucket_name):
+    annex = Annex("s3", bucket_name)
+    client = annex._client
+
+    pid = os.fork()
+    if not pid:
+        os._exit(0 if annex._client is not client else 1)
+
+    _, status = os.waitpid(pid, 0)
+    assert os.waitstatus_to_exitcode(status) == 0
+    assert annex._client is client
+
+
+# -----------------------------------------------------------------------------
+
+
+@pytest.mark.bench
+@pytest.mark.parametrize("mode", ("unused", "shared", "unshared"))
+def test_bench_create_annexes(bucket_name, bench, monkeypatch, mode):
+    # An app with one annex per bucket. Unshared clients are what every annex
+    # created for itself before clients were pooled.
+    def create_annexes():
+        clients = []
+        for i in range(4):
+            annex = Annex("s3", f"{bucket_name}-{i}")
+            if mode == "unused":
+                continue
+
+            if mode == "unshared":
+                s3._clients.clear()
+
+            clients.append(annex._client)
+
+    bench(
+        f"create_annexes[{mode}]",
+        create_annexes,
+        rounds=5,
+        setup=s3._clients.clear,
+    )
+
+
+@pytest.mark.bench
+@pytest.mark.parametrize(
+    "transfer_options",
+    (
+        # These are boto's default TransferConfig settings.
+        {
+            "multipart_threshold": 8 * 1024**2,
+            "multipart_chunksize": 8 * 1024**2,
+        },
+        {},
+    ),
+    ids=("boto_defaults", "size_aware"),
+)
+@pytest.mark.parametrize("size", (4 * 1024**2, 12 * 1024**2, 64 * 1024**2))
+def test_bench_transfer_config(bucket_name, bench, transfer_options, size):
+    annex = Annex("s3", bucket_name, **transfer_options)
+    data = b"0" * size
+    name = "boto_defaults" if transfer_options else "size_aware"
+
+    bench(
+        f"save_file[{name}-{size}]",
+        lambda: annex.save_file("bench/file", BytesIO(data)),
+        rounds=3,
+        nbytes=size,
+    )
@@ -0,0 +1,218 @@
+import os
+import pytest
+from io import BytesIO
+from unittest.mock import Mock
+
+from flask_annex import Annex
+from flask_annex.compress import CompressedAnnex
+from flask_annex.metrics import MetricsAggregator
+from flask_annex.signals import operation_finished, operation_started
+
+from .helpers import AbstractTestAnnex
+
+# -----------------------------------------------------------------------------
+
+
+@pytest.fixture
+def file_annex(tmpdir):
+    annex = Annex("file", tmpdir.join("annex").mkdir().strpath)
+    annex.save_file("foo/bar.txt", BytesIO(b"1\n"))
+    return annex
+
+
+@pytest.fixture
+def started():
+    receiver = Mock()
+    operation_started.connect(receiver)
+    yield receiver
+    operation_started.disconnect(receiver)
+
+
+@pytest.fixture
+def finished():
+    receiver = Mock()
+    operation_finished.connect(receiver)
+    yield receiver
+    operation_finished.disconnect(receiver)
+
+
+def get_calls(receiver):
+    return [call.kwargs for call in receiver.call_args_list]
+
+
+# -----------------------------------------------------------------------------
+
+
+class TestInstrumentedAnnex(AbstractTestAnnex):
+    @pytest.fixture
+    def annex_base(self, tmpdir, finished):
+        return Annex("file", tmpdir.strpath)
+
+    def test_send_file(self, client, finished):
+        response = client.get("/files/foo/baz.json")
+        assert response.status_code == 200
+
+        assert get_calls(finished)[-1]["operation"] == "send_file"
+
+
+# -----------------------------------------------------------------------------
+
+
+def test_signals(file_annex, started, finished):
+    out_file = BytesIO(b"ab")
+    out_file.seek(2)
+    file_annex.get_file("foo/bar.txt", out_file)
+
+    (started_call,) = started.call_args_list
+    assert started_call.args == (file_annex,)
+    assert started_call.kwargs == {
+        "operation": "get_file",
+        "key": "foo/bar.txt",
+        "backend": "FileAnnex",
+    }
+
+    (finished_call,) = finished.call_args_list
+    assert finished_call.args == (file_annex,)
+    assert finished_call.kwargs["duration"] > 0
+    assert finished_call.kwargs["nbytes"] == 2
+    assert finished_call.kwargs["error"] is None
+
+
+def test_signals_filename(tmpdir, file_annex, finished):
+    in_file = tmpdir.join("in")
+    in_file.write_binary(b"12345")
+    file_annex.save_file("foo/qux.txt", in_file.strpath)
+
+    out_filename = tmpdir.join("out").strpath
+    file_annex.get_file("foo/qux.txt", out_filename)
+
+    assert [call["nbytes"] for call in get_calls(finished)] == [5, 5]
+
+
+def test_signals_error(file_annex, finished):
+    with pytest.raises(FileNotFoundError):
+        file_annex.stat("foo/@@nonexistent")
+
+    (call,) = get_calls(finished)
+    assert isinstance(call["error"], FileNotFoundError)
+    assert call["nbytes"] is None
+
+
+def test_signals_nested(file_annex, finished):
+    # FileAnnex implements exists with stat, which isn't reported on its own.
+    assert file_annex.exists("foo/bar.txt")
+    assert [call["operation"] for call in get_calls(finished)] == ["exists"]
+
+    with file_annex.open_mapped("foo/bar.txt") as data:
+        assert data[:] == b"1\n"
+
+    assert get_calls(finished)[-1]["nbytes"] == 2
+
+
+def test_signals_nested_batch(file_annex, finished):
+    # Batch operations run their inner calls on other threads.
+    file_annex.stat_many(("foo/bar.txt", "foo/@@nonexistent"))
+    errors = dict(file_annex.get_many((("foo/bar.txt", BytesIO()),)))
+    assert errors == {"foo/bar.txt": None}
+
+    assert [call["operation"] for call in get_calls(finished)] == [
+        "stat_many",
+        "get_many",
+    ]
+
+
+def test_signals_kwargs(file_annex, finished):
+    out_file = BytesIO()
+    file_annex.get_file(key="foo/bar.txt", out_file=out_file)
+
+    (call,) = get_calls(finished)
+    assert call["key"] == "foo/bar.txt"
+    assert call["nbytes"] == 2
+
+
+def test_signals_wrapped(file_annex, finished):
+    annex = CompressedAnnex(file_annex)
+    annex.save_file("foo/qux.json", BytesIO(b"{}"))
+
+    assert [
+        (call["backend"], call["operation"]) for call in get_calls(finished)
+    ] == [
+        ("FileAnnex", "open_write"),
+        ("FileAnnex", "stat"),
+        ("CompressedAnnex", "save_file"),
+    ]
+
+
+def test_nbytes_unknown(file_annex, finished):
+    in_file = Mock(spec=("read",), read=Mock(side_effect=(b"12", b"")))
+    file_annex.save_file("foo/qux.txt", in_file)
+
+    assert get_calls(finished)[-1]["nbytes"] is None
+    assert os.path.getsize(file_annex._get_filename("foo/qux.txt")) == 2
+
+
+def test_no_receivers(file_annex, monkeypatch):
+    monkeypatch.setattr(
+        "flask_annex.signals.time.perf_counter",
+        Mock(side_effect=AssertionError),
+    )
+
+    assert file_annex.exists("foo/bar.txt")
+
+
+def test_metrics(file_annex):
+    with MetricsAggregator(buckets=(1, 2)) as metrics:
+        file_annex.get_file("foo/bar.txt", BytesIO())
+        file_annex.get_file("foo/bar.txt", BytesIO())
+
+        with pytest.raises(FileNotFoundError):
+            file_annex.get_file("foo/@@nonexistent", BytesIO())
+
+        assert metrics.snapshot() == {
+            ("FileAnnex", "get_file"): (
+                3,
+                1,
+                pytest.approx(0, abs=1),
+                4,
+                (3, 0),
+            )
+        }
+
+        metrics.reset()
+        assert metrics.snapshot() == {}
+
+    file_annex.get_file("foo/bar.txt", BytesIO())
+    assert metrics.snapshot() == {}
+
+
+def test_metrics_sender(file_annex, tmpdir):
+    other_annex = Annex("file", tmpdir.strpath)
+
+    metrics = MetricsAggregator()
+    metrics.connect(file_annex)
+    try:
+        file_annex.exists("foo/bar.txt")
+        other_annex.exists("foo/bar.txt")
+    finally:
+        metrics.disconnect()
+
+    assert metrics.snapshot()[("FileAnnex", "exists")].count == 1
+
+
+# -----------------------------------------------------------------------------
+
+
+@pytest.mark.bench
+@pytest.mark.parametrize("receivers", ("none", "metrics"))
+def test_bench_instrumentation(file_annex, bench, receivers):
+    def stat():
+        for _ in range(1000):
+            file_annex.stat("foo/bar.txt")
+
+    if receivers == "none":
+        bench("stat_1000[none]", stat)
+    else:
+        with MetricsAggregator() as metrics:
+            bench(f"stat_1000[{receivers}]", stat)
+
+        assert metrics.snapshot()[("FileAnnex", "stat")].count
@@ -0,0 +1,243 @@
+import pytest
+import time
+from io import BytesIO
+from unittest.mock import Mock
+
+from flask_annex import Annex
+from flask_annex.tiered import TieredAnnex
+
+from .helpers import AbstractTestAnnex, assert_key_value
+
+# -----------------------------------------------------------------------------
+
+
+@pytest.fixture
+def hot_annex(tmpdir):
+    return Annex("file", tmpdir.join("hot").mkdir().strpath)
+
+
+@pytest.fixture
+def cold_annex(tmpdir):
+    return Annex("file", tmpdir.join("cold").mkdir().strpath)
+
+
+def read_times(annex, key, times):
+    for _ in range(times):
+        annex.get_file(key, BytesIO())
+
+
+# -----------------------------------------------------------------------------
+
+
+class TestTieredAnnex(AbstractTestAnnex):
+    @pytest.fixture
+    def annex_base(self, hot_annex, cold_annex):
+        return TieredAnnex(
+            hot_annex, cold_annex, max_size=4, rebalance_interval=None
+        )
+
+    def test_send_file(self, client):
+        response = client.get("/files/foo/baz.json")
+        assert response.status_code == 200
+        assert response.mimetype == "application/json"
+
+    def test_save_hot(self, annex, hot_annex, cold_annex):
+        assert list(hot_annex.list_keys("")) == ["foo/bar.txt", "foo/baz.json"]
+        assert not list(cold_annex.list_keys(""))
+
+    def test_demote(self, annex, hot_annex, cold_annex):
+        annex._max_size = 2
+        read_times(annex, "foo/bar.txt", 2)
+        annex.rebalance()
+
+        assert list(hot_annex.list_keys("")) == ["foo/bar.txt"]
+        assert list(cold_annex.list_keys("")) == ["foo/baz.json"]
+        assert annex.tier_info() == (2, 2, 0, 1)
+
+        assert_key_value(annex, "foo/baz.json", b"2\n")
+        assert annex.stat("foo/baz.json").size == 2
+        assert list(annex.list_keys("")) == ["foo/bar.txt", "foo/baz.json"]
+
+    def test_demote_newest_kept(self, annex, hot_annex):
+        annex._max_size = 4
+        time.sleep(0.01)
+        annex.save_file("foo/qux.txt", BytesIO(b"3\n"))
+        read_times(annex, "foo/baz.json", 1)
+        annex.rebalance()
+
+        # Unread keys rank by how recently they were written.
+        assert list(hot_annex.list_keys("")) == ["foo/baz.json", "foo/qux.txt"]
+
+    def test_promote(self, annex, hot_annex, cold_annex):
+        annex._max_size = 2
+        read_times(annex, "foo/bar.txt", 2)
+        annex.rebalance()
+
+        read_times(annex, "foo/baz.json", 2)
+        annex.rebalance()
+
+        assert list(hot_annex.list_keys("")) == ["foo/baz.json"]
+        assert annex.tier_info() == (2, 2, 1, 2)
+
+        # The promoted key keeps its cold copy, but is only listed once.
+        assert list(cold_annex.list_keys("")) == [
+            "foo/bar.txt",
+            "foo/baz.json",
+        ]
+        assert list(annex.list_keys("")) == ["foo/bar.txt", "foo/baz.json"]
+        assert list(annex.list_keys("", limit=1)) == ["foo/bar.txt"]
+
+    def test_promote_after(self, annex, hot_annex):
+        annex._max_size = 2
+        read_times(annex, "foo/bar.txt", 2)
+        annex.rebalance()
+
+        # A single read isn't enough to promote a key.
+        read_times(annex, "foo/baz.json", 1)
+        annex.rebalance()
+
+        assert list(hot_annex.list_keys("")) == ["foo/bar.txt"]
+
+    def test_demote_clean(self, annex, cold_annex, monkeypatch):
+        annex._max_size = 2
+        read_times(annex, "foo/bar.txt", 2)
+        annex.rebalance()
+        read_times(annex, "foo/baz.json", 4)
+        annex.rebalance()
+
+        save_file = Mock(wraps=cold_annex.save_file)
+        monkeypatch.setattr(cold_annex, "save_file", save_file)
+
+        # foo/baz.json wasn't written since its promotion, so demoting it
+        # doesn't upload it again.
+        annex._max_size = 0
+        annex.rebalance()
+
+        save_file.assert_not_called()
+        assert annex.tier_info().demotions == 3
+        assert_key_value(annex, "foo/baz.json", b"2\n")
+
+    def test_save_demoted(self, annex, hot_annex, cold_annex):
+        annex._max_size = 0
+        annex.rebalance()
+        assert not list(hot_annex.list_keys(""))
+
+        annex.save_file("foo/bar.txt", BytesIO(b"5\n"))
+        assert list(cold_annex.list_keys("")) == ["foo/baz.json"]
+        assert_key_value(annex, "foo/bar.txt", b"5\n")
+
+        annex.rebalance()
+        assert_key_value(annex, "foo/bar.txt", b"5\n")
+
+    def test_delete_demoted(self, annex, hot_annex, cold_annex):
+        annex._max_size = 0
+        annex.rebalance()
+
+        annex.delete("foo/bar.txt")
+        annex.delete_many(iter(("foo/baz.json",)))
+        assert not list(cold_annex.list_keys(""))
+
+        with pytest.raises(FileNotFoundError):
+            annex.get_file("foo/bar.txt", BytesIO())
+
+    def test_key_locks_released(self, annex):
+        annex._max_size = 0
+        annex.rebalance()
+        annex.delete_many(("foo/bar.txt", "foo/bar.txt"))
+
+        assert annex._key_locks == {}
+
+    def test_read_saved_while_reading(self, annex, cold_annex, monkeypatch):
+        annex._max_size = 2
+        read_times(annex, "foo/baz.json", 2)
+        annex.rebalance()
+
+        # The save moves the key from the cold tier to the hot one after the
+        # read misses the hot tier.
+        cold_get_file = cold_annex.get_file
+
+        def get_file(key, out_file):
+            annex.save_file(key, BytesIO(b"3\n"))
+            cold_get_file(key, out_file)
+
+        monkeypatch.setattr(cold_annex, "get_file", get_file)
+
+        out_file = BytesIO()
+        annex.get_file("foo/bar.txt", out_file)
+        assert out_file.getvalue() == b"3\n"
+
+
+@pytest.mark.requires_s3
+class TestTieredS3Annex(AbstractTestAnnex):
+    @pytest.fixture
+    def cold_annex(self, bucket_name):
+        return Annex("s3", bucket_name)
+
+    @pytest.fixture
+    def annex_base(self, hot_annex, cold_annex):
+        return TieredAnnex(
+            hot_annex, cold_annex, max_size=4, rebalance_interval=None
+        )
+
+    def test_send_file(self, client):
+        response = client.get("/files/foo/baz.json")
+        assert response.status_code == 200
+        assert response.mimetype == "application/json"
+
+    def test_send_file_cold(self, annex, client):
+        annex._max_size = 0
+        annex.rebalance()
+
+        response = client.get("/files/foo/baz.json")
+        assert response.status_code == 302
+
+    def test_demote_promote(self, annex, hot_annex, cold_annex):
+        annex._max_size = 2
+        read_times(annex, "foo/bar.txt", 2)
+        annex.rebalance()
+
+        # The hot key misses on S3, and the cold one on the hot annex.
+        assert list(cold_annex.list_keys("")) == ["foo/baz.json"]
+        assert_key_value(annex, "foo/baz.json", b"2\n")
+        with annex.open_read("foo/baz.json") as in_fp:
+            assert in_fp.read() == b"2\n"
+
+        read_times(annex, "foo/baz.json", 2)
+        annex.rebalance()
+        assert list(hot_annex.list_keys("")) == ["foo/baz.json"]
+        assert annex.tier_info() == (2, 2, 1, 2)
+
+    def test_promote_deleted(self, annex, cold_annex):
+        annex._max_size = 2
+        read_times(annex, "foo/bar.txt", 2)
+        annex.rebalance()
+        read_times(annex, "foo/baz.json", 2)
+
+        # Deleted behind the annex's back between listing and promotion.
+        cold_annex.delete("foo/baz.json")
+        annex._promote("foo/baz.json")
+        assert annex.tier_info().promotions == 0
+
+        with pytest.raises(FileNotFoundError):
+            annex.get_file("foo/baz.json", BytesIO())
+
+
+# -----------------------------------------------------------------------------
+
+
+def test_rebalance_thread(hot_annex, cold_annex):
+    hot_annex.save_file("foo/bar.txt", BytesIO(b"1\n"))
+
+    annex = TieredAnnex(
+        hot_annex, cold_annex, max_size=0, rebalance_interval=0.01
+    )
+    try:
+        for _ in range(100):
+            if annex.tier_info().demotions:
+                break
+            time.sleep(0.01)
+    finally:
+        annex.close()
+
+    assert list(cold_annex.list_keys("")) == ["foo/bar.txt"]
+    assert not annex._rebalance_thread.is_alive()